@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+"""
+bench_balance.py: benchmark Balance and BalanceArray against the old Balance
+
+The old class had no __slots__, recomputed 10**decimals on every operation
+and allocated a new object for every result. Run from model/chain, e.g.:
+
+    RUN_SHELL=1 ./run.sh
+    python bench_balance.py 200000
+"""
+import sys
+import timeit
+
+from model import Balance, BalanceArray, EXCHG, max_accounts
+
+class LegacyBalance:
+    """
+    The parts of Balance from before __slots__ and the scale table that the
+    hot paths use.
+    """
+
+    def __init__(self, wei=0, decimals=0):
+        self._wei = int(wei)
+        self._decimals = int(decimals)
+
+    @classmethod
+    def from_tokens(cls, n, decimals=0):
+        return cls(n * 10**decimals, decimals)
+
+    def __add__(self, other):
+        if isinstance(other, LegacyBalance):
+            if other._decimals != self._decimals:
+                raise ValueError("Cannot add balances with different decimals: {}, {}", self, other)
+            return LegacyBalance(self._wei + other._wei, self._decimals)
+        else:
+            return LegacyBalance(self._wei + other * 10**self._decimals, self._decimals)
+
+    def __iadd__(self, other):
+        if isinstance(other, LegacyBalance):
+            if other._decimals != self._decimals:
+                raise ValueError("Cannot add balances with different decimals: {}, {}", self, other)
+            self._wei += other._wei
+        else:
+            self._wei += other * 10**self._decimals
+        return self
+
+    def __radd__(self, other):
+        return self + other
+
+    def __gt__(self, other):
+        if isinstance(other, LegacyBalance):
+            if other._decimals != self._decimals:
+                raise ValueError("Cannot compare balances with different decimals: {}, {}", self, other)
+            return self._wei > other._wei
+        else:
+            return float(self) > other
+
+    def __float__(self):
+        return self._wei / 10**self._decimals
+
+    def __str__(self):
+        base = 10**self._decimals
+        ipart = self._wei // base
+        fpart = self._wei - base * ipart
+        return ('{}.{:0' + str(self._decimals) + 'd}').format(ipart, fpart)
+
+    def to_decimals(self, new_decimals):
+        return LegacyBalance(self._wei * 10**new_decimals // 10**self._decimals, new_decimals)
+
+def bench(label, legacy, current, number):
+    legacy_time = timeit.timeit(legacy, number=number)
+    current_time = timeit.timeit(current, number=number)
+    print('{:<28} legacy {:8.3f} us  current {:8.3f} us  speedup {:.1f}x'.format(
+        label, legacy_time / number * 1e6, current_time / number * 1e6, legacy_time / current_time))
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    decimals = EXCHG['decimals']
+
+    la = LegacyBalance.from_tokens(12.5, decimals)
+    lb = LegacyBalance.from_tokens(3, decimals)
+    ca = Balance.from_tokens(12.5, decimals)
+    cb = Balance.from_tokens(3, decimals)
+
+    def legacy_iadd():
+        x = la
+        x += lb
+
+    def current_iadd():
+        x = ca
+        x += cb
+
+    bench('a + b', lambda: la + lb, lambda: ca + cb, number)
+    bench('a += b', legacy_iadd, current_iadd, number)
+    bench('a + 1 (tokens)', lambda: la + 1, lambda: ca + 1, number)
+    bench('a > 1', lambda: la > 1, lambda: ca > 1, number)
+    bench('float(a)', lambda: float(la), lambda: float(ca), number)
+    bench('str(a)', lambda: str(la), lambda: str(ca), number)
+    bench('a.to_decimals(6)', lambda: la.to_decimals(6), lambda: ca.to_decimals(6), number)
+
+    # Across all agents, like the step loop's totals and eligibility checks
+    legacy_agents = [LegacyBalance.from_tokens(i * 1.5, decimals) for i in range(max_accounts)]
+    current_agents = BalanceArray.from_balances([Balance.from_tokens(i * 1.5, decimals) for i in range(max_accounts)])
+    rounds = max(1, number // 100)
+    bench('total of {} agents'.format(max_accounts), lambda: sum(legacy_agents, LegacyBalance(0, decimals)), current_agents.total, rounds)
+    bench('{} agents > 1'.format(max_accounts), lambda: [x > 1 for x in legacy_agents], lambda: current_agents > 1, rounds)
+    bench('{} agents > other'.format(max_accounts), lambda: [x > lb for x in legacy_agents], lambda: current_agents > cb, rounds)
+
+    # Memory per object
+    print('instance size: legacy {} bytes (+ __dict__ {}), current {} bytes'.format(
+        sys.getsizeof(la), sys.getsizeof(la.__dict__), sys.getsizeof(ca)))
+
+if __name__ == "__main__":
+    main()
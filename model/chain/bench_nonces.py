@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+"""
+bench_nonces.py: benchmark the NonceTable against the old JSON nonce file
+
+The old scheme kept every agent's nonce in one JSON blob of base64 ABI-encoded
+uint256s behind a global 'locked' flag, and every transaction paid for a
+lock/get/unlock round of full parses. Run from model/chain, e.g.:
+
+    RUN_SHELL=1 ./run.sh
+    python bench_nonces.py 20000
+"""
+import base64
+import json
+import mmap
+import os
+import sys
+import tempfile
+import time
+from eth_abi import encode_single, decode_single
+
+from model import NonceTable, max_accounts
+
+def make_address(i):
+    return '0x' + ('%040x' % (i + 1))
+
+class LegacyNonceFile:
+    """
+    The lock_nonce/get_nonce/unlock_nonce dance from before the NonceTable,
+    minus the latest block lookup.
+    """
+
+    def __init__(self, path, addresses):
+        nonce_data = {'locked': '0'}
+        for address in addresses:
+            nonce_data[address] = {
+                "seen_block": base64.b64encode(encode_single('uint256', 0)).decode('ascii'),
+                "next_tx_count": base64.b64encode(encode_single('uint256', 0)).decode('ascii'),
+            }
+        with open(path, 'w+') as f:
+            f.write(json.dumps(nonce_data))
+        self.f = open(path, 'r+b')
+        self.mm = mmap.mmap(self.f.fileno(), 0)
+        self.next_tx_count = {address: 0 for address in addresses}
+
+    def __load(self):
+        self.mm.seek(0)
+        return json.loads(self.mm.read().decode('utf8'))
+
+    def __set_locked(self, flag):
+        nonce_data = self.__load()
+        nonce_data['locked'] = flag
+        self.mm[0:] = bytes(json.dumps(nonce_data), 'utf8')
+
+    def reserve(self, address, current_block):
+        nonce_data = self.__load()
+        while nonce_data['locked'] == '1':
+            nonce_data = self.__load()
+
+        seen_block = decode_single('uint256', base64.b64decode(nonce_data[address]["seen_block"]))
+        decode_single('uint256', base64.b64decode(nonce_data[address]["next_tx_count"]))
+        if seen_block == 0:
+            nonce = self.next_tx_count[address]
+        else:
+            nonce = self.next_tx_count[address] + 1
+        nonce_data[address]["seen_block"] = base64.b64encode(encode_single('uint256', current_block)).decode('ascii')
+        nonce_data[address]["next_tx_count"] = base64.b64encode(encode_single('uint256', nonce)).decode('ascii')
+        self.next_tx_count[address] = nonce
+
+        self.__set_locked('1')
+        self.__set_locked('0')
+        return nonce
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    addresses = [make_address(i) for i in range(max_accounts)]
+    tmp_dir = tempfile.mkdtemp()
+
+    legacy = LegacyNonceFile(os.path.join(tmp_dir, 'legacy-nonces'), addresses)
+    start = time.perf_counter()
+    for i in range(iterations):
+        legacy.reserve(addresses[i % len(addresses)], 1 + i // len(addresses))
+    legacy_time = time.perf_counter() - start
+
+    table = NonceTable(os.path.join(tmp_dir, 'nonces.bin'))
+    for address in addresses:
+        table.sync(address, 0)
+    start = time.perf_counter()
+    for i in range(iterations):
+        table.reserve(addresses[i % len(addresses)])
+    table_time = time.perf_counter() - start
+
+    print('agents: {}, nonces: {}'.format(len(addresses), iterations))
+    print('json file:   {:.3f} s ({:.1f} us/nonce)'.format(legacy_time, legacy_time / iterations * 1e6))
+    print('nonce table: {:.3f} s ({:.1f} us/nonce)'.format(table_time, table_time / iterations * 1e6))
+    print('speedup: {:.1f}x'.format(legacy_time / table_time))
+
+if __name__ == "__main__":
+    main()
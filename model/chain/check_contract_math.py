@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+
+"""
+check_contract_math.py: check the contract_math ports against the contracts
+
+Without arguments, runs every port against a line-by-line transliteration
+of the Solidity (SafeMath reverts and all) on randomized inputs, with the
+edge cases the contracts care about mixed in: prices on and outside the
+grid, times outside [t0, t1], malformed curves, zero balances, reserve
+ratios of 0 and 100%, feeds with gaps and unaligned samples, expired and
+out-of-range options. With --chain, also asks the deployed contracts: it
+loads the pricing parameters and feed samples from the model checkpoint
+and compares every local quote with queryBuy/querySell, the feed's vol,
+and calcCollateral for sample positions. Run from model/chain, e.g.:
+
+    python check_contract_math.py 500
+    python check_contract_math.py --chain POOL_ADDRESS [CHECKPOINT]
+"""
+import random
+import sys
+
+import contract_math
+from contract_math import PricingParameters, PricingBook, BUY, SELL
+
+M = 2**256
+FB = contract_math.FRACTION_BASE
+VB = contract_math.VOLUME_BASE
+
+class Revert(Exception):
+    pass
+
+def sub(a, b):
+    if b > a:
+        raise Revert("SafeMath: subtraction overflow")
+    return a - b
+
+def div(a, b):
+    if b == 0:
+        raise Revert("SafeMath: division by zero")
+    return a // b
+
+def sdiv(a, b):
+    if b == 0:
+        raise Revert("SignedSafeMath: division by zero")
+    q = abs(a) // abs(b)
+    return -q if (a < 0) != (b < 0) else q
+
+def sol_interpolate(udl_price, now, t0, t1, x, y, f):
+    # findUdlPrice
+    xp = udl_price % M
+    j = 0
+    while True:
+        if j >= len(x):
+            raise Revert("index out of bounds")
+        if not x[j] < xp:
+            break
+        j += 1
+    if not (j > 0 and j < len(x)):
+        raise Revert("invalid pricing parameters")
+
+    dt = sub(t1, t0)
+    if not (now >= t0 and now <= t1):
+        raise Revert("invalid pricing parameters")
+    t = now - t0
+
+    def calc_opt_price_at(offset):
+        k = offset + j
+        y_a = y[k]
+        y_b = y[k - 1]
+        return (sdiv((y_a - y_b) * (xp - x[j - 1]), x[j] - x[j - 1]) + y_b) % M
+
+    p0 = calc_opt_price_at(0)
+    p1 = calc_opt_price_at(len(x))
+    price = p0 * dt
+    price = sub(price, t * (p0 - p1)) if p0 > p1 else price + t * (p1 - p0)
+    return div(div(price * f, FB), dt)
+
+def sol_query(p, op, udl_price, now, spread, reserve_ratio, coll, iv, written, holding, free_balance, pool_balance, pool_collateral):
+    # addSymbol's require
+    if len(p.x) == 0 or len(p.y) != 2 * len(p.x):
+        raise Revert("invalid pricing surface or maturity")
+
+    f = FB + spread if op == BUY else sub(FB, spread)
+    price = sol_interpolate(udl_price, now, p.t0, p.t1, p.x, p.y, f)
+
+    r = sub(FB, reserve_ratio)
+    if op == BUY:
+        volume = M - 1 if coll <= price else div(free_balance * VB, sub(coll, div(price * r, FB)))
+        (stock, held) = (p.buy_stock, written)
+    else:
+        written_coll = written * coll
+        pool_coll = pool_collateral - written_coll if pool_collateral > written_coll else 0
+        volume = M - 1 if price <= iv else div(sub(pool_balance, div(pool_coll * FB, r)) * VB, sub(price, iv))
+        volume = max(volume, div(pool_balance * VB, price))
+        volume = min(volume, div(pool_balance * VB, price))
+        (stock, held) = (p.sell_stock, holding)
+
+    return (price, min(volume, stock - held if stock > held else 0))
+
+def sol_sqrt(x):
+    z = x // 2 + 1
+    y = x
+    while z < y:
+        y = z
+        z = (x // z + z) // 2
+    return y
+
+class SolChainlinkFeed:
+    """
+    ChainlinkFeed's sample store and getDailyVolatility, statement by statement.
+    """
+
+    def __init__(self, timestamps, prices):
+        self.samples = []
+        self.daily_prices = {}
+        for (ts, pc) in zip(timestamps, prices):
+            if ts % 86400 == 0:
+                self.daily_prices[ts] = (ts, pc)
+            self.samples.append((ts, pc))
+
+    def prefetch_daily_price(self, timestamp, answer):
+        price = sdiv(answer * 10**10, 1)
+        key = timestamp // 86400 * 86400
+        if not (key not in self.daily_prices or self.daily_prices[key][0] > timestamp):
+            raise Revert("price already set")
+        self.daily_prices[key] = (timestamp, price)
+        if len(self.samples) == 0 or self.samples[-1][0] < timestamp:
+            self.samples.append((timestamp, price))
+
+    def get_price_cached(self, position):
+        if position % 86400 == 0 and position in self.daily_prices:
+            return self.daily_prices[position][1]
+        n = len(self.samples)
+        if not n > 0:
+            raise Revert("no sample")
+        if not (self.samples[0][0] <= position and self.samples[n - 1][0] >= position):
+            raise Revert("invalid position (prefetch needed)")
+        (start, end) = (0, n - 1)
+        while True:
+            m = (start + end + 1) // 2
+            s = self.samples[m]
+            if s[0] == position or end == m:
+                if self.samples[start][0] == position:
+                    s = self.samples[start]
+                return s[1]
+            if s[0] > position:
+                end = m
+            else:
+                start = m
+
+    def get_daily_volatility(self, timespan, now):
+        period = div(timespan, 86400)
+        timespan = period * 86400
+        array = [0] * sub(period, 1)
+        today = now // 86400 * 86400
+        (prev, p_base) = (0, 10**9)
+        for i in range(period):
+            position = sub(today, timespan) + (i + 1) * 86400
+            price = self.get_price_cached(position)
+            if i > 0:
+                array[i - 1] = sdiv(price * p_base, prev)
+            prev = price
+
+        # MoreMath.std
+        avg = sdiv(sum(array), len(array))
+        x2 = 0
+        for a in array:
+            x2 += (a - avg) * (a - avg)
+        return div(sol_sqrt(div(x2, len(array))) * (prev % M), p_base)
+
+def check_sqrt(trials, seed=0):
+    rng = random.Random(seed)
+    values = list(range(1000)) + [rng.randint(0, 2**rng.randint(1, 250)) for i in range(trials * 10)]
+    mismatches = [x for x in values if contract_math.sqrt(x) != sol_sqrt(x)]
+    for x in mismatches[:10]:
+        print('MISMATCH sqrt', x, 'expected', sol_sqrt(x), 'got', contract_math.sqrt(x))
+    print('sqrt: {} values, {} mismatches'.format(len(values), len(mismatches)))
+    return len(mismatches)
+
+def check_volatility(trials, seed=0):
+    """
+    Run feeds the way the model does (30 unaligned samples, then one
+    prefetched daily price a day, now and then skipping or doubling up)
+    and ask for vols along the way.
+    """
+
+    rng = random.Random(seed)
+    (total, reverted, mismatches) = (0, 0, 0)
+    for trial in range(max(1, trials // 10)):
+        start = rng.randint(1500000000, 1600000000)
+        if rng.random() < 0.2:
+            start = start // 86400 * 86400
+        timestamps = [start - x * 86400 for x in range(30, 0, -1)]
+        prices = [rng.randint(1000000000000, 6000000000000) for x in timestamps]
+        sol_feed = SolChainlinkFeed(timestamps, prices)
+        replica = contract_math.ChainlinkFeedReplica(8)
+        replica.initialize(timestamps, prices)
+
+        daily = []
+        now = start
+        for day in range(60):
+            now += rng.choice([86400, 86400, 86400, 86400, 2 * 86400, 3600])
+            answer = rng.randint(1000000000000, 6000000000000) if rng.random() > 0.01 else 0
+            try:
+                sol_feed.prefetch_daily_price(now, answer)
+                sol_ok = True
+            except Revert:
+                sol_ok = False
+            try:
+                replica.prefetch_daily_price(now, answer)
+                replica_ok = True
+            except ValueError:
+                replica_ok = False
+            if sol_ok != replica_ok:
+                mismatches += 1
+                print('MISMATCH prefetchDailyPrice', now, answer)
+            if sol_ok:
+                daily.append(answer * 10**10)
+
+            for period in [2, 7, 30, rng.randint(0, 40)]:
+                total += 1
+                query_now = now + rng.choice([0, 0, 0, 60, -86400])
+                try:
+                    expected = sol_feed.get_daily_volatility(period * 86400 + rng.choice([0, 0, 5]), query_now)
+                except (Revert, IndexError, ZeroDivisionError):
+                    expected = None
+                    reverted += 1
+                try:
+                    got = replica.daily_volatility(period * 86400, query_now)
+                except ValueError:
+                    got = None
+                if got != expected:
+                    mismatches += 1
+                    print('MISMATCH getDailyVolatility', period, query_now, 'expected', expected, 'got', got)
+
+        # The vectorized pass over the prefetched prices, against RollingVolatility
+        for period in [2, 7, 30]:
+            window = contract_math.RollingVolatility(period)
+            expected = []
+            for price in daily:
+                window.append(price)
+                if window.is_full():
+                    try:
+                        expected.append(window.volatility())
+                    except ValueError:
+                        expected.append(None)
+            if 0 in daily:
+                continue
+            total += len(expected)
+            got = list(contract_math.daily_volatilities(daily, period))
+            if got != expected:
+                mismatches += 1
+                print('MISMATCH daily_volatilities', period, 'expected', expected, 'got', got)
+
+    print('getDailyVolatility: {} vols ({} reverting), {} mismatches'.format(total, reverted, mismatches))
+    return mismatches
+
+def sol_calc_collateral(option_type, strike, maturity, volume, udl_price, now, vol):
+    # createOptionInMemory
+    if strike > 2**120 - 1 or maturity > 2**32 - 1:
+        raise Revert("SafeCast: value doesn't fit")
+    # getFeedData
+    (lower_vol, upper_vol) = (div(vol * 3, 2), vol * 3)
+    if lower_vol > 2**120 - 1 or upper_vol > 2**120 - 1:
+        raise Revert("SafeCast: value doesn't fit")
+
+    # calcIntrinsicValue
+    if option_type == contract_math.CALL:
+        iv = max(0, udl_price - strike)
+    else:
+        iv = max(0, strike - udl_price)
+    # daysToMaturity
+    d = div(10**18 * sub(maturity, now), 86400) if maturity > now else 0
+
+    coll = sdiv(iv * volume + div(upper_vol * volume * sol_sqrt(d), 10**9), VB)
+    if option_type == contract_math.PUT:
+        coll = min(coll, div(strike * volume, VB))
+    return coll if coll > 0 else 0
+
+def check_collateral(trials, seed=0):
+    rng = random.Random(seed)
+    (total, reverted, mismatches) = (0, 0, 0)
+    for trial in range(trials):
+        n = rng.randint(1, 8)
+        option_type = [rng.randint(0, 1) for i in range(n)]
+        strike = [rng.randint(1000, 90000) * 10**18 if rng.random() > 0.02 else 2**121 for i in range(n)]
+        now = rng.randint(1500000000, 1600000000)
+        maturity = [now + rng.randint(-86400, 400 * 86400) if rng.random() > 0.02 else 2**33 for i in range(n)]
+        udl_price = rng.randint(1000, 90000) * 10**18
+        vol = rng.randint(0, 10**22) if rng.random() > 0.02 else 2**119
+        # One volume per agent, against every option
+        volumes = [[rng.choice([0, VB, rng.randint(0, 10**24)])] for a in range(rng.randint(1, 4))]
+
+        (coll, ok) = contract_math.calc_collateral(option_type, strike, maturity, volumes, udl_price, now, vol)
+        for (a, volume) in enumerate(volumes):
+            for i in range(n):
+                total += 1
+                try:
+                    expected = sol_calc_collateral(option_type[i], strike[i], maturity[i], volume[0], udl_price, now, vol)
+                except Revert:
+                    expected = None
+                    reverted += 1
+                got = coll[a, i] if ok[a, i] else None
+                if got != expected:
+                    mismatches += 1
+                    print('MISMATCH calcCollateral', option_type[i], strike[i], maturity[i], volume[0], udl_price, now, vol, 'expected', expected, 'got', got)
+
+        # The most that fits must fit, and one more wei mustn't
+        surplus = [rng.randint(0, 10**23) for i in range(n)]
+        most = contract_math.max_volume(option_type, strike, maturity, surplus, udl_price, now, vol, limit=10**30)
+        for i in range(n):
+            try:
+                fits = sol_calc_collateral(option_type[i], strike[i], maturity[i], most[i], udl_price, now, vol) <= surplus[i]
+                over = most[i] < 10**30 and sol_calc_collateral(option_type[i], strike[i], maturity[i], most[i] + 1, udl_price, now, vol) <= surplus[i]
+            except Revert:
+                (fits, over) = (most[i] == 0, False)
+            total += 1
+            if not fits or over:
+                mismatches += 1
+                print('MISMATCH max_volume', option_type[i], strike[i], maturity[i], surplus[i], 'got', most[i])
+
+    print('calcCollateral: {} values ({} reverting), {} mismatches'.format(total, reverted, mismatches))
+    return mismatches
+
+def random_parameters(rng, base):
+    m = rng.choice([0, 1, 2, 3]) if rng.random() < 0.1 else 10
+    x = sorted(rng.sample(range(base // 2, base * 2), m))
+    x = [v * 10**18 for v in x]
+    y_length = 2 * m if rng.random() > 0.05 else 2 * m + 1
+    y = [rng.randint(0, 5000) * 10**18 for i in range(y_length)]
+    t0 = rng.randint(1000, 2000)
+    t1 = t0 + rng.choice([0, 172800, 172800, 172800])
+    return PricingParameters('0x0', rng.randint(0, 1), base * 10**18, t1 + 100, t0, t1,
+                             rng.randint(0, 200) * VB, rng.randint(0, 200) * VB, x, y)
+
+def check_queries(trials, seed=0):
+    rng = random.Random(seed)
+    (total, reverted, mismatches) = (0, 0, 0)
+    for trial in range(trials):
+        base = rng.randint(20000, 30000)
+        params = [random_parameters(rng, base) for i in range(rng.randint(1, 8))]
+        book = PricingBook(params)
+        coll = [rng.choice([0, rng.randint(0, 10**22)]) for p in params]
+        iv = [rng.choice([0, rng.randint(0, 10**21)]) for p in params]
+        written = [rng.randint(0, 100) * VB for p in params]
+        holding = [rng.randint(0, 100) * VB for p in params]
+
+        # Mostly on the grid, sometimes a negative feed price
+        udl_price = rng.randint(base // 2, base * 2) * 10**18 if rng.random() > 0.05 else -rng.randint(1, 10**18)
+        now = rng.randint(900, 2000 + 173000)
+        spread = rng.choice([0, 5 * 10**7])
+        reserve_ratio = rng.choice([0, 2 * 10**8, FB])
+        free_balance = rng.randint(0, 10**24)
+        pool_balance = rng.choice([0, rng.randint(0, 10**24)])
+        pool_collateral = rng.randint(0, 10**24)
+
+        for op in [BUY, SELL]:
+            (price, volume, ok) = contract_math.query(book, op, udl_price, now, spread, reserve_ratio,
+                                                      coll, iv, written, holding, free_balance, pool_balance, pool_collateral)
+            for (i, p) in enumerate(params):
+                total += 1
+                try:
+                    expected = sol_query(p, op, udl_price, now, spread, reserve_ratio, coll[i], iv[i],
+                                         written[i], holding[i], free_balance, pool_balance, pool_collateral)
+                except Revert:
+                    expected = None
+                    reverted += 1
+                got = (price[i], volume[i]) if ok[i] else None
+                if got != expected:
+                    mismatches += 1
+                    print('MISMATCH', 'queryBuy' if op == BUY else 'querySell', p.to_tuple(), udl_price, now, 'expected', expected, 'got', got)
+
+    print('queryBuy/querySell: {} quotes ({} reverting), {} mismatches'.format(total, reverted, mismatches))
+    return mismatches
+
+def check_chain(pool_address, checkpoint_path):
+    """
+    Compare local quotes with the deployed pool's, for the symbols in the model checkpoint.
+    """
+
+    import model
+    model.init_chain()
+    model.rpc_connection = model.AsyncRPCConnection(model.provider.endpoint_uri, model.start_event_loop_thread('rpc'))
+    model.block_context = model.BlockContext(model.rpc_connection)
+    model.log_indexer = model.LogIndexer(model.block_context.number)
+
+    state = model.Model.read_checkpoint(checkpoint_path)
+    agent = model.Agent(None, None, None, None, None, starting_axax=0, starting_usdt=0, wallet_address=model.w3.eth.accounts[0], is_mint=False)
+    usdt = model.TokenProxy(model.w3.eth.contract(abi=model.USDTContract['abi'], address=model.USDT["addr"]))
+    feed = model.w3.eth.contract(abi=model.ChainlinkFeedContract['abi'], address=model.BTCUSDc['addr'])
+    exchange = model.OptionsExchange(model.w3.eth.contract(abi=model.OptionsExchangeContract['abi'], address=model.EXCHG["addr"]), usdt, feed)
+    pool_contract = model.w3.eth.contract(abi=model.LinearLiquidityPoolContract['abi'], address=pool_address)
+    pool = model.LinearLiquidityPool(pool_contract, usdt, exchange)
+    pool.pricing_parameters = {key: PricingParameters(*params) for (key, params) in state['pricing_parameters']}
+
+    quoter = model.PoolQuoter(pool, exchange, feed)
+    mismatches = quoter.check(agent)
+    print('chain: {} symbols with parameters, {} mismatches'.format(len(pool.pricing_parameters), mismatches))
+
+    replica = contract_math.ChainlinkFeedReplica(model.BTCUSDAgg['decimals'], model.BTCUSDc['offset'])
+    replica.restore(state['feed'])
+    timespan = model.VOLATILITY_PERIOD_DAYS * contract_math.DAY
+    try:
+        expected = feed.caller({'from' : agent.address, 'gas': 8000000}).getDailyVolatility(timespan)
+    except Exception as inst:
+        expected = None
+    try:
+        got = replica.daily_volatility(timespan, model.block_context.timestamp)
+    except ValueError:
+        got = None
+    if got != expected:
+        mismatches += 1
+        print('MISMATCH chain getDailyVolatility', 'expected', expected, 'got', got)
+
+    # Sample positions: every symbol the pool has parameters for, at a few volumes
+    positions = [(p.option_type, p.strike, p.maturity, volume) for p in pool.pricing_parameters.values()
+                 for volume in [1, VB, 37 * VB, 10**6 * VB] if p.maturity > model.block_context.timestamp]
+    quoter = model.CollateralQuoter(feed, lambda agent: replica.daily_volatility(timespan, model.block_context.timestamp))
+    if positions:
+        calls = [(exchange.contract, 'calcCollateral', [feed.address, volume, option_type, strike, maturity])
+                 for (option_type, strike, maturity, volume) in positions]
+        expected = model.batch_call(calls, agent)
+        got = quoter.calc_collateral(agent, *[[x[k] for x in positions] for k in range(4)])
+        for (position, e, g) in zip(positions, expected, got):
+            if e != g:
+                mismatches += 1
+                print('MISMATCH chain calcCollateral', position, 'expected', e, 'got', g)
+    print('chain: {} sample positions for calcCollateral'.format(len(positions)))
+    return mismatches
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--chain':
+        if len(sys.argv) not in (3, 4):
+            print('usage: {} [TRIALS] | --chain POOL_ADDRESS [CHECKPOINT]'.format(sys.argv[0]))
+            sys.exit(2)
+        mismatches = check_queries(20) + check_sqrt(20) + check_volatility(20) + check_collateral(20)
+        mismatches += check_chain(sys.argv[2], sys.argv[3] if len(sys.argv) == 4 else 'model-checkpoint.bin')
+    else:
+        trials = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+        mismatches = check_queries(trials) + check_sqrt(trials) + check_volatility(trials) + check_collateral(trials)
+    sys.exit(1 if mismatches else 0)
+
+if __name__ == "__main__":
+    main()
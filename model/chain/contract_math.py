@@ -0,0 +1,608 @@
+"""
+contract_math.py: the contracts' pricing math, ported to Python
+
+Replicas of view functions the simulator otherwise calls over RPC, with the
+same integer arithmetic as the Solidity: uint256 values are Python ints in
+object arrays, SafeMath underflows and divisions by zero are flagged
+instead of reverting, and signed division truncates toward zero. Every
+function works on a whole book of symbols at once.
+
+Kept free of web3 so the math can be checked on its own; model.py feeds
+it chain state and check_contract_math.py compares it with the contracts.
+
+Ported so far:
+
+    LinearInterpolator.interpolate / calcOptPriceAt
+    LiquidityPool.queryBuy / querySell and LinearLiquidityPool.calcVolume
+    ChainlinkFeed.getDailyVolatility / getPriceCached, with MoreMath.std / sqrt
+    CollateralManager.calcCollateral(opt, volume), as OptionsExchange.calcCollateral calls it
+"""
+import bisect
+import collections
+import math
+import numpy as np
+
+UINT256_MAX = 2**256 - 1
+UINT256_MOD = 2**256
+FRACTION_BASE = 10**9
+VOLUME_BASE = 10**18
+# ChainlinkFeed's pBase and exchange decimals
+PRICE_BASE = 10**9
+EXCHANGE_DECIMALS = 18
+DAY = 24 * 60 * 60
+# BaseCollateralManager's timeBase and sqrtTimeBase
+TIME_BASE = 10**18
+SQRT_TIME_BASE = 10**9
+UINT120_MAX = 2**120 - 1
+UINT32_MAX = 2**32 - 1
+# Pads x past its end; bigger than any uint120, so findUdlPrice always stops on it
+X_PAD = 2**120
+
+# IOptionsExchange.OptionType and LiquidityPool.Operation
+CALL = 0
+PUT = 1
+BUY = 0
+SELL = 1
+
+def as_uints(values, n=None):
+    """
+    Make an object array of Python ints, so nothing overflows. With n, a
+    single value is repeated n times.
+    """
+
+    values = np.asarray(values, dtype=object)
+    if n is not None:
+        values = np.broadcast_to(values, (n,))
+    return np.array([int(v) for v in values.ravel()] + [None], dtype=object)[:-1].reshape(values.shape)
+
+def trunc_div(a, b):
+    """
+    Signed division rounding toward zero, like Solidity's int division.
+    """
+
+    q = np.abs(a) // np.abs(b)
+    return np.where((a < 0) != (b < 0), -q, q)
+
+class PricingParameters:
+    """
+    What LiquidityPool keeps per symbol (its PricingParameters struct), as
+    passed to addSymbol. y holds the t0 curve followed by the t1 curve.
+    """
+
+    __slots__ = ('udl_feed', 'option_type', 'strike', 'maturity', 't0', 't1', 'buy_stock', 'sell_stock', 'x', 'y')
+
+    def __init__(self, udl_feed, option_type, strike, maturity, t0, t1, buy_stock, sell_stock, x, y):
+        self.udl_feed = udl_feed
+        self.option_type = option_type
+        self.strike = int(strike)
+        self.maturity = int(maturity)
+        self.t0 = int(t0)
+        self.t1 = int(t1)
+        self.buy_stock = int(buy_stock)
+        self.sell_stock = int(sell_stock)
+        self.x = [int(v) for v in x]
+        self.y = [int(v) for v in y]
+
+    def add_symbol_args(self):
+        """
+        The arguments of LiquidityPool.addSymbol, in its order.
+        """
+
+        return (self.udl_feed, self.strike, self.maturity, self.option_type, self.t0, self.t1,
+                self.x, self.y, self.buy_stock, self.sell_stock)
+
+    def to_tuple(self):
+        return (self.udl_feed, self.option_type, self.strike, self.maturity, self.t0, self.t1,
+                self.buy_stock, self.sell_stock, self.x, self.y)
+
+class PricingBook:
+    """
+    The PricingParameters of several symbols packed into padded arrays,
+    one row per symbol.
+    """
+
+    def __init__(self, parameters):
+        self.parameters = list(parameters)
+        n = len(self.parameters)
+        # At least one column of padding, so j can always point one past the end
+        m = max([len(p.x) for p in self.parameters] + [1]) + 1
+
+        self.lengths = np.array([len(p.x) for p in self.parameters], dtype=np.int64)
+        # A y that doesn't hold exactly two curves fails addSymbol's check, so it's never valid here
+        self.valid = np.array([len(p.x) > 0 and len(p.y) == 2 * len(p.x) for p in self.parameters], dtype=bool)
+        self.x = np.full((n, m), X_PAD, dtype=object)
+        self.y0 = np.zeros((n, m), dtype=object)
+        self.y1 = np.zeros((n, m), dtype=object)
+        for (i, p) in enumerate(self.parameters):
+            k = len(p.x)
+            self.x[i, :k] = p.x
+            if self.valid[i]:
+                self.y0[i, :k] = p.y[:k]
+                self.y1[i, :k] = p.y[k:]
+
+        self.t0 = as_uints([p.t0 for p in self.parameters])
+        self.t1 = as_uints([p.t1 for p in self.parameters])
+        self.strike = as_uints([p.strike for p in self.parameters])
+        self.maturity = as_uints([p.maturity for p in self.parameters])
+        self.buy_stock = as_uints([p.buy_stock for p in self.parameters])
+        self.sell_stock = as_uints([p.sell_stock for p in self.parameters])
+
+    def __len__(self):
+        return len(self.parameters)
+
+def find_udl_price(udl_price, x, lengths):
+    """
+    LinearInterpolator.findUdlPrice: the first j with x[j] >= udlPrice.
+
+    Returns (j, ok); ok is False where the contract requires fail (the
+    price is at or below x[0], or above every x).
+    """
+
+    xp = as_uints(udl_price) % UINT256_MOD
+    j = np.argmax(x >= xp[:, None], axis=1)
+    ok = (j > 0) & (j < lengths)
+    return (np.where(ok, j, 1), xp, ok)
+
+def calc_opt_price_at(x, curve, j, xp):
+    """
+    LinearInterpolator.calcOptPriceAt on one of the two curves.
+    """
+
+    rows = np.arange(len(j))
+    y_a = curve[rows, j]
+    y_b = curve[rows, j - 1]
+    x_a = x[rows, j]
+    x_b = x[rows, j - 1]
+    # Only rows findUdlPrice rejected can have x[j] == x[j - 1]
+    span = np.where(x_a != x_b, x_a - x_b, 1)
+    return (trunc_div((y_a - y_b) * (xp - x_b), span) + y_b) % UINT256_MOD
+
+def interpolate(book, udl_price, now, f):
+    """
+    LinearInterpolator.interpolate for every symbol in the book.
+
+    udl_price may be one price or one per symbol; f is the spread factor
+    (fractionBase plus or minus the spread). Returns (price, ok).
+    """
+
+    udl_price = as_uints(udl_price, len(book))
+    (j, xp, ok) = find_udl_price(udl_price, book.x, book.lengths)
+    ok = ok & book.valid
+
+    now = int(now)
+    ok = ok & (book.t0 <= now) & (now <= book.t1) & (book.t1 > book.t0)
+    dt = np.where(ok, book.t1 - book.t0, 1)
+    t = np.where(ok, now - book.t0, 0)
+
+    p0 = calc_opt_price_at(book.x, book.y0, j, xp)
+    p1 = calc_opt_price_at(book.x, book.y1, j, xp)
+
+    price = p0 * dt
+    price = np.where(p0 > p1, price - t * (p0 - p1), price + t * (p1 - p0))
+    # SafeMath.sub reverts rather than going negative
+    ok = ok & (price >= 0)
+    price = np.where(ok, price * int(f) // FRACTION_BASE // dt, 0)
+    return (price, ok)
+
+def available_stock(stock, held):
+    return np.where(stock > held, stock - held, 0)
+
+def calc_volume_buy(price, coll, free_balance, reserve_ratio):
+    """
+    LinearLiquidityPool.calcVolume for Operation.BUY. Returns (volume, ok).
+    """
+
+    r = FRACTION_BASE - int(reserve_ratio)
+    denominator = coll - price * r // FRACTION_BASE
+    ok = (coll <= price) | (denominator > 0)
+    volume = np.where(
+        coll <= price,
+        UINT256_MAX,
+        int(free_balance) * VOLUME_BASE // np.where(denominator > 0, denominator, 1)
+    )
+    return (np.where(ok, volume, 0), ok)
+
+def calc_volume_sell(price, coll, iv, written, pool_balance, pool_collateral, reserve_ratio):
+    """
+    LinearLiquidityPool.calcVolume for Operation.SELL. Returns (volume, ok).
+
+    Clamping between max() and min() of the same bound leaves the volume
+    at bal * volumeBase / price, but the requires along the way still apply.
+    """
+
+    r = FRACTION_BASE - int(reserve_ratio)
+    bal = int(pool_balance)
+
+    written_coll = written * coll
+    pool_coll = np.where(int(pool_collateral) > written_coll, int(pool_collateral) - written_coll, 0)
+
+    ok = price > 0
+    if r == 0:
+        # Only the branch that divides by r fails
+        ok = ok & (price <= iv)
+        free = np.zeros(len(price), dtype=object)
+    else:
+        free = bal - pool_coll * FRACTION_BASE // r
+        ok = ok & ((price <= iv) | (free >= 0))
+
+    volume = np.where(price <= iv, UINT256_MAX, np.where(ok, free, 0) * VOLUME_BASE // np.where(price > iv, price - iv, 1))
+    bound = bal * VOLUME_BASE // np.where(price > 0, price, 1)
+    volume = np.minimum(np.maximum(volume, bound), bound)
+    return (np.where(ok, volume, 0), ok)
+
+def query(book, op, udl_price, now, spread, reserve_ratio, coll, iv, written, holding,
+          free_balance, pool_balance, pool_collateral):
+    """
+    LiquidityPool.queryBuy (op=BUY) or querySell (op=SELL) for every symbol
+    in the book.
+
+    Per symbol: coll is exchange.calcCollateral for one volumeBase, iv the
+    intrinsic value, written and holding the pool's written volume and
+    balance of the option token. The rest is pool wide. Returns (price,
+    volume, ok); where ok is False the contract call would revert.
+    """
+
+    coll = as_uints(coll)
+    iv = as_uints(iv) % UINT256_MOD
+    written = as_uints(written)
+    holding = as_uints(holding)
+
+    if op == BUY:
+        f = FRACTION_BASE + int(spread)
+    else:
+        f = FRACTION_BASE - int(spread)
+    (price, ok) = interpolate(book, udl_price, now, f)
+
+    if op == BUY:
+        (volume, volume_ok) = calc_volume_buy(price, coll, free_balance, reserve_ratio)
+        stock = available_stock(book.buy_stock, written)
+    else:
+        (volume, volume_ok) = calc_volume_sell(price, coll, iv, written, pool_balance, pool_collateral, reserve_ratio)
+        stock = available_stock(book.sell_stock, holding)
+
+    ok = ok & volume_ok
+    volume = np.where(ok, np.minimum(volume, stock), 0)
+    return (price, volume, ok)
+
+def sdiv(a, b):
+    """
+    SignedSafeMath.div on two ints.
+    """
+
+    if b == 0:
+        raise ValueError("SignedSafeMath: division by zero")
+    q = abs(a) // abs(b)
+    return -q if (a < 0) != (b < 0) else q
+
+def sqrt(x):
+    """
+    MoreMath.sqrt. Its Babylonian loop lands on the floor of the root,
+    except for 2, where it starts on the answer 2 and stops.
+    """
+
+    return 2 if x == 2 else math.isqrt(x)
+
+def std(array):
+    """
+    MoreMath.std: the population standard deviation of ints, around their
+    truncated mean.
+    """
+
+    if len(array) == 0:
+        raise ValueError("SignedSafeMath: division by zero")
+    avg = sdiv(sum(array), len(array))
+    return sqrt(sum((a - avg) * (a - avg) for a in array) // len(array))
+
+def normalized_vol(vol, price, multiplier=3.0, decimals=EXCHANGE_DECIMALS):
+    """
+    Turn the feed's daily volatility (with decimals) into the normalized
+    vol log((p + m std) / (p - m std)) the pricing curves take. price is a
+    float.
+    """
+
+    tvol = vol / (10.**decimals)
+    return math.log((price + (tvol * multiplier)) / (price - (tvol * multiplier)))
+
+class RollingVolatility:
+    """
+    ChainlinkFeed.getDailyVolatility's math over the last period daily
+    prices, updated in O(1) per price.
+
+    The feed takes the std of the ratios between consecutive prices (times
+    pBase, truncated) around their truncated mean. Keeping the sum of the
+    ratios and of their squares is enough for that, exactly:
+    sum((r - avg)^2) = sum(r^2) - 2 avg sum(r) + n avg^2.
+    """
+
+    def __init__(self, period):
+        self.period = period
+        self.prices = collections.deque(maxlen=period)
+        self.ratios = collections.deque()
+        self.sum = 0
+        self.sum_squares = 0
+        # Ratios after a zero price; the contract reverts while any is in the window
+        self.undefined = 0
+
+    def append(self, price):
+        price = int(price)
+        if self.prices:
+            prev = self.prices[-1]
+            ratio = sdiv(price * PRICE_BASE, prev) if prev != 0 else None
+            self.ratios.append(ratio)
+            if ratio is None:
+                self.undefined += 1
+            else:
+                self.sum += ratio
+                self.sum_squares += ratio * ratio
+            if len(self.ratios) > self.period - 1:
+                ratio = self.ratios.popleft()
+                if ratio is None:
+                    self.undefined -= 1
+                else:
+                    self.sum -= ratio
+                    self.sum_squares -= ratio * ratio
+        self.prices.append(price)
+
+    def is_full(self):
+        return len(self.prices) == self.period
+
+    def volatility(self):
+        """
+        Get what getDailyVolatility would for this window.
+
+        Raises ValueError where the contract would revert.
+        """
+
+        n = self.period - 1
+        if not self.is_full() or n < 1:
+            raise ValueError("not enough daily prices for the period")
+        if self.undefined:
+            raise ValueError("SignedSafeMath: division by zero")
+        avg = sdiv(self.sum, n)
+        x2 = self.sum_squares - 2 * avg * self.sum + n * avg * avg
+        return sqrt(x2 // n) * (self.prices[-1] % UINT256_MOD) // PRICE_BASE
+
+def daily_volatilities(prices, period):
+    """
+    getDailyVolatility for every window of period consecutive daily
+    prices, in one pass. Entry i is the volatility over prices[i:i + period],
+    i.e. as of the day of prices[i + period - 1].
+
+    Prices must be nonzero.
+    """
+
+    prices = as_uints(prices)
+    n = period - 1
+    if n < 1 or len(prices) < period:
+        return np.zeros(0, dtype=object)
+    if (prices == 0).any():
+        raise ValueError("SignedSafeMath: division by zero")
+
+    ratios = trunc_div(prices[1:] * PRICE_BASE, prices[:-1])
+    sums = np.concatenate([as_uints([0]), np.cumsum(ratios)])
+    sums_squares = np.concatenate([as_uints([0]), np.cumsum(ratios * ratios)])
+    s1 = sums[n:] - sums[:-n]
+    s2 = sums_squares[n:] - sums_squares[:-n]
+
+    avg = trunc_div(s1, np.full(len(s1), n, dtype=object))
+    x2 = s2 - 2 * avg * s1 + n * avg * avg
+    return np.frompyfunc(sqrt, 1, 1)(x2 // n) * (prices[n:] % UINT256_MOD) // PRICE_BASE
+
+class ChainlinkFeedReplica:
+    """
+    A ChainlinkFeed's samples and daily prices, kept in step with the calls
+    made to it, so its volatility can be had without asking the chain.
+
+    Vol windows are kept per period and moved along one day at a time with
+    RollingVolatility; a jump of more than a day, or a daily price landing
+    inside a window, rebuilds that window.
+    """
+
+    def __init__(self, aggregator_decimals=8, offset=0):
+        self.offset = offset
+        diff = EXCHANGE_DECIMALS - aggregator_decimals
+        (self.price_n, self.price_d) = (10**diff, 1) if diff > 0 else (1, 10**-diff)
+        self.timestamps = []
+        self.prices = []
+        # Day timestamp to (timestamp, price)
+        self.daily_prices = {}
+        # (timespan, day) to vol, as stored by prefetchDailyVolatility
+        self.daily_volatilities = {}
+        # period to (day, RollingVolatility)
+        self.__windows = {}
+
+    def is_initialized(self):
+        return len(self.timestamps) > 0
+
+    def initialize(self, timestamps, prices):
+        """
+        ChainlinkFeed.initialize. These prices are stored as given, not rescaled.
+        """
+
+        if self.is_initialized():
+            raise ValueError("already initialized")
+        last_timestamp = 0
+        for (ts, price) in zip(timestamps, prices):
+            (ts, price) = (int(ts), int(price))
+            if not ts > last_timestamp:
+                raise ValueError("ascending order required")
+            last_timestamp = ts
+            if ts % DAY == 0:
+                self.daily_prices[ts] = (ts, price)
+            self.timestamps.append(ts)
+            self.prices.append(price)
+
+    def rescale_price(self, answer):
+        return sdiv(int(answer) * self.price_n, self.price_d)
+
+    def prefetch_daily_price(self, timestamp, answer):
+        """
+        ChainlinkFeed.prefetchDailyPrice, for the aggregator round that
+        answered answer at timestamp.
+        """
+
+        (timestamp, price) = (int(timestamp), self.rescale_price(answer))
+        key = timestamp // DAY * DAY
+        if key in self.daily_prices and not self.daily_prices[key][0] > timestamp:
+            raise ValueError("price already set")
+        self.daily_prices[key] = (timestamp, price)
+        if not self.timestamps or self.timestamps[-1] < timestamp:
+            self.timestamps.append(timestamp)
+            self.prices.append(price)
+
+        # Windows reaching that day now see a different price there
+        for (period, (day, window)) in list(self.__windows.items()):
+            if day >= key and day - period * DAY < key:
+                del self.__windows[period]
+
+    def get_price_cached(self, position):
+        """
+        ChainlinkFeed.getPriceCached: the daily price if the position is a
+        day we have one for, else the first sample at or after it.
+        """
+
+        if position % DAY == 0 and position in self.daily_prices:
+            return self.daily_prices[position][1]
+        if not self.timestamps:
+            raise ValueError("no sample")
+        if not (self.timestamps[0] <= position and self.timestamps[-1] >= position):
+            raise ValueError("invalid position (prefetch needed) : {}".format(position))
+        return self.prices[bisect.bisect_left(self.timestamps, position)]
+
+    def today(self, now):
+        return (int(now) - self.offset) // DAY * DAY
+
+    def daily_volatility(self, timespan, now):
+        """
+        ChainlinkFeed.getDailyVolatility as of now (the feed's time provider).
+
+        Raises ValueError where the contract would revert.
+        """
+
+        period = int(timespan) // DAY
+        if period < 1:
+            raise ValueError("SafeMath: subtraction overflow")
+        timespan = period * DAY
+        today = self.today(now)
+        if (timespan, today) in self.daily_volatilities:
+            return self.daily_volatilities[(timespan, today)]
+
+        (day, window) = self.__windows.get(period, (None, None))
+        if day == today - DAY:
+            price = self.get_price_cached(today)
+            window.append(price)
+        elif day != today:
+            window = RollingVolatility(period)
+            for i in range(period):
+                window.append(self.get_price_cached(today - timespan + (i + 1) * DAY))
+        self.__windows[period] = (today, window)
+        return window.volatility()
+
+    def prefetch_daily_volatility(self, timespan, now):
+        """
+        ChainlinkFeed.prefetchDailyVolatility: fix today's vol for the timespan.
+        """
+
+        if int(timespan) % DAY != 0:
+            raise ValueError("invalid timespan")
+        key = (int(timespan), self.today(now))
+        if key not in self.daily_volatilities:
+            self.daily_volatilities[key] = self.daily_volatility(timespan, now)
+
+    def state(self):
+        return {
+            'timestamps': list(self.timestamps),
+            'prices': list(self.prices),
+            'daily_prices': dict(self.daily_prices),
+            'daily_volatilities': dict(self.daily_volatilities),
+        }
+
+    def restore(self, state):
+        self.timestamps = list(state['timestamps'])
+        self.prices = list(state['prices'])
+        self.daily_prices = dict(state['daily_prices'])
+        self.daily_volatilities = dict(state['daily_volatilities'])
+        self.__windows = {}
+
+def upper_volatility(vol):
+    """
+    ChainlinkFeed.calcUpperVolatility.
+    """
+
+    return vol * 3
+
+def lower_volatility(vol):
+    """
+    ChainlinkFeed.calcLowerVolatility.
+    """
+
+    return vol * 3 // 2
+
+def intrinsic_value(option_type, strike, udl_price):
+    """
+    BaseCollateralManager.calcIntrinsicValue, given the underlying price the
+    option is valued at (the latest, or the one at maturity once expired).
+    """
+
+    value = np.where(np.atleast_1d(as_uints(option_type)) == CALL, as_uints(udl_price) - as_uints(strike), as_uints(strike) - as_uints(udl_price))
+    return np.where(value > 0, value, 0)
+
+def days_to_maturity(maturity, now):
+    """
+    BaseCollateralManager.daysToMaturity: days left, with timeBase decimals.
+    now is the feed's latest timestamp, not the exchange's clock.
+    """
+
+    maturity = np.atleast_1d(as_uints(maturity))
+    return np.where(maturity > int(now), TIME_BASE * (maturity - int(now)) // DAY, 0)
+
+def calc_collateral(option_type, strike, maturity, volume, udl_price, now, vol):
+    """
+    CollateralManager.calcCollateral(opt, volume) for many options and
+    volumes at once.
+
+    option_type, strike, maturity and volume broadcast against each other,
+    so e.g. a row of candidate options against a column of volumes (one per
+    agent) gives the whole table. udl_price is the price the options are
+    valued at and broadcasts the same way; now is the feed's latest
+    timestamp and vol its getDailyVolatility over the protocol's
+    volatility period. Returns (collateral, ok); where ok is False the
+    contract call would revert.
+    """
+
+    (option_type, strike, maturity, volume) = np.broadcast_arrays(
+        *[np.atleast_1d(as_uints(x)) for x in (option_type, strike, maturity, volume)]
+    )
+
+    upper_vol = upper_volatility(int(vol))
+    # createOptionInMemory's and getFeedData's SafeCasts
+    ok = (strike <= UINT120_MAX) & (maturity <= UINT32_MAX) & (upper_vol <= UINT120_MAX) & (lower_volatility(int(vol)) <= UINT120_MAX)
+
+    iv = intrinsic_value(option_type, strike, udl_price)
+    d = days_to_maturity(maturity, now)
+    sqrt_d = np.frompyfunc(sqrt, 1, 1)(d)
+    coll = trunc_div(iv * volume + upper_vol * volume * sqrt_d // SQRT_TIME_BASE, np.full(volume.shape, VOLUME_BASE, dtype=object))
+    coll = np.where(option_type == PUT, np.minimum(coll, strike * volume // VOLUME_BASE), coll)
+    coll = np.where(coll > 0, coll, 0)
+    return (np.where(ok, coll, 0), ok)
+
+def max_volume(option_type, strike, maturity, surplus, udl_price, now, vol, limit=UINT120_MAX):
+    """
+    The largest volume (up to limit) of each option whose calcCollateral
+    fits in surplus, found by bisection. Collateral never goes down as
+    volume goes up, so the search is exact. Arguments broadcast like
+    calc_collateral's, with surplus in place of volume.
+    """
+
+    (option_type, strike, maturity, surplus) = np.broadcast_arrays(
+        *[np.atleast_1d(as_uints(x)) for x in (option_type, strike, maturity, surplus)]
+    )
+    low = np.full(surplus.shape, 0, dtype=object)
+    high = np.full(surplus.shape, int(limit), dtype=object)
+    while (low < high).any():
+        mid = (low + high + 1) // 2
+        (coll, ok) = calc_collateral(option_type, strike, maturity, mid, udl_price, now, vol)
+        fits = ok & (coll <= surplus)
+        low = np.where(fits, mid, low)
+        high = np.where(fits, high, mid - 1)
+    return low
@@ -1,6 +1,8 @@
 import os
 import json
 
+from option_symbol import OptionSymbol
+
 base_sim_path = './sim_output/'
 out_put_files = [x for x in os.listdir(base_sim_path) if '.txt' in x]
 
@@ -43,11 +45,11 @@ for sim_raw_file in out_put_files[-2:]:
 							sim_symbols_sold_map[sim_raw_file]['symbols'][temp_sym] += temp_vol * temp_price
 
 
-						if '-EP-' in temp_sym:
+						if OptionSymbol.parse(temp_sym).is_put:
 							sim_symbols_sold_map[sim_raw_file]['puts'] += temp_vol
 							sim_symbols_sold_map[sim_raw_file]['puts_value'] += temp_vol * temp_price
 
-						if '-EC-' in temp_sym:
+						if OptionSymbol.parse(temp_sym).is_call:
 							sim_symbols_sold_map[sim_raw_file]['calls'] += temp_vol
 							sim_symbols_sold_map[sim_raw_file]['calls_value'] += temp_vol * temp_price
 			i+=1
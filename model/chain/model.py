@@ -13,14 +13,46 @@ import logging
 import time
 import sys
 import os
-import base64
 import mmap
-from eth_abi import encode_single, decode_single
+import fcntl
+import struct
+import pickle
+import zlib
+import threading
+import asyncio
+import itertools
+import concurrent.futures
+import websockets
+import numpy as np
+import requests
+from hexbytes import HexBytes
+from eth_account import Account
 from web3 import Web3
+from web3.datastructures import AttributeDict
+from web3.exceptions import TimeExhausted
+from web3.providers.base import JSONBaseProvider
+from web3.middleware import geth_poa_middleware
+from web3._utils.method_formatters import receipt_formatter
+from web3._utils.abi import get_abi_output_types, map_abi_data
+from web3._utils.normalizers import BASE_RETURN_NORMALIZERS
 import datetime
+from option_symbol import OptionSymbol
+from snapshot_cache import ChainSnapshotCache, SNAPSHOT_CACHE_DIR, REDEPLOY_EXIT_CODE
+from ohlc_data import OHLCData, OHLC_DATA_DIR
+from pricing import NumpyPricingBackend, OpModelBackend, CachedPricingBackend, PRICING_CACHE_DIR
+import contract_math
+from contract_math import PricingParameters, PricingBook, ChainlinkFeedReplica
 
 IS_DEBUG = False
 is_try_model_mine = False
+is_pipelined_tx = True
+is_local_signing = False
+is_signing_in_processes = False
+is_resuming = False
+# Price symbols with the numpy engine in process, instead of shelling out to ./op_model
+is_in_process_pricing = True
+# Keep priced curves in memory and under PRICING_CACHE_DIR, shared between runs
+is_pricing_cache = True
 max_accounts = 40
 block_offset = 19 + max_accounts
 tx_pool_latency = 0.25
@@ -28,25 +60,117 @@ tx_pool_latency = 0.25
 DEADLINE_FROM_NOW = 60 * 60 * 24 * 7 * 52
 UINT256_MAX = 2**256 - 1
 ZERO_ADDRESS = '0x0000000000000000000000000000000000000000'
-MMAP_FILE = '/tmp/avax-cchain-nonces'
-
-deploy_data = None
-with open("deploy_output.txt", 'r+') as f:
-    deploy_data = f.read()
+MMAP_FILE = '/tmp/avax-cchain-nonces.bin'
+NONCE_TABLE_SLOTS = 1024
+CHAIN_ID = 43112
+GAS_PRICE = Web3.toWei(225, 'gwei')
+BATCH_CALL_SIZE = 500
+AGENT_KEYS_FILE = './agent-keys.json'
+SIGNING_WORKERS = 4
+GAS_PROFILE_FILE = './gas-profile.json'
+APPROVALS_FILE = './approvals.log'
+CHECKPOINT_FILE = './model-checkpoint.bin'
+CHECKPOINT_STEPS = 24
+GAS_MARGIN = 1.25
+MAX_TX_RETRIES = 5
+TX_RETRY_BACKOFF = 0.1
+LOG_RANGE_BLOCKS = 2048
+TRANSFER_TOPIC = Web3.keccak(text='Transfer(address,address,uint256)').hex()
+WRITE_OPTIONS_TOPIC = Web3.keccak(text='WriteOptions(address,address,address,uint256)').hex()
+CREATE_SYMBOL_TOPIC = Web3.keccak(text='CreateSymbol(address,address)').hex()
+LIQUIDATE_EARLY_TOPIC = Web3.keccak(text='LiquidateEarly(address,address,address,uint256)').hex()
+LIQUIDATE_EXPIRED_TOPIC = Web3.keccak(text='LiquidateExpired(address,address,address,uint256)').hex()
+LEDGER_CHECK_BLOCKS = 50
+WS_URI = 'ws://127.0.0.1:9545/ext/bc/C/ws'
+RPC_URI = 'http://127.0.0.1:9545/ext/bc/C/rpc'
+WS_POOL_SIZE = 4
+HTTP_POOL_SIZE = 4
+# web3's websocket provider reads replies in order, so keep one request per socket
+WS_MAX_IN_FLIGHT = 1
+HTTP_MAX_IN_FLIGHT = 8
+AVAX_URI = 'http://127.0.0.1:9545/ext/bc/C/avax'
+DEPLOY_OUTPUT_FILE = 'deploy_output.txt'
+BUILD_DIR = './build/contracts'
+ABI_CACHE_DIR = './build/abi-cache'
+POOL_SPREAD = 5 * (10**7) # 5%
+POOL_RESERVE_RATIO = 0 * (10**7) # 20% default
+POOL_MATURITY_DAYS = 1000000000
+VOLATILITY_PERIOD_DAYS = 30
+# Where in the BTC-USD history the model starts, and how many days before it seed the feed
+OHLC_START_DATE = "2017-06-17"#"2017-12-17"
+OHLC_LOOKBACK_DAYS = 30
 
 logger = logging.getLogger(__name__)
-#provider = Web3.HTTPProvider('http://127.0.0.1:7545/ext/bc/C/rpc', request_kwargs={"timeout": 60*300})
-provider = Web3.WebsocketProvider('ws://127.0.0.1:9545/ext/bc/C/ws', websocket_timeout=60*300)
 
-providerAvax = Web3.HTTPProvider('http://127.0.0.1:9545/ext/bc/C/avax', request_kwargs={"timeout": 60*300})
-w3 = Web3(provider)
-from web3.middleware import geth_poa_middleware
-w3.middleware_onion.inject(geth_poa_middleware, layer=0)
+class ProviderPool(JSONBaseProvider):
+    """
+    A web3 provider spreading requests over several websocket connections
+    and a keep-alive HTTP session, so worker threads don't queue behind one
+    socket.
+
+    Transactions go round-robin over the websockets, reads round-robin over
+    the HTTP lanes, and time/mining controls always take the first websocket
+    so they stay in order. Each lane carries at most its in-flight count of
+    requests; a request waits for a free lane only when all of them are busy.
+    """
 
-w3.eth.defaultAccount = w3.eth.accounts[0]
-logger.info(w3.eth.blockNumber)
-logger.info(w3.clientVersion)
-#sys.exit()
+    ORDERED_METHODS = {'debug_increaseTime', 'evm_snapshot', 'evm_revert', 'evm_mine'}
+
+    def __init__(self, ws_uri, http_uri, ws_size=WS_POOL_SIZE, http_size=HTTP_POOL_SIZE,
+                 ws_in_flight=WS_MAX_IN_FLIGHT, http_in_flight=HTTP_MAX_IN_FLIGHT, timeout=60*300):
+        super().__init__()
+        self.endpoint_uri = ws_uri
+        self.ws_lanes = [
+            (Web3.WebsocketProvider(ws_uri, websocket_timeout=timeout), threading.BoundedSemaphore(ws_in_flight))
+            for i in range(ws_size)
+        ]
+
+        # All the HTTP lanes share one session with enough pooled connections for all of them
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(1, http_size * http_in_flight))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        self.http_lanes = [
+            (Web3.HTTPProvider(http_uri, request_kwargs={"timeout": timeout}, session=session), threading.BoundedSemaphore(http_in_flight))
+            for i in range(http_size)
+        ]
+
+        self.__lock = threading.Lock()
+        self.__counter = itertools.count()
+
+    def lanes_for(self, method):
+        if method in self.ORDERED_METHODS:
+            return self.ws_lanes[:1]
+        if method.startswith('eth_send') or not self.http_lanes:
+            return self.ws_lanes
+        return self.http_lanes
+
+    def __acquire(self, lanes):
+        with self.__lock:
+            start = next(self.__counter)
+        for i in range(len(lanes)):
+            lane = lanes[(start + i) % len(lanes)]
+            if lane[1].acquire(blocking=False):
+                return lane
+        lane = lanes[start % len(lanes)]
+        lane[1].acquire()
+        return lane
+
+    def make_request(self, method, params):
+        (lane_provider, slots) = self.__acquire(self.lanes_for(method))
+        try:
+            return lane_provider.make_request(method, params)
+        finally:
+            slots.release()
+
+    def isConnected(self):
+        return all(lane_provider.isConnected() for (lane_provider, slots) in self.ws_lanes + self.http_lanes)
+
+#provider = Web3.HTTPProvider('http://127.0.0.1:7545/ext/bc/C/rpc', request_kwargs={"timeout": 60*300})
+# These are set up by init_chain(), so importing this module doesn't need a node
+provider = None
+providerAvax = None
+w3 = None
 
 TPRO = {
     "addr": '',
@@ -110,14 +234,11 @@ BTCUSDc = {
     "addr": '',
     "decimals": 18,
     "symbol": 'BTCUSDc',
+    # The feed's constructor _offset (private on chain), as the migrations deploy it
+    "offset": 3 * 60 * 60,
     "deploy_slug": "BTCUSDMockFeed is at: "
 }
 
-for contract in [BTCUSDc, BTCUSDAgg, LLPF, STG, CREDPRO, EXCHG, TPRO]:
-    logger.info(contract["deploy_slug"])
-    contract["addr"] = deploy_data.split(contract["deploy_slug"])[1].split('\n')[0]
-    logger.info('\t'+contract["addr"])
-
 
 # token (from Deploy Root on testnet)
 xSD = {
@@ -126,132 +247,1173 @@ xSD = {
   "symbol": 'xSD',
 }
 
-AggregatorV3MockContract = json.loads(open('./build/contracts/AggregatorV3Mock.json', 'r+').read())
-ChainlinkFeedContract = json.loads(open('./build/contracts/ChainlinkFeed.json', 'r+').read())
-CreditProviderContract = json.loads(open('./build/contracts/CreditProvider.json', 'r+').read())
-OptionsExchangeContract = json.loads(open('./build/contracts/OptionsExchange.json', 'r+').read())
-ProposalManagerContract = json.loads(open('./build/contracts/ProposalsManager.json', 'r+').read())
+class ABIRegistry:
+    """
+    Contract ABIs from the Truffle build artifacts, loaded on first use.
 
-ProposalManagerHelperContract = json.loads(open('./build/contracts/PoolManagementProposal.json', 'r+').read())
-ProposalWrapperContract = json.loads(open('./build/contracts/ProposalWrapper.json', 'r+').read())
- 
-USDTContract = json.loads(open('./build/contracts/TestnetUSDT.json', 'r+').read())
-OptionTokenContract = json.loads(open('./build/contracts/OptionToken.json', 'r+').read())
-ProtocolSettingsContract = json.loads(open('./build/contracts/ProtocolSettings.json', 'r+').read())
-LinearLiquidityPoolContract = json.loads(open('./build/contracts/LinearLiquidityPool.json', 'r+').read())
-LinearLiquidityPoolFactoryContract = json.loads(open('./build/contracts/LinearLiquidityPoolFactory.json', 'r+').read())
-ERC20StableCoinContract = json.loads(open('./build/contracts/ERC20.json', 'r+').read())
-TimeProviderMockContract = json.loads(open('./build/contracts/TimeProviderMock.json', 'r+').read())
+    The artifacts carry bytecode, sources and source maps we never look at,
+    so the first time an artifact is needed its ABI is pulled out into a
+    small file under the cache directory, named for the artifact's mtime.
+    Later runs read just that until the contract is rebuilt.
+    """
+
+    def __init__(self, build_dir=BUILD_DIR, cache_dir=ABI_CACHE_DIR):
+        self.build_dir = build_dir
+        self.cache_dir = cache_dir
+        # This maps from artifact name to its ABI
+        self.abis = {}
+        self.__lock = threading.Lock()
+
+    def artifact_file(self, name):
+        return os.path.join(self.build_dir, name + '.json')
+
+    def artifact(self, name):
+        """
+        Load the whole artifact, for anything besides the ABI.
+        """
+
+        with open(self.artifact_file(name), 'r') as f:
+            return json.loads(f.read())
+
+    def abi(self, name):
+        abi = self.abis.get(name)
+        if abi is not None:
+            return abi
+
+        with self.__lock:
+            if name in self.abis:
+                return self.abis[name]
+            mtime = os.stat(self.artifact_file(name)).st_mtime_ns
+            cache_file = os.path.join(self.cache_dir, '{}-{}.json'.format(name, mtime))
+            if os.path.exists(cache_file):
+                with open(cache_file, 'r') as f:
+                    abi = json.loads(f.read())
+            else:
+                abi = self.artifact(name)['abi']
+                os.makedirs(self.cache_dir, exist_ok=True)
+                for stale_file in [x for x in os.listdir(self.cache_dir) if x.rsplit('-', 1)[0] == name]:
+                    os.remove(os.path.join(self.cache_dir, stale_file))
+                tmp_file = cache_file + '.tmp'
+                with open(tmp_file, 'w') as f:
+                    f.write(json.dumps(abi, separators=(',', ':')))
+                os.replace(tmp_file, cache_file)
+            self.abis[name] = abi
+        return abi
+
+class ContractArtifact:
+    """
+    Stands in for a loaded Truffle artifact: artifact['abi'] comes from the
+    ABIRegistry, and any other key loads the full artifact once.
+    """
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+        self.__full = None
+
+    def __getitem__(self, key):
+        if key == 'abi':
+            return self.registry.abi(self.name)
+        if self.__full is None:
+            self.__full = self.registry.artifact(self.name)
+        return self.__full[key]
+
+abi_registry = ABIRegistry()
+AggregatorV3MockContract = ContractArtifact(abi_registry, 'AggregatorV3Mock')
+ChainlinkFeedContract = ContractArtifact(abi_registry, 'ChainlinkFeed')
+CreditProviderContract = ContractArtifact(abi_registry, 'CreditProvider')
+OptionsExchangeContract = ContractArtifact(abi_registry, 'OptionsExchange')
+ProposalManagerContract = ContractArtifact(abi_registry, 'ProposalsManager')
+ProposalManagerHelperContract = ContractArtifact(abi_registry, 'PoolManagementProposal')
+ProposalWrapperContract = ContractArtifact(abi_registry, 'ProposalWrapper')
+USDTContract = ContractArtifact(abi_registry, 'TestnetUSDT')
+OptionTokenContract = ContractArtifact(abi_registry, 'OptionToken')
+ProtocolSettingsContract = ContractArtifact(abi_registry, 'ProtocolSettings')
+LinearLiquidityPoolContract = ContractArtifact(abi_registry, 'LinearLiquidityPool')
+LinearLiquidityPoolFactoryContract = ContractArtifact(abi_registry, 'LinearLiquidityPoolFactory')
+ERC20StableCoinContract = ContractArtifact(abi_registry, 'ERC20')
+TimeProviderMockContract = ContractArtifact(abi_registry, 'TimeProviderMock')
+
+def init_chain(deploy_output=DEPLOY_OUTPUT_FILE):
+    """
+    Connect to the node and read the deployed contract addresses.
 
+    Importing this module doesn't touch the node or the deploy output;
+    anything that talks to the chain needs to call this first.
+    """
+    global provider
+    global providerAvax
+    global w3
+
+    provider = ProviderPool(WS_URI, RPC_URI)
+    providerAvax = Web3.HTTPProvider(AVAX_URI, request_kwargs={"timeout": 60*300})
+    w3 = Web3(provider)
+    w3.middleware_onion.inject(geth_poa_middleware, layer=0)
+    w3.eth.defaultAccount = w3.eth.accounts[0]
+    logger.info(w3.eth.blockNumber)
+    logger.info(w3.clientVersion)
+
+    with open(deploy_output, 'r+') as f:
+        deploy_data = f.read()
+
+    for contract in [BTCUSDc, BTCUSDAgg, LLPF, STG, CREDPRO, EXCHG, TPRO]:
+        logger.info(contract["deploy_slug"])
+        contract["addr"] = deploy_data.split(contract["deploy_slug"])[1].split('\n')[0]
+        logger.info('\t'+contract["addr"])
 
 def get_addr_from_contract(contract):
     return contract["networks"][str(sorted(map(int,contract["networks"].keys()))[0])]["address"]
 
-avax_cchain_nonces = None
-mm = None
-
-def lock_nonce(agent):
-    global mm
-    # DECODE START
-    if not mm:
-        mm = mmap.mmap(avax_cchain_nonces.fileno(), 0)
-
-    mm.seek(0)
-    raw_data_cov = mm.read().decode('utf8')
-    nonce_data = json.loads(raw_data_cov)
-
-    nonce_data['locked'] = '1'
-    out_data = bytes(json.dumps(nonce_data), 'utf8')
-    mm[0:] = out_data
-
-def get_nonce(agent):
-    global mm
-    # DECODE START
-    if not mm:
-        mm = mmap.mmap(avax_cchain_nonces.fileno(), 0)
-
-    mm.seek(0)
-    raw_data_cov = mm.read().decode('utf8')
-    nonce_data = json.loads(raw_data_cov)
-    current_block = int(w3.eth.get_block('latest')["number"])
-
-    while nonce_data['locked'] == '1':
-        mm.seek(0)
-        raw_data_cov = mm.read().decode('utf8')
-        nonce_data = json.loads(raw_data_cov)
-        mm.seek(0)
-        continue
-
-    # locked == '1', unlocked == '0'
-    
-    nonce_data[agent.address]["seen_block"] = decode_single('uint256', base64.b64decode(nonce_data[agent.address]["seen_block"]))
-    nonce_data[agent.address]["next_tx_count"] = decode_single('uint256', base64.b64decode(nonce_data[agent.address]["next_tx_count"]))
-    # DECODE END
-
-    if current_block != nonce_data[agent.address]["seen_block"]:
-        if (nonce_data[agent.address]["seen_block"] == 0):
-            nonce_data[agent.address]["seen_block"] = current_block
-            nonce_data[agent.address]["next_tx_count"] = agent.next_tx_count
+class NonceTable:
+    """
+    A fixed-layout, memory-mapped nonce table shared by every simulator process.
+
+    The file is a 32 byte header followed by one 32 byte slot per address:
+    the raw 20 byte address, a uint32 of flags and the next uint64 nonce to
+    hand out. Each slot is updated under its own fcntl byte-range lock, so
+    agents never wait on each other and no JSON is ever parsed.
+    """
+
+    MAGIC = b'AVXNONCE'
+    VERSION = 1
+    HEADER = struct.Struct('<8sII16x')
+    SLOT = struct.Struct('<20sIQ')
+    FLAG_SET = 1
+
+    def __init__(self, path, slots=NONCE_TABLE_SLOTS):
+        self.path = path
+        self.__fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        self.__thread_lock = threading.Lock()
+        # This maps from string address to slot index, so lookups after the first are O(1)
+        self.__slots = {}
+
+        size = self.HEADER.size + self.SLOT.size * slots
+        fcntl.lockf(self.__fd, fcntl.LOCK_EX, self.HEADER.size, 0, os.SEEK_SET)
+        try:
+            header = os.pread(self.__fd, self.HEADER.size, 0)
+            if len(header) == self.HEADER.size and self.HEADER.unpack(header)[0] == self.MAGIC:
+                (_, version, slots) = self.HEADER.unpack(header)
+                if version != self.VERSION:
+                    raise ValueError("Unsupported nonce table version {} in {}".format(version, path))
+                size = self.HEADER.size + self.SLOT.size * slots
+            else:
+                # Fresh file (or the old JSON format): lay out an empty table
+                os.ftruncate(self.__fd, 0)
+                os.ftruncate(self.__fd, size)
+                os.pwrite(self.__fd, self.HEADER.pack(self.MAGIC, self.VERSION, slots), 0)
+        finally:
+            fcntl.lockf(self.__fd, fcntl.LOCK_UN, self.HEADER.size, 0, os.SEEK_SET)
+
+        self.num_slots = slots
+        self.__mm = mmap.mmap(self.__fd, size)
+
+    def __offset(self, index):
+        return self.HEADER.size + index * self.SLOT.size
+
+    def __lock(self, start, length):
+        fcntl.lockf(self.__fd, fcntl.LOCK_EX, length, start, os.SEEK_SET)
+
+    def __unlock(self, start, length):
+        fcntl.lockf(self.__fd, fcntl.LOCK_UN, length, start, os.SEEK_SET)
+
+    def slot(self, address):
+        """
+        Get the slot index for the given address, claiming a free one if needed.
+        """
+
+        address = getattr(address, 'address', address)
+        index = self.__slots.get(address)
+        if index is not None:
+            return index
+
+        raw = bytes.fromhex(address[2:] if address.startswith('0x') else address)
+        empty = bytes(20)
+
+        # Claiming scans the whole table, so hold the header lock while doing it
+        self.__lock(0, self.HEADER.size)
+        try:
+            free = None
+            for i in range(self.num_slots):
+                slot_address = self.__mm[self.__offset(i):self.__offset(i) + 20]
+                if slot_address == raw:
+                    index = i
+                    break
+                if free is None and slot_address == empty:
+                    free = i
+            else:
+                if free is None:
+                    raise RuntimeError("Nonce table {} is full ({} slots)".format(self.path, self.num_slots))
+                index = free
+                self.SLOT.pack_into(self.__mm, self.__offset(index), raw, 0, 0)
+        finally:
+            self.__unlock(0, self.HEADER.size)
+
+        self.__slots[address] = index
+        return index
+
+    def reserve(self, address, initial=0):
+        """
+        Atomically hand out the next nonce for the given address.
+
+        If nobody has used the slot yet, start counting from initial.
+        """
+
+        offset = self.__offset(self.slot(address))
+        with self.__thread_lock:
+            self.__lock(offset, self.SLOT.size)
+            try:
+                (raw, flags, nonce) = self.SLOT.unpack_from(self.__mm, offset)
+                if not flags & self.FLAG_SET:
+                    nonce = initial
+                self.SLOT.pack_into(self.__mm, offset, raw, flags | self.FLAG_SET, nonce + 1)
+            finally:
+                self.__unlock(offset, self.SLOT.size)
+        return nonce
+
+    def peek(self, address):
+        """
+        Get the next nonce that would be handed out, or None if the slot is unset.
+        """
+
+        (_, flags, nonce) = self.SLOT.unpack_from(self.__mm, self.__offset(self.slot(address)))
+        return nonce if flags & self.FLAG_SET else None
+
+    def sync(self, address, tx_count):
+        """
+        Make sure the slot won't hand out anything below the given
+        transaction count, as reported by the chain.
+        """
+
+        offset = self.__offset(self.slot(address))
+        with self.__thread_lock:
+            self.__lock(offset, self.SLOT.size)
+            try:
+                (raw, flags, nonce) = self.SLOT.unpack_from(self.__mm, offset)
+                if not flags & self.FLAG_SET or nonce < tx_count:
+                    self.SLOT.pack_into(self.__mm, offset, raw, flags | self.FLAG_SET, tx_count)
+            finally:
+                self.__unlock(offset, self.SLOT.size)
+
+    def rewind(self, address, tx_count):
+        """
+        Make sure the slot hands out the given transaction count next if it
+        had gotten ahead of it, so a nonce that was never used gets reused.
+        """
+
+        offset = self.__offset(self.slot(address))
+        with self.__thread_lock:
+            self.__lock(offset, self.SLOT.size)
+            try:
+                (raw, flags, nonce) = self.SLOT.unpack_from(self.__mm, offset)
+                if not flags & self.FLAG_SET or nonce > tx_count:
+                    self.SLOT.pack_into(self.__mm, offset, raw, flags | self.FLAG_SET, tx_count)
+            finally:
+                self.__unlock(offset, self.SLOT.size)
+
+    def set(self, address, tx_count):
+        """
+        Make the slot hand out exactly the given transaction count next,
+        whichever way it was off. For when the chain's count is the truth.
+        """
+
+        offset = self.__offset(self.slot(address))
+        with self.__thread_lock:
+            self.__lock(offset, self.SLOT.size)
+            try:
+                (raw, flags, nonce) = self.SLOT.unpack_from(self.__mm, offset)
+                self.SLOT.pack_into(self.__mm, offset, raw, flags | self.FLAG_SET, tx_count)
+            finally:
+                self.__unlock(offset, self.SLOT.size)
+
+    def release(self, address, nonce, tx_count):
+        """
+        Hand back a nonce whose transaction failed, given the chain's pending
+        transaction count.
+
+        Only if it was the newest one handed out does the slot go back to
+        tx_count; otherwise sends after it may still be on their way to the
+        node and not in its count yet, so going back would hand their nonces
+        out again. Either way the slot ends up at least at tx_count.
+        """
+
+        offset = self.__offset(self.slot(address))
+        with self.__thread_lock:
+            self.__lock(offset, self.SLOT.size)
+            try:
+                (raw, flags, current) = self.SLOT.unpack_from(self.__mm, offset)
+                if not flags & self.FLAG_SET or current == nonce + 1 or current < tx_count:
+                    self.SLOT.pack_into(self.__mm, offset, raw, flags | self.FLAG_SET, tx_count)
+            finally:
+                self.__unlock(offset, self.SLOT.size)
+
+    def close(self):
+        self.__mm.close()
+        os.close(self.__fd)
+
+nonce_table = None
+
+class RPCError(Exception):
+    """
+    An error object the node returned for one JSON-RPC request.
+    """
+
+    def __init__(self, error):
+        super().__init__(error.get('message', error) if isinstance(error, dict) else error)
+        self.error = error
+
+class TransactionError(Exception):
+    """
+    A transaction that couldn't be sent. Subclasses say why, and whether
+    sending it again can help.
+    """
+
+    retryable = False
+
+    def __init__(self, inst):
+        super().__init__(str(inst))
+        self.cause = inst
+
+class NonceError(TransactionError):
+    retryable = True
+
+class UnderpricedError(TransactionError):
+    retryable = True
+
+class RevertError(TransactionError):
+    pass
+
+class OutOfGasError(TransactionError):
+    pass
+
+class TransportError(TransactionError):
+    retryable = True
+
+def classify_error(inst):
+    """
+    Wrap an exception from sending a transaction in the matching TransactionError.
+    """
+
+    if isinstance(inst, TransactionError):
+        return inst
+    err_str = str(inst).lower()
+    if 'nonce too low' in err_str or 'nonce too high' in err_str or 'invalid nonce' in err_str:
+        return NonceError(inst)
+    if 'underpriced' in err_str:
+        return UnderpricedError(inst)
+    if 'out of gas' in err_str or 'intrinsic gas too low' in err_str or 'gas required exceeds' in err_str or 'exceeds block gas limit' in err_str:
+        return OutOfGasError(inst)
+    if 'revert' in err_str:
+        return RevertError(inst)
+    if isinstance(inst, (OSError, asyncio.TimeoutError, concurrent.futures.TimeoutError, websockets.exceptions.WebSocketException)):
+        return TransportError(inst)
+    return TransactionError(inst)
+
+def start_event_loop_thread(name):
+    """
+    Run a fresh asyncio event loop forever in a daemon thread, and return it.
+    """
+
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, name=name, daemon=True)
+    thread.start()
+    return loop
+
+class AsyncRPCConnection:
+    """
+    A JSON-RPC client on its own websocket. Responses are matched to requests
+    by id, so any number of requests can be in flight on the one socket.
+    """
+
+    def __init__(self, endpoint_uri, loop):
+        self.endpoint_uri = endpoint_uri
+        self.loop = loop
+        self.__ws = None
+        self.__connecting = None
+        # This maps from request id to the asyncio future waiting on it
+        self.__pending = {}
+        # This maps from subscription id to the callback for its notifications
+        self.subscriptions = {}
+        self.__ids = itertools.count(1)
+
+    async def __connection(self):
+        if self.__ws is None:
+            if self.__connecting is None:
+                self.__connecting = self.loop.create_task(self.__connect())
+            await self.__connecting
+        return self.__ws
+
+    async def __connect(self):
+        self.__ws = await websockets.connect(self.endpoint_uri, max_size=None, ping_interval=None)
+        self.loop.create_task(self.__read(self.__ws))
+
+    async def __read(self, ws):
+        try:
+            async for message in ws:
+                data = json.loads(message)
+                for response in (data if isinstance(data, list) else [data]):
+                    self.dispatch(response)
+        except Exception as inst:
+            logger.info({"endpoint": self.endpoint_uri, "error": inst, "action": "rpc_read"})
+        finally:
+            # Fail everything still waiting so callers don't hang, and reconnect on next use
+            self.__ws = None
+            self.__connecting = None
+            self.subscriptions = {}
+            pending, self.__pending = self.__pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("websocket to {} closed".format(self.endpoint_uri)))
+
+    def dispatch(self, response):
+        """
+        Resolve the future waiting on a single JSON-RPC response, or hand a
+        subscription notification to its callback.
+        """
+
+        if response.get('method') == 'eth_subscription':
+            callback = self.subscriptions.get(response['params']['subscription'])
+            if callback is not None:
+                callback(response['params']['result'])
+            return
+
+        future = self.__pending.pop(response.get('id'), None)
+        if future is None or future.done():
+            return
+        if 'error' in response:
+            future.set_exception(RPCError(response['error']))
         else:
-            nonce_data[agent.address]["seen_block"] = current_block
-            nonce_data[agent.address]["next_tx_count"] = agent.next_tx_count
-            nonce_data[agent.address]["next_tx_count"] += 1
-            agent.next_tx_count = nonce_data[agent.address]["next_tx_count"]
-    else:
-        nonce_data[agent.address]["next_tx_count"] = agent.next_tx_count
-        nonce_data[agent.address]["next_tx_count"] += 1
-        agent.next_tx_count = nonce_data[agent.address]["next_tx_count"]
+            future.set_result(response.get('result'))
 
-    # ENCODE START
-    nonce_data[agent.address]["seen_block"] = base64.b64encode(encode_single('uint256', nonce_data[agent.address]["seen_block"])).decode('ascii')
-    nonce_data[agent.address]["next_tx_count"] = base64.b64encode(encode_single('uint256', nonce_data[agent.address]["next_tx_count"])).decode('ascii')
-    
-    # ENCODE END
-    return agent.next_tx_count
+    def __encode(self, method, params):
+        request_id = next(self.__ids)
+        future = self.loop.create_future()
+        self.__pending[request_id] = future
+        return {'jsonrpc': '2.0', 'id': request_id, 'method': method, 'params': params}, future
+
+    async def request(self, method, params):
+        ws = await self.__connection()
+        (payload, future) = self.__encode(method, params)
+        await ws.send(json.dumps(payload))
+        return await future
+
+    async def batch(self, calls):
+        """
+        Send a list of (method, params) as one JSON-RPC batch. Returns the
+        results in order, with an RPCError in place of any failed call.
+        """
+
+        if len(calls) == 0:
+            return []
+        ws = await self.__connection()
+        (payloads, futures) = zip(*[self.__encode(method, params) for (method, params) in calls])
+        await ws.send(json.dumps(list(payloads)))
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    async def subscribe(self, kind, callback):
+        """
+        Start an eth_subscribe subscription calling callback(result) on the
+        event loop for every notification. Returns the subscription id.
+        """
+
+        subscription_id = await self.request('eth_subscribe', [kind])
+        self.subscriptions[subscription_id] = callback
+        return subscription_id
+
+    def call(self, method, params, timeout=None):
+        """
+        Make a request from outside the event loop thread and block on it.
+        """
+
+        return asyncio.run_coroutine_threadsafe(self.request(method, params), self.loop).result(timeout)
+
+    def call_batch(self, calls, timeout=None):
+        """
+        Make a batch request from outside the event loop thread and block on it.
+        """
+
+        return asyncio.run_coroutine_threadsafe(self.batch(calls), self.loop).result(timeout)
+
+def encode_rpc_transaction(tx):
+    """
+    Turn a transaction dict from buildTransaction into JSON-RPC form.
+    """
+
+    return {k: (hex(v) if isinstance(v, int) else v) for k, v in tx.items()}
+
+class PendingTransaction:
+    """
+    A transaction handed to the TransactionPipeline. Holds futures that
+    resolve to its hash once the node accepts it, and to its receipt once mined.
+    """
+
+    def __init__(self, agent, prepped_function_call, gas):
+        self.agent = agent
+        self.prepped_function_call = prepped_function_call
+        self.gas = gas
+        self.nonce = None
+        self.hash_future = concurrent.futures.Future()
+        self.receipt_future = concurrent.futures.Future()
+
+    @property
+    def hash(self):
+        return self.hash_future.result()
+
+    def receipt(self, timeout=None):
+        return self.receipt_future.result(timeout)
+
+    def resolve_receipt(self, future):
+        """
+        Done callback for the ReceiptCollector's future on our hash.
+        """
+
+        if future.cancelled():
+            self.fail(concurrent.futures.CancelledError())
+        elif future.exception() is not None:
+            self.fail(future.exception())
+        elif not self.receipt_future.done():
+            self.receipt_future.set_result(future.result())
+
+    def fail(self, inst):
+        for future in [self.hash_future, self.receipt_future]:
+            if not future.done():
+                future.set_exception(inst)
+
+    def __repr__(self):
+        if self.hash_future.done() and self.hash_future.exception() is None:
+            # Log just like a bare hash would
+            return repr(self.hash_future.result())
+        return 'PendingTransaction({}, {})'.format(getattr(self.agent, 'address', self.agent), self.nonce)
+
+def sign_transaction(tx, key):
+    # Module level so it can be shipped to a process pool
+    return bytes(Account.sign_transaction(tx, key).rawTransaction)
+
+def load_agent_keys(path):
+    """
+    Read a JSON object of agent address to private key.
+    """
 
-def unlock_nonce(agent):
-    global mm
-    # DECODE START
-    if not mm:
-        mm = mmap.mmap(avax_cchain_nonces.fileno(), 0)
+    with open(path, 'r') as f:
+        keys = json.loads(f.read())
+    return {Web3.toChecksumAddress(address): key for address, key in keys.items()}
 
-    mm.seek(0)
-    raw_data_cov = mm.read().decode('utf8')
-    nonce_data = json.loads(raw_data_cov)
+class LocalSigner:
+    """
+    Holds agent keys in-process and signs transactions on a thread or
+    process pool, so signing overlaps with network I/O instead of leaving
+    it to the node's unlocked accounts.
+    """
+
+    def __init__(self, keys, workers=SIGNING_WORKERS, use_processes=False):
+        self.keys = keys
+        if use_processes:
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='signer')
+
+    def has_key(self, address):
+        return address in self.keys
+
+    def sign(self, tx):
+        return sign_transaction(tx, self.keys[tx['from']])
+
+    async def sign_async(self, loop, tx):
+        return await loop.run_in_executor(self.executor, sign_transaction, tx, self.keys[tx['from']])
+
+class TransactionPipeline:
+    """
+    Submits transactions without waiting on the node. Nonces are assigned
+    locally from the NonceTable as calls are handed in, and up to
+    max_in_flight sends are kept going at once on an AsyncRPCConnection.
+    Receipts come from the ReceiptCollector.
+
+    With a LocalSigner, transactions from agents it has keys for are built
+    and signed in-process, and go out as batches of eth_sendRawTransaction.
+    """
+
+    def __init__(self, connection, collector, max_in_flight=64, max_retries=MAX_TX_RETRIES, signer=None):
+        self.connection = connection
+        self.collector = collector
+        self.loop = connection.loop
+        self.max_retries = max_retries
+        self.signer = signer
+        self.__in_flight = threading.BoundedSemaphore(max_in_flight)
+        # Signed transactions waiting for the next raw batch
+        self.__outbox = []
+        self.chain_id = CHAIN_ID
+        self.gas_price = GAS_PRICE
+        if signer is not None:
+            # Ask once, so a wrong chain id shows up before anything is signed
+            self.chain_id = int(connection.call('eth_chainId', [], 60), 16)
+
+    def submit(self, agent, prepped_function_call, gas):
+        """
+        Queue a prepared function call to be sent from the agent. Returns a PendingTransaction.
+        """
+
+        pending = PendingTransaction(agent, prepped_function_call, gas)
+        pending.nonce = nonce_table.reserve(agent.address, agent.next_tx_count)
+        agent.next_tx_count = pending.nonce
+        # Block the submitter, not the loop, when too much is in flight
+        self.__in_flight.acquire()
+        asyncio.run_coroutine_threadsafe(self.__send(pending), self.loop)
+        return pending
+
+    def submit_many(self, calls):
+        """
+        Queue a list of (agent, prepped_function_call, gas) at once.
+        """
+
+        return [self.submit(agent, prepped_function_call, gas) for (agent, prepped_function_call, gas) in calls]
+
+    def __build(self, pending):
+        return encode_rpc_transaction(pending.prepped_function_call.buildTransaction({
+            'chainId': self.chain_id,
+            'nonce': pending.nonce,
+            'from' : getattr(pending.agent, 'address', pending.agent),
+            'gas': pending.gas,
+            'gasPrice': self.gas_price,
+        }))
+
+    def __build_raw(self, pending):
+        # Everything is known locally, so skip buildTransaction's defaults
+        fn = pending.prepped_function_call
+        return {
+            'from': getattr(pending.agent, 'address', pending.agent),
+            'to': fn.address,
+            'data': fn._encode_transaction_data(),
+            'value': 0,
+            'chainId': self.chain_id,
+            'nonce': pending.nonce,
+            'gas': pending.gas,
+            'gasPrice': self.gas_price,
+        }
+
+    async def __flush(self):
+        outbox, self.__outbox = self.__outbox, []
+        for i in range(0, len(outbox), BATCH_CALL_SIZE):
+            chunk = outbox[i:i + BATCH_CALL_SIZE]
+            try:
+                results = await self.connection.batch([('eth_sendRawTransaction', [raw]) for (raw, future) in chunk])
+            except Exception as inst:
+                results = [inst] * len(chunk)
+            for ((raw, future), result) in zip(chunk, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    async def __send_raw(self, pending):
+        tx = self.__build_raw(pending)
+        raw = await self.signer.sign_async(self.loop, tx)
+        future = self.loop.create_future()
+        self.__outbox.append(('0x' + raw.hex(), future))
+        if len(self.__outbox) == 1:
+            # Whatever else gets signed by the next loop pass goes in the same batch
+            self.loop.call_soon(asyncio.ensure_future, self.__flush())
+        return await future
+
+    async def __send_once(self, pending):
+        if self.signer is not None and self.signer.has_key(getattr(pending.agent, 'address', pending.agent)):
+            return await self.__send_raw(pending)
+        return await self.connection.request('eth_sendTransaction', [self.__build(pending)])
+
+    async def __resync(self, pending):
+        address = getattr(pending.agent, 'address', pending.agent)
+        tx_count = int(await self.connection.request('eth_getTransactionCount', [address, 'pending']), 16)
+        nonce_table.release(address, pending.nonce, tx_count)
+        return tx_count
+
+    async def __send(self, pending):
+        tx_hash = None
+        address = getattr(pending.agent, 'address', pending.agent)
+        delay = TX_RETRY_BACKOFF
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    tx_hash = await self.__send_once(pending)
+                    break
+                except Exception as inst:
+                    err = classify_error(inst)
+                    if not err.retryable or attempt == self.max_retries:
+                        raise err
+                    await asyncio.sleep(delay)
+                    delay *= 2
+                    if isinstance(err, (NonceError, UnderpricedError)):
+                        # take the next nonce the node will accept
+                        tx_count = await self.__resync(pending)
+                        pending.nonce = nonce_table.reserve(address, tx_count)
+                        pending.agent.next_tx_count = pending.nonce
+        except Exception as inst:
+            err = classify_error(inst)
+            logger.info({"agent": address, "error": err, "type": type(err).__name__, "action": "submit", "nonce": pending.nonce})
+            try:
+                # Don't leave a gap behind the nonce that was never used
+                await self.__resync(pending)
+            except Exception as resync_inst:
+                logger.info({"agent": address, "error": resync_inst, "action": "resync"})
+            pending.fail(err)
+            return
+        finally:
+            self.__in_flight.release()
 
-    nonce_data['locked'] = '0'
-    out_data = bytes(json.dumps(nonce_data), 'utf8')
-    mm[:] = out_data
+        pending.hash_future.set_result(HexBytes(tx_hash))
+        self.collector.watch(tx_hash).add_done_callback(pending.resolve_receipt)
+
+tx_pipeline = None
+
+def normalize_hash(tx_hash):
+    return '0x' + bytes(HexBytes(tx_hash)).hex()
+
+class ReceiptCollector:
+    """
+    Waits on whole sets of transactions at once instead of polling each hash.
+
+    Watched hashes are checked in one batch as soon as they come in. After
+    that, each new head (from a newHeads subscription, or a slow poll if that
+    isn't available) pulls the new blocks, matches their transactions
+    against everything being watched, and batch-fetches only the receipts
+    that are ready.
+    """
+
+    def __init__(self, connection, poll_interval=1.0):
+        self.connection = connection
+        self.loop = connection.loop
+        self.poll_interval = poll_interval
+        self.head = None
+        # This maps from normalized hash to the futures waiting on its receipt
+        self.__watched = {}
+        # Hashes that haven't had their first receipt check yet
+        self.__unchecked = set()
+        self.__subscription = None
+        self.__wake = None
+        self.__scanner = None
+
+    def __on_head(self, head):
+        self.head = int(head['number'], 16)
+        self.__wake.set()
+
+    async def __ensure_subscribed(self):
+        if self.__subscription in self.connection.subscriptions:
+            return
+        try:
+            self.__subscription = await self.connection.subscribe('newHeads', self.__on_head)
+        except RPCError as inst:
+            logger.info({"error": inst, "action": "subscribe newHeads"})
+            self.__subscription = None
+
+    async def __fetch(self, tx_hashes):
+        tx_hashes = list(tx_hashes)
+        results = await self.connection.batch([('eth_getTransactionReceipt', [tx_hash]) for tx_hash in tx_hashes])
+        for (tx_hash, receipt) in zip(tx_hashes, results):
+            if receipt and not isinstance(receipt, Exception):
+                receipt = AttributeDict.recursive(receipt_formatter(receipt))
+                for future in self.__watched.pop(tx_hash, []):
+                    if not future.done():
+                        future.set_result(receipt)
+
+    async def __scan(self):
+        try:
+            await self.__ensure_subscribed()
+            scanned = int(await self.connection.request('eth_blockNumber', []), 16)
+            while self.__watched:
+                # Anything mined at or before the scanned block shows up here
+                if self.__unchecked:
+                    unchecked, self.__unchecked = self.__unchecked, set()
+                    await self.__fetch(unchecked & set(self.__watched))
+
+                # Forget hashes nobody is waiting on anymore
+                for tx_hash in [k for k, v in self.__watched.items() if all(f.done() for f in v)]:
+                    del self.__watched[tx_hash]
+                if not self.__watched:
+                    break
+
+                self.__wake.clear()
+                try:
+                    await asyncio.wait_for(self.__wake.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    await self.__ensure_subscribed()
+
+                # Anything mined after it shows up in the new blocks
+                head = int(await self.connection.request('eth_blockNumber', []), 16)
+                if head <= scanned:
+                    continue
+                blocks = await self.connection.batch([('eth_getBlockByNumber', [hex(n), False]) for n in range(scanned + 1, head + 1)])
+                mined = set()
+                for block in blocks:
+                    if block and not isinstance(block, Exception):
+                        mined.update(normalize_hash(tx_hash) for tx_hash in block['transactions'])
+                mined &= set(self.__watched)
+                if mined:
+                    await self.__fetch(mined)
+                scanned = head
+        except Exception as inst:
+            logger.info({"error": inst, "action": "collect receipts"})
+            watched, self.__watched = self.__watched, {}
+            for futures in watched.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(inst)
+        finally:
+            self.__scanner = None
+
+    def watch(self, tx_hash):
+        """
+        Get an asyncio future for the receipt of the given hash. Must be
+        called on the event loop.
+        """
+
+        if self.__wake is None:
+            self.__wake = asyncio.Event()
+        tx_hash = normalize_hash(tx_hash)
+        future = self.loop.create_future()
+        self.__watched.setdefault(tx_hash, []).append(future)
+        self.__unchecked.add(tx_hash)
+        if self.__scanner is None:
+            self.__scanner = self.loop.create_task(self.__scan())
+        self.__wake.set()
+        return future
+
+    async def collect_async(self, tx_hashes, timeout=600):
+        futures = {normalize_hash(tx_hash): self.watch(tx_hash) for tx_hash in tx_hashes}
+        if len(futures) > 0:
+            await asyncio.wait(futures.values(), timeout=timeout)
+
+        receipts = {}
+        for (tx_hash, future) in futures.items():
+            if future.done() and future.exception() is None:
+                receipts[tx_hash] = future.result()
+            else:
+                future.cancel()
+        return receipts
+
+    def collect(self, tx_hashes, timeout=600):
+        """
+        Wait for all the given hashes to be mined. Returns a dict from
+        normalized hash to receipt, missing anything not mined in time.
+        """
+
+        return asyncio.run_coroutine_threadsafe(self.collect_async(list(tx_hashes), timeout), self.loop).result()
+
+    def summarize(self, tx_hashes, timeout=600):
+        """
+        Confirm a step's worth of {'type': ..., 'hash': ...} entries in one pass.
+
+        Returns (successful count, failed entries, passed entries).
+        """
+
+        hashes = {}
+        tx_fails = []
+        for tmp_tx_hash in tx_hashes:
+            tx_hash = tmp_tx_hash['hash']
+            if isinstance(tx_hash, PendingTransaction):
+                try:
+                    tx_hash = tx_hash.hash
+                except Exception as inst:
+                    # Pipelined sends can fail after the agent moved on
+                    logger.info({"error": inst, "action": tmp_tx_hash['type']})
+                    tx_fails.append(tmp_tx_hash)
+                    continue
+            hashes[id(tmp_tx_hash)] = normalize_hash(tx_hash)
+
+        receipts = self.collect(hashes.values(), timeout)
+
+        tx_good = []
+        for tmp_tx_hash in tx_hashes:
+            if id(tmp_tx_hash) not in hashes:
+                continue
+            receipt = receipts.get(hashes[id(tmp_tx_hash)])
+            if receipt is None or receipt["status"] == 0:
+                tx_fails.append(tmp_tx_hash)
+            else:
+                tx_good.append(tmp_tx_hash)
+
+        return len(tx_good), tx_fails, tx_good
+
+rpc_connection = None
+receipt_collector = None
+
+class BlockContext:
+    """
+    The latest block, fetched once and served from memory until the chain
+    moves.
+
+    A newHeads subscription drops the cached block as soon as a new head
+    comes in, and advance_time()/issue_block() drop it right away since they
+    are how the simulator moves the chain itself. Without a subscription
+    every read goes to the node.
+    """
+
+    def __init__(self, connection=None):
+        self.connection = connection
+        self.__block = None
+        # Bumped on every invalidation so a fetch racing a new head is not kept
+        self.__generation = 0
+        self.__subscription = None
+
+    def __on_head(self, head):
+        self.invalidate()
+
+    def __is_subscribed(self):
+        if self.connection is None:
+            return False
+        if self.__subscription in self.connection.subscriptions:
+            return True
+        try:
+            self.__subscription = asyncio.run_coroutine_threadsafe(
+                self.connection.subscribe('newHeads', self.__on_head),
+                self.connection.loop
+            ).result(60)
+        except Exception as inst:
+            logger.info({"error": inst, "action": "subscribe newHeads"})
+            self.__subscription = None
+            return False
+        # Anything cached from before the subscription can't be trusted
+        self.invalidate()
+        return True
+
+    def invalidate(self):
+        self.__generation += 1
+        self.__block = None
+
+    @property
+    def block(self):
+        block = self.__block
+        if block is not None and self.__subscription in self.connection.subscriptions:
+            return block
+
+        is_subscribed = self.__is_subscribed()
+        generation = self.__generation
+        block = w3.eth.get_block('latest')
+        if is_subscribed and generation == self.__generation:
+            self.__block = block
+        return block
+
+    @property
+    def number(self):
+        return self.block["number"]
+
+    @property
+    def timestamp(self):
+        return self.block["timestamp"]
+
+    def advance_time(self, seconds):
+        provider.make_request("debug_increaseTime", [seconds])
+        self.invalidate()
+
+    def issue_block(self):
+        providerAvax.make_request("avax.issueBlock", {})
+        self.invalidate()
+
+block_context = None
+
+def wait_for_receipt(tx_hash, timeout=120):
+    """
+    Block until the transaction is mined and return its receipt.
+
+    Takes either a bare hash or a PendingTransaction from the pipeline.
+    """
+
+    if isinstance(tx_hash, PendingTransaction):
+        return tx_hash.receipt(timeout)
+    if receipt_collector is not None:
+        receipt = receipt_collector.collect([tx_hash], timeout).get(normalize_hash(tx_hash))
+        if receipt is None:
+            raise TimeExhausted("Transaction {} is not in the chain after {} seconds".format(normalize_hash(tx_hash), timeout))
+        return receipt
+    return w3.eth.waitForTransactionReceipt(tx_hash, poll_latency=tx_pool_latency, timeout=timeout)
+
+def wait_for_receipts(tx_hashes, timeout=120):
+    """
+    Block until all the transactions are mined and return their receipts, in order.
+    """
+
+    if receipt_collector is None:
+        return [wait_for_receipt(tx_hash, timeout) for tx_hash in tx_hashes]
+
+    hashes = [normalize_hash(tx_hash.hash if isinstance(tx_hash, PendingTransaction) else tx_hash) for tx_hash in tx_hashes]
+    receipts = receipt_collector.collect(hashes, timeout)
+    for tx_hash in hashes:
+        if tx_hash not in receipts:
+            raise TimeExhausted("Transaction {} is not in the chain after {} seconds".format(tx_hash, timeout))
+    return [receipts[tx_hash] for tx_hash in hashes]
+
+def batch_call(calls, caller, gas=8000000):
+    """
+    Run many contract view calls as batched eth_call requests and return the
+    decoded results, in order.
+
+    calls is a list of (contract, fn_name, args). Falls back to one call per
+    request when there is no rpc connection.
+    """
+
+    fns = [contract.functions[fn_name](*args) for (contract, fn_name, args) in calls]
+    sender = getattr(caller, 'address', caller)
+    if rpc_connection is None:
+        return [fn.call({'from' : sender, 'gas': gas}) for fn in fns]
+
+    results = []
+    for i in range(0, len(fns), BATCH_CALL_SIZE):
+        chunk = fns[i:i + BATCH_CALL_SIZE]
+        raw = rpc_connection.call_batch([
+            ('eth_call', [{
+                'from': sender,
+                'to': fn.address,
+                'data': fn._encode_transaction_data(),
+                'gas': hex(gas),
+            }, 'latest']) for fn in chunk
+        ])
+        for fn, data in zip(chunk, raw):
+            if isinstance(data, RPCError):
+                raise data
+            output_types = get_abi_output_types(fn.abi)
+            decoded = map_abi_data(BASE_RETURN_NORMALIZERS, output_types, w3.codec.decode_abi(output_types, HexBytes(data)))
+            results.append(decoded[0] if len(decoded) == 1 else decoded)
+    return results
+
+def when_mined(tx_hash, callback):
+    """
+    Call callback(receipt) once the transaction is mined, from whatever
+    thread sees the receipt first. Nothing happens if it never is.
+    """
+
+    def on_receipt(future):
+        if not future.cancelled() and future.exception() is None:
+            callback(future.result())
+
+    if isinstance(tx_hash, PendingTransaction):
+        tx_hash.receipt_future.add_done_callback(on_receipt)
+    elif receipt_collector is not None:
+        receipt_collector.loop.call_soon_threadsafe(lambda: receipt_collector.watch(tx_hash).add_done_callback(on_receipt))
+
+class GasProfile:
+    """
+    Learned gas limits per (contract address, function selector).
+
+    The first call to a function is seeded from estimateGas, and every
+    receipt after that raises the limit to the most gas seen used, plus
+    GAS_MARGIN. A transaction that runs out of gas doubles it. The gas passed
+    in at the call site is kept as the ceiling, and as the fallback when
+    estimating fails. Saved to and loaded from a JSON file between runs.
+    """
+
+    def __init__(self, path=GAS_PROFILE_FILE, margin=GAS_MARGIN):
+        self.path = path
+        self.margin = margin
+        self.__lock = threading.Lock()
+        # This maps from "address:selector" to {"limit", "max_used"}
+        self.profiles = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.profiles = json.loads(f.read())
+
+    def key(self, prepped_function_call):
+        return '{}:{}'.format(prepped_function_call.address, prepped_function_call._encode_transaction_data()[:10])
+
+    def gas_for(self, agent, prepped_function_call, gas):
+        """
+        Get the gas limit to send the call with, capped at the given gas.
+        """
+
+        key = self.key(prepped_function_call)
+        with self.__lock:
+            profile = self.profiles.get(key)
+        if profile is not None:
+            return min(profile['limit'], gas)
+
+        try:
+            estimate = prepped_function_call.estimateGas({'from' : getattr(agent, 'address', agent), 'gas': gas})
+        except Exception as inst:
+            # Probably reverts in the current state; try again next time
+            logger.info({"agent": getattr(agent, 'address', agent), "error": inst, "action": "estimate_gas", "key": key})
+            return gas
+        with self.__lock:
+            profile = self.profiles.setdefault(key, {'limit': int(estimate * self.margin), 'max_used': 0})
+        return min(profile['limit'], gas)
+
+    def observe(self, prepped_function_call, gas, receipt):
+        """
+        Learn from the receipt of a call sent with the given gas limit.
+        """
+
+        key = self.key(prepped_function_call)
+        with self.__lock:
+            profile = self.profiles.setdefault(key, {'limit': gas, 'max_used': 0})
+            if receipt['status'] == 0 and receipt['gasUsed'] >= gas:
+                profile['limit'] = max(profile['limit'], gas * 2)
+            elif receipt['gasUsed'] > profile['max_used']:
+                profile['max_used'] = receipt['gasUsed']
+                profile['limit'] = max(profile['limit'], int(receipt['gasUsed'] * self.margin))
+
+    def track(self, tx_hash, prepped_function_call, gas):
+        """
+        Observe the transaction's receipt whenever it turns up.
+        """
+
+        when_mined(tx_hash, lambda receipt: self.observe(prepped_function_call, gas, receipt))
+
+    def save(self):
+        with self.__lock:
+            data = json.dumps(self.profiles, indent=1, sort_keys=True)
+        with open(self.path, 'w') as f:
+            f.write(data)
+
+gas_profile = None
 
 def transaction_helper(agent, prepped_function_call, gas):
+    if gas_profile is not None:
+        gas = gas_profile.gas_for(agent, prepped_function_call, gas)
+
+    if tx_pipeline is not None:
+        tx_hash = tx_pipeline.submit(agent, prepped_function_call, gas)
+        if gas_profile is not None:
+            gas_profile.track(tx_hash, prepped_function_call, gas)
+        if surplus_screener is not None:
+            surplus_screener.track(tx_hash, agent)
+        return tx_hash
+
     tx_hash = None
-    nonce = get_nonce(agent)
-    while tx_hash is None:
+    address = getattr(agent, 'address', agent)
+    nonce = nonce_table.reserve(address, agent.next_tx_count)
+    delay = TX_RETRY_BACKOFF
+    for attempt in range(MAX_TX_RETRIES + 1):
         try:
             agent.next_tx_count = nonce
-            lock_nonce(agent)
             tx_hash = prepped_function_call.transact({
-                'chainId': 43112,
+                'chainId': CHAIN_ID,
                 'nonce': nonce,
-                'from' : getattr(agent, 'address', agent),
+                'from' : address,
                 'gas': gas,
-                'gasPrice': Web3.toWei(225, 'gwei'),
+                'gasPrice': GAS_PRICE,
             })
-            unlock_nonce(agent)
+            break
         except Exception as inst:
-            err_str = str(inst)
-            if 'nonce too low' in err_str:
-                # increment tx_hash
-                unlock_nonce(agent)
-                nonce +=1
-            elif 'replacement transaction underpriced' in err_str:
-                # increment tx_hash
-                unlock_nonce(agent)
-                nonce +=1
-            else:
-                unlock_nonce(agent)
-                nonce +=1
-                print(inst)
+            err = classify_error(inst)
+            if not err.retryable or attempt == MAX_TX_RETRIES:
+                logger.info({"agent": address, "error": err, "type": type(err).__name__, "action": "submit", "nonce": nonce})
+                try:
+                    # Don't leave a gap behind the nonce that was never used
+                    nonce_table.release(address, nonce, w3.eth.getTransactionCount(address, 'pending'))
+                except Exception as resync_inst:
+                    logger.info({"agent": address, "error": resync_inst, "action": "resync"})
+                # Hand the failure back like a pipelined send would
+                tx_hash = PendingTransaction(agent, prepped_function_call, gas)
+                tx_hash.nonce = nonce
+                tx_hash.fail(err)
+                break
+            time.sleep(delay)
+            delay *= 2
+            if isinstance(err, (NonceError, UnderpricedError)):
+                # take the next nonce the node will accept
+                tx_count = w3.eth.getTransactionCount(address, 'pending')
+                nonce_table.release(address, nonce, tx_count)
+                nonce = nonce_table.reserve(address, tx_count)
+    if gas_profile is not None:
+        gas_profile.track(tx_hash, prepped_function_call, gas)
+    if surplus_screener is not None:
+        surplus_screener.track(tx_hash, agent)
     return tx_hash
 
 def pretty(d, indent=0):
@@ -305,42 +1467,65 @@ def execute_cmd(cmd):
 # have. But also, it's ugly to throw around total counts of atomic units. So we
 # use this class that represents a fixed-point token balance.
 class Balance:
+    """
+    A token amount as integer wei plus a number of decimals.
+
+    Powers of ten come from the SCALES table instead of being recomputed,
+    and the in-place operators update this object rather than making a new
+    one.
+    """
+
+    __slots__ = ('_wei', '_decimals')
+
+    # SCALES[d] == 10**d for every decimals value a uint256 can use
+    SCALES = tuple(10**d for d in range(78))
+
     def __init__(self, wei=0, decimals=0):
         self._wei = int(wei)
         self._decimals = int(decimals)
+
+    @classmethod
+    def make(cls, wei, decimals):
+        """
+        Make a balance from an int wei and int decimals without converting them.
+        """
+        balance = object.__new__(cls)
+        balance._wei = wei
+        balance._decimals = decimals
+        return balance
         
     def clone(self):
         """
         Make a deep copy so += and -= on us won't infect the copy.
         """
-        return Balance(self._wei, self._decimals)
+        return Balance.make(self._wei, self._decimals)
         
     def to_decimals(self, new_decimals):
         """
         Get a similar balance with a different number of decimals.
         """
         
-        return Balance(self._wei * 10**new_decimals // 10**self._decimals, new_decimals)
+        return Balance.make(self._wei * self.SCALES[new_decimals] // self.SCALES[self._decimals], int(new_decimals))
         
     @classmethod
     def from_tokens(cls, n, decimals=0):
-        return cls(n * 10**decimals, decimals)
+        return cls(n * cls.SCALES[decimals], decimals)
 
     def __add__(self, other):
         if isinstance(other, Balance):
             if other._decimals != self._decimals:
-                raise ValueError("Cannot add balances with different decimals: {}, {}", self, other)
-            return Balance(self._wei + other._wei, self._decimals)
+                raise ValueError("Cannot add balances with different decimals: {}, {}".format(self, other))
+            return Balance.make(self._wei + other._wei, self._decimals)
         else:
-            return Balance(self._wei + other * 10**self._decimals, self._decimals)
+            return Balance(self._wei + other * self.SCALES[self._decimals], self._decimals)
 
     def __iadd__(self, other):
         if isinstance(other, Balance):
             if other._decimals != self._decimals:
-                raise ValueError("Cannot add balances with different decimals: {}, {}", self, other)
+                raise ValueError("Cannot add balances with different decimals: {}, {}".format(self, other))
             self._wei += other._wei
         else:
-            self._wei += other * 10**self._decimals
+            self._wei = int(self._wei + other * self.SCALES[self._decimals])
         return self
         
     def __radd__(self, other):
@@ -349,22 +1534,22 @@ class Balance:
     def __sub__(self, other):
         if isinstance(other, Balance):
             if other._decimals != self._decimals:
-                raise ValueError("Cannot subtract balances with different decimals: {}, {}", self, other)
-            return Balance(self._wei - other._wei, self._decimals)
+                raise ValueError("Cannot subtract balances with different decimals: {}, {}".format(self, other))
+            return Balance.make(self._wei - other._wei, self._decimals)
         else:
-            return Balance(self._wei - other * 10**self._decimals, self._decimals)
+            return Balance(self._wei - other * self.SCALES[self._decimals], self._decimals)
 
     def __isub__(self, other):
         if isinstance(other, Balance):
             if other._decimals != self._decimals:
-                raise ValueError("Cannot subtract balances with different decimals: {}, {}", self, other)
+                raise ValueError("Cannot subtract balances with different decimals: {}, {}".format(self, other))
             self._wei -= other._wei
         else:
-            self._wei -= other * 10**self._decimals
+            self._wei = int(self._wei - other * self.SCALES[self._decimals])
         return self
         
     def __rsub__(self, other):
-        return Balance(other * 10**self._decimals, self._decimals) - self
+        return Balance(other * self.SCALES[self._decimals], self._decimals) - self
         
     def __mul__(self, other):
         if isinstance(other, Balance):
@@ -375,6 +1560,7 @@ class Balance:
         if isinstance(other, Balance):
             raise TypeError("Cannot multiply two balances")
         self._wei = int(self._wei * other)
+        return self
         
     def __rmul__(self, other):
         return self * other
@@ -388,6 +1574,7 @@ class Balance:
         if isinstance(other, Balance):
             raise TypeError("Cannot divide two balances")
         self._wei = int(self._wei // other)
+        return self
         
     # No rtruediv because dividing by a balance is silly.
     
@@ -396,65 +1583,66 @@ class Balance:
     def __lt__(self, other):
         if isinstance(other, Balance):
             if other._decimals != self._decimals:
-                raise ValueError("Cannot compare balances with different decimals: {}, {}", self, other)
+                raise ValueError("Cannot compare balances with different decimals: {}, {}".format(self, other))
             return self._wei < other._wei
         else:
-            return float(self) < other
+            return self._wei / self.SCALES[self._decimals] < other
             
     def __le__(self, other):
         if isinstance(other, Balance):
             if other._decimals != self._decimals:
-                raise ValueError("Cannot compare balances with different decimals: {}, {}", self, other)
+                raise ValueError("Cannot compare balances with different decimals: {}, {}".format(self, other))
             return self._wei <= other._wei
         else:
-            return float(self) <= other
+            return self._wei / self.SCALES[self._decimals] <= other
             
     def __gt__(self, other):
         if isinstance(other, Balance):
             if other._decimals != self._decimals:
-                raise ValueError("Cannot compare balances with different decimals: {}, {}", self, other)
+                raise ValueError("Cannot compare balances with different decimals: {}, {}".format(self, other))
             return self._wei > other._wei
         else:
-            return float(self) > other
+            return self._wei / self.SCALES[self._decimals] > other
             
     def __ge__(self, other):
         if isinstance(other, Balance):
             if other._decimals != self._decimals:
-                raise ValueError("Cannot compare balances with different decimals: {}, {}", self, other)
+                raise ValueError("Cannot compare balances with different decimals: {}, {}".format(self, other))
             return self._wei >= other._wei
         else:
-            return float(self) >= other
+            return self._wei / self.SCALES[self._decimals] >= other
             
     def __eq__(self, other):
         if isinstance(other, Balance):
             if other._decimals != self._decimals:
-                raise ValueError("Cannot compare balances with different decimals: {}, {}", self, other)
+                raise ValueError("Cannot compare balances with different decimals: {}, {}".format(self, other))
             return self._wei == other._wei
         else:
-            return float(self) == other
+            return self._wei / self.SCALES[self._decimals] == other
             
     def __ne__(self, other):
         if isinstance(other, Balance):
             if other._decimals != self._decimals:
-                raise ValueError("Cannot compare balances with different decimals: {}, {}", self, other)
+                raise ValueError("Cannot compare balances with different decimals: {}, {}".format(self, other))
             return self._wei != other._wei
         else:
-            return float(self) != other
+            return self._wei / self.SCALES[self._decimals] != other
+
+    __hash__ = None
 
     def __str__(self):
-        base = 10**self._decimals
-        ipart = self._wei // base
-        fpart = self._wei - base * ipart
+        (ipart, fpart) = divmod(self._wei, self.SCALES[self._decimals])
         return ('{}.{:0' + str(self._decimals) + 'd}').format(ipart, fpart)
 
     def __repr__(self):
         return 'Balance({}, {})'.format(self._wei, self._decimals)
         
     def __float__(self):
-        return self._wei / 10**self._decimals
+        return self._wei / self.SCALES[self._decimals]
 
     def __round__(self):
-        return Balance(int(math.floor(self._wei / 10**self._decimals)) * 10**self._decimals, self._decimals)
+        scale = self.SCALES[self._decimals]
+        return Balance(int(math.floor(self._wei / scale)) * scale, self._decimals)
         
     def __format__(self, s):
         if s == '':
@@ -467,6 +1655,468 @@ class Balance:
     def decimals(self):
         return self._decimals
 
+class BalanceArray:
+    """
+    Many balances with the same decimals, stored as one NumPy array of wei.
+
+    The array has object dtype so wei stay exact Python ints (18 decimals
+    overflow int64 past 9.2 tokens), while totals, comparisons and
+    conversions still run as single NumPy calls instead of a Python loop
+    over Balance objects.
+    """
+
+    __slots__ = ('wei', 'decimals')
+
+    def __init__(self, wei=(), decimals=0):
+        self.decimals = int(decimals)
+        self.wei = np.array([int(w) for w in wei], dtype=object)
+
+    @classmethod
+    def from_balances(cls, balances, decimals=None):
+        balances = list(balances)
+        if decimals is None:
+            decimals = balances[0].decimals() if balances else 0
+        for balance in balances:
+            if balance.decimals() != decimals:
+                raise ValueError("Cannot pack balances with different decimals: {}, {}".format(balance, decimals))
+        return cls([balance.to_wei() for balance in balances], decimals)
+
+    def __wrap(self, wei):
+        result = BalanceArray((), self.decimals)
+        result.wei = wei
+        return result
+
+    def __other_wei(self, other, verb):
+        if isinstance(other, (BalanceArray, Balance)):
+            decimals = other.decimals if isinstance(other, BalanceArray) else other.decimals()
+            if decimals != self.decimals:
+                raise ValueError("Cannot {} balances with different decimals: {}, {}".format(verb, self.decimals, decimals))
+            return other.wei if isinstance(other, BalanceArray) else other.to_wei()
+        return None
+
+    def __len__(self):
+        return len(self.wei)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return Balance(self.wei[index], self.decimals)
+        return self.__wrap(self.wei[index])
+
+    def __setitem__(self, index, value):
+        self.wei[index] = value.to_wei() if isinstance(value, Balance) else int(value)
+
+    def total(self):
+        return Balance(self.wei.sum() if len(self.wei) else 0, self.decimals)
+
+    def to_floats(self):
+        """
+        Get the balances in token units as a float64 array.
+        """
+
+        return self.wei.astype(np.float64) / Balance.SCALES[self.decimals]
+
+    def to_decimals(self, new_decimals):
+        result = self.__wrap(self.wei * Balance.SCALES[new_decimals] // Balance.SCALES[self.decimals])
+        result.decimals = new_decimals
+        return result
+
+    def __add__(self, other):
+        wei = self.__other_wei(other, 'add')
+        return self.__wrap(self.wei + (wei if wei is not None else int(other * Balance.SCALES[self.decimals])))
+
+    def __iadd__(self, other):
+        wei = self.__other_wei(other, 'add')
+        self.wei += (wei if wei is not None else int(other * Balance.SCALES[self.decimals]))
+        return self
+
+    def __sub__(self, other):
+        wei = self.__other_wei(other, 'subtract')
+        return self.__wrap(self.wei - (wei if wei is not None else int(other * Balance.SCALES[self.decimals])))
+
+    def __isub__(self, other):
+        wei = self.__other_wei(other, 'subtract')
+        self.wei -= (wei if wei is not None else int(other * Balance.SCALES[self.decimals]))
+        return self
+
+    def __compare(self, other, op):
+        wei = self.__other_wei(other, 'compare')
+        if wei is None:
+            # Like Balance, compare against plain numbers in token units
+            return op(self.to_floats(), other)
+        return op(self.wei, wei).astype(bool)
+
+    def __lt__(self, other):
+        return self.__compare(other, np.less)
+
+    def __le__(self, other):
+        return self.__compare(other, np.less_equal)
+
+    def __gt__(self, other):
+        return self.__compare(other, np.greater)
+
+    def __ge__(self, other):
+        return self.__compare(other, np.greater_equal)
+
+    def __eq__(self, other):
+        return self.__compare(other, np.equal)
+
+    def __ne__(self, other):
+        return self.__compare(other, np.not_equal)
+
+    __hash__ = None
+
+    def __iter__(self):
+        for wei in self.wei:
+            yield Balance(wei, self.decimals)
+
+    def __repr__(self):
+        return 'BalanceArray({}, {})'.format(list(self.wei), self.decimals)
+
+def topic_address(topic):
+    return Web3.toChecksumAddress('0x' + HexBytes(topic).hex()[-40:])
+
+def log_uint(log):
+    return int.from_bytes(HexBytes(log['data'])[:32], 'big')
+
+class LogIndexer:
+    """
+    Fetches Transfer events for every tracked token with one eth_getLogs per
+    block range, and hands each one to the TokenProxy for its address.
+    Other consumers can subscribe raw handlers to extra topics from the
+    contracts they name, which go in the same query.
+
+    Keeps a cursor at the last block indexed, so every block is covered
+    exactly once no matter how many proxies ask for an update.
+    """
+
+    def __init__(self, from_block):
+        self.cursor = from_block
+        # This maps from token address to the TokenProxy that gets its events
+        self.proxies = {}
+        # And this to the block the proxy loaded its state at
+        self.__start_blocks = {}
+        # This maps from topic to the handlers that get every raw log with it
+        self.handlers = {}
+        # The address collections handlers were subscribed with, kept by reference so they can grow
+        self.__subscribed_addresses = []
+
+    def subscribe(self, topic, handler, addresses):
+        """
+        Call handler(log) for every log with the topic from any of the
+        addresses. addresses is kept as is, so a set the subscriber adds to
+        later widens the query from then on.
+        """
+
+        self.handlers.setdefault(topic, []).append(handler)
+        if not any(addresses is known for known in self.__subscribed_addresses):
+            self.__subscribed_addresses.append(addresses)
+
+    def addresses(self):
+        """
+        Get every contract address the query covers: tracked tokens and
+        everything subscribed.
+        """
+
+        result = set(self.proxies.keys())
+        for addresses in self.__subscribed_addresses:
+            result.update(addresses)
+        return result
+
+    def track(self, proxy, start_block):
+        if proxy.address not in self.proxies:
+            self.proxies[proxy.address] = proxy
+            self.__start_blocks[proxy.address] = start_block
+
+    def proxy(self, contract):
+        """
+        Get the tracked proxy for the contract's address, making one if needed.
+        """
+
+        if contract.address in self.proxies:
+            return self.proxies[contract.address]
+        return TokenProxy(contract)
+
+    def poll(self):
+        """
+        Dispatch the events of every block since the cursor.
+        """
+
+        head = block_context.number
+        while self.cursor < head and self.addresses():
+            to_block = min(head, self.cursor + LOG_RANGE_BLOCKS)
+            topics = [list(set([TRANSFER_TOPIC] + list(self.handlers.keys())))]
+            queried = set()
+            addresses = self.addresses()
+            while addresses:
+                # A handler can add addresses (a new option token, say), whose logs in this range are fetched next
+                queried |= addresses
+                log_filter = {
+                    'fromBlock': self.cursor + 1,
+                    'toBlock': to_block,
+                    'address': sorted(addresses),
+                    'topics': topics,
+                }
+                for log in w3.eth.get_logs(log_filter):
+                    self.__dispatch(log)
+                addresses = self.addresses() - queried
+            self.cursor = to_block
+        if not self.addresses():
+            self.cursor = max(self.cursor, head)
+
+    def __dispatch(self, log):
+        topic = HexBytes(log['topics'][0]).hex()
+        for handler in self.handlers.get(topic, []):
+            handler(log)
+        if topic != TRANSFER_TOPIC or log['address'] not in self.proxies:
+            return
+        if log['blockNumber'] <= self.__start_blocks[log['address']]:
+            # Already part of the state the proxy loaded
+            return
+        proxy = self.proxies[log['address']]
+        proxy.on_transfer(proxy.contract.events.Transfer().processLog(log))
+
+log_indexer = None
+
+class PositionLedger:
+    """
+    In-memory option positions per (agent, option token): written volume and
+    holding balance, in wei, plus totals per agent.
+
+    Loaded from OptionsExchange.getBook and then kept current from events
+    off the LogIndexer: WriteOptions adds written volume, option token
+    Transfers move holdings (and a burn by a writer takes off written
+    volume), and the collateral manager's liquidation events take off the
+    liquidated volume. Every check_interval blocks check() reloads the books
+    and logs anything that drifted. Short collateral exposure depends on
+    prices as well as positions, so it is memoized per block instead.
+    """
+
+    def __init__(self, options_exchange, credit_provider, collateral_managers, check_interval=LEDGER_CHECK_BLOCKS):
+        self.options_exchange = options_exchange
+        self.credit_provider = credit_provider
+        self.check_interval = check_interval
+        # These map from (agent address, token address) to wei
+        self.written = collections.defaultdict(int)
+        self.holding = collections.defaultdict(int)
+        # These map from agent address to wei
+        self.total_written = collections.defaultdict(int)
+        self.total_holding = collections.defaultdict(int)
+        # This maps from agent address to (block, Balance)
+        self.__exposure = {}
+        self.tokens = set()
+        self.loaded_block = None
+        # The addresses to reload in check()
+        self.owners = []
+
+        # Liquidations are emitted by the collateral managers, not the exchange
+        self.collateral_managers = set(collateral_managers)
+
+        log_indexer.subscribe(CREATE_SYMBOL_TOPIC, self.__on_create_symbol, [self.options_exchange.address])
+        log_indexer.subscribe(WRITE_OPTIONS_TOPIC, self.__on_write, [self.options_exchange.address])
+        # The set of tokens grows as symbols get created, and the query with it
+        log_indexer.subscribe(TRANSFER_TOPIC, self.__on_transfer, self.tokens)
+        log_indexer.subscribe(LIQUIDATE_EARLY_TOPIC, self.__on_liquidate, self.collateral_managers)
+        log_indexer.subscribe(LIQUIDATE_EXPIRED_TOPIC, self.__on_liquidate, self.collateral_managers)
+
+    def __add(self, position, totals, owner, token, amount):
+        # Never let a missed event drive a position negative
+        amount = max(amount, -position[(owner, token)])
+        position[(owner, token)] += amount
+        totals[owner] += amount
+
+    def __is_new(self, log):
+        return self.loaded_block is None or log['blockNumber'] > self.loaded_block
+
+    def __on_create_symbol(self, log):
+        if log['address'] == self.options_exchange.address:
+            self.tokens.add(topic_address(log['topics'][1]))
+
+    def __on_write(self, log):
+        if log['address'] != self.options_exchange.address or not self.__is_new(log):
+            return
+        token = topic_address(log['topics'][1])
+        issuer = topic_address(log['topics'][2])
+        self.tokens.add(token)
+        self.__add(self.written, self.total_written, issuer, token, log_uint(log))
+
+    def __on_transfer(self, log):
+        if log['address'] not in self.tokens or not self.__is_new(log):
+            return
+        token = log['address']
+        sender = topic_address(log['topics'][1])
+        receiver = topic_address(log['topics'][2])
+        value = log_uint(log)
+        if sender != ZERO_ADDRESS:
+            self.__add(self.holding, self.total_holding, sender, token, -value)
+            if receiver == ZERO_ADDRESS and self.written[(sender, token)] > 0:
+                # Redeeming needs everything liquidated first, so this is a writer burning
+                self.__add(self.written, self.total_written, sender, token, -value)
+        if receiver != ZERO_ADDRESS:
+            self.__add(self.holding, self.total_holding, receiver, token, value)
+
+    def __on_liquidate(self, log):
+        token = topic_address(log['topics'][1])
+        if token not in self.tokens or not self.__is_new(log):
+            return
+        owner = topic_address(log['topics'][3])
+        self.__add(self.written, self.total_written, owner, token, -log_uint(log))
+
+    def load(self, owners):
+        """
+        Replace the positions of the given owners with their books from the chain.
+
+        Returns the (owner, token, field, ledger, chain) entries that differed.
+        """
+
+        self.owners = [getattr(owner, 'address', owner) for owner in owners]
+        # Bring the ledger up to date first, so the books can take over from here
+        log_indexer.poll()
+        self.loaded_block = block_context.number
+        books = batch_call([(self.options_exchange, 'getBook', [owner]) for owner in self.owners], self.owners[0])
+
+        drift = []
+        for owner, book in zip(self.owners, books):
+            (symbols, tokens, holding, written) = book[:4]
+            chain = {}
+            for (token, held, wrote) in zip(tokens, holding, written):
+                self.tokens.add(token)
+                chain[(token, 'holding')] = held
+                chain[(token, 'written')] = wrote
+            known = set(k[1] for k in list(self.holding.keys()) + list(self.written.keys()) if k[0] == owner)
+            for token in known | set(tokens):
+                for (field, position, totals) in [('holding', self.holding, self.total_holding), ('written', self.written, self.total_written)]:
+                    value = chain.get((token, field), 0)
+                    if position[(owner, token)] != value:
+                        drift.append((owner, token, field, position[(owner, token)], value))
+                        totals[owner] += value - position[(owner, token)]
+                        position[(owner, token)] = value
+        return drift
+
+    def check(self):
+        """
+        Reload the books if check_interval blocks went by since the last load.
+        """
+
+        if self.loaded_block is not None and block_context.number - self.loaded_block < self.check_interval:
+            return
+        for (owner, token, field, ledger_value, chain_value) in self.load(self.owners):
+            logger.info({"action": "ledger drift", "owner": owner, "token": token, "field": field, "ledger": ledger_value, "chain": chain_value})
+
+    def written_of(self, owner):
+        log_indexer.poll()
+        return Balance(self.total_written[getattr(owner, 'address', owner)], EXCHG['decimals'])
+
+    def holding_of(self, owner):
+        log_indexer.poll()
+        return Balance(self.total_holding[getattr(owner, 'address', owner)], EXCHG['decimals'])
+
+    def exposure_of(self, owner):
+        address = getattr(owner, 'address', owner)
+        block = block_context.number
+        if address not in self.__exposure or self.__exposure[address][0] != block:
+            self.__exposure[address] = (block, self.credit_provider.get_short_collateral_exposure(owner))
+        return self.__exposure[address][1].clone()
+
+position_ledger = None
+
+class ApprovalStore:
+    """
+    Which (token, owner, spender) approvals we have on chain, kept in an
+    append-only log with one "token owner spender" line per approval.
+
+    approve() submits every missing approval in one go and can either wait
+    for them together or let them confirm in the background. Either way
+    they are logged as their receipts come in, and an approval still in
+    flight is waited on rather than sent again.
+    """
+
+    def __init__(self, path=APPROVALS_FILE):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.approved = set()
+        # This maps from (token, owner, spender) to a Future of the approve transaction in flight
+        self.pending = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 3:
+                        self.approved.add(tuple(parts))
+        self.__log = open(path, 'a')
+
+    def reset(self, keys):
+        """
+        Replace everything we know with the given approvals, e.g. after the
+        chain was reverted to a snapshot, and rewrite the log to match.
+        """
+
+        with self.__lock:
+            self.approved = set(tuple(key) for key in keys)
+            self.pending = {}
+            self.__log.close()
+            with open(self.path, 'w') as f:
+                for key in sorted(self.approved):
+                    f.write(' '.join(key) + '\n')
+            self.__log = open(self.path, 'a')
+
+    def __mined(self, key, receipt):
+        with self.__lock:
+            self.pending.pop(key, None)
+            if receipt['status'] != 1 or key in self.approved:
+                return
+            self.approved.add(key)
+            self.__log.write(' '.join(key) + '\n')
+            self.__log.flush()
+
+    def approve(self, requests, wait=True):
+        """
+        Make sure every (token proxy, owner, spender) in requests is approved
+        for everything, sending all the missing approvals at once.
+        """
+
+        waiting = []
+        for (token, owner, spender) in requests:
+            key = (token.address, getattr(owner, 'address', owner), getattr(spender, 'address', spender))
+            with self.__lock:
+                if key in self.approved:
+                    continue
+                sent = self.pending.get(key)
+                is_sender = sent is None
+                if is_sender:
+                    # Claim the key here but send outside the lock: sending can block until
+                    # earlier approvals are mined, and their callbacks need the lock
+                    sent = concurrent.futures.Future()
+                    self.pending[key] = sent
+            if is_sender:
+                try:
+                    tx_hash = transaction_helper(
+                        owner,
+                        token.contract.functions.approve(key[2], UINT256_MAX),
+                        500000
+                    )
+                except Exception as inst:
+                    with self.__lock:
+                        self.pending.pop(key, None)
+                    sent.set_exception(inst)
+                    raise
+                sent.set_result(tx_hash)
+                when_mined(tx_hash, lambda receipt, key=key: self.__mined(key, receipt))
+            waiting.append((key, sent))
+
+        if not wait or not waiting:
+            return
+        for (key, sent) in waiting:
+            try:
+                self.__mined(key, wait_for_receipt(sent.result(), timeout=600))
+            except Exception as inst:
+                logger.info({"owner": key[1], "error": inst, "action": "approve", "token": key[0], "spender": key[2]})
+                with self.__lock:
+                    self.pending.pop(key, None)
+
+approval_store = None
+
+pricing_backend = None
+
 class TokenProxy:
     """
     A proxy for an ERC20 token. Monitors events, processes them when update()
@@ -479,27 +2129,18 @@ class TokenProxy:
         """
         
         self.__contract = contract
-        self.__transfer_filter = self.__contract.events.Transfer.createFilter(fromBlock='latest')
         # This maps from string address to Balance balance
         self.__balances = {}
-        # This records who we approved for who
-        self.__approved_file = "{}-{}.json".format(str(contract.address), 'approvals')
-
-        if not os.path.exists(self.__approved_file):
-            f = open(self.__approved_file, 'w+')
-            f.write('{}')
-            f.close()
-            tmp_file_data = {}
-        else:
-            data = open(self.__approved_file, 'r+').read()
-            tmp_file_data = {} if len(data) == 0 else json.loads(data)
-        self.__approved = tmp_file_data
-        
+        # These addresses need to be polled because we have no balance from
+        # before their transfers.
+        self.__new_addresses = set()
         # Load initial parameters from the chain.
         # Assumes no events are happening to change the supply while we are doing this.
         self.__decimals = self.__contract.functions.decimals().call()
         self.__symbol = self.__contract.functions.symbol().call()
         self.__supply = Balance(self.__contract.functions.totalSupply().call(), self.__decimals)
+        if log_indexer is not None:
+            log_indexer.track(self, block_context.number)
 
     # Expose some properties to make us easy to use in place of the contract
         
@@ -523,47 +2164,49 @@ class TokenProxy:
     def contract(self):
         return self.__contract
         
-    def update(self, is_init_agents=[]):
+    def on_transfer(self, transfer):
         """
-        Process pending events and update state to match chain.
-        Assumes no transactions are still in flight.
+        Apply a Transfer event handed over by the LogIndexer.
         """
+
+        # Each loooks something like:
+        # AttributeDict({'args': AttributeDict({'from': '0x0000000000000000000000000000000000000000', 
+        # 'to': '0x20042A784Bf0743fcD81136422e12297f52959a0', 'value': 19060347313}), 
+        # 'event': 'Transfer', 'logIndex': 0, 'transactionIndex': 0,
+        # 'transactionHash': HexBytes('0xa6f4ca515b28301b224f24b7ee14b8911d783e2bf965dbcda5784b4296c84c23'), 
+        # 'address': '0xa2Ff73731Ee46aBb6766087CE33216aee5a30d5e', 
+        # 'blockHash': HexBytes('0xb5ffd135318581fcd5cd2463cf3eef8aaf238bef545e460c284ad6283928ed08'),
+        # 'blockNumber': 17})
+        args = transfer['args']
         
-        # These addresses need to be polled because we have no balance from
-        # before all these events.
-        new_addresses = set()
-        try:
-            for transfer in self.__transfer_filter.get_new_entries():
-                # For every transfer event since we last updated...
-                
-                # Each loooks something like:
-                # AttributeDict({'args': AttributeDict({'from': '0x0000000000000000000000000000000000000000', 
-                # 'to': '0x20042A784Bf0743fcD81136422e12297f52959a0', 'value': 19060347313}), 
-                # 'event': 'Transfer', 'logIndex': 0, 'transactionIndex': 0,
-                # 'transactionHash': HexBytes('0xa6f4ca515b28301b224f24b7ee14b8911d783e2bf965dbcda5784b4296c84c23'), 
-                # 'address': '0xa2Ff73731Ee46aBb6766087CE33216aee5a30d5e', 
-                # 'blockHash': HexBytes('0xb5ffd135318581fcd5cd2463cf3eef8aaf238bef545e460c284ad6283928ed08'),
-                # 'blockNumber': 17})
-                args = transfer['args']
-                
-                moved = Balance(args['value'], self.__decimals)
-                if args['from'] in self.__balances:
-                    self.__balances[args['from']] -= moved
-                elif args['from'] == ZERO_ADDRESS:
-                    # This is a mint
-                    self.__supply += moved
-                else:
-                    new_addresses.add(args['from'])
-                if args['to'] in self.__balances:
-                    self.__balances[args['to']] += moved
-                elif args['to'] == ZERO_ADDRESS:
-                    # This is a burn
-                    self.__supply -= moved
-                else:
-                    new_addresses.add(args['to'])
-        except:
-            pass
+        moved = Balance(args['value'], self.__decimals)
+        if args['from'] in self.__balances:
+            self.__balances[args['from']] -= moved
+        elif args['from'] == ZERO_ADDRESS:
+            # This is a mint
+            self.__supply += moved
+        else:
+            self.__new_addresses.add(args['from'])
+        if args['to'] in self.__balances:
+            self.__balances[args['to']] += moved
+        elif args['to'] == ZERO_ADDRESS:
+            # This is a burn
+            self.__supply -= moved
+        else:
+            self.__new_addresses.add(args['to'])
+
+    def update(self, is_init_agents=[]):
+        """
+        Process pending events and update state to match chain.
+        Assumes no transactions are still in flight.
+        """
         
+        try:
+            log_indexer.poll()
+        except Exception as inst:
+            logger.info({"error": inst, "action": "poll logs", "token": self.address})
+
+        new_addresses, self.__new_addresses = self.__new_addresses, set()
         for address in new_addresses:
             # TODO: can we get a return value and a correct-as-of block in the same call?
             self.__balances[address] = Balance(self.__contract.functions.balanceOf(address).call(), self.__decimals)
@@ -597,24 +2240,7 @@ class TokenProxy:
         
         Owner and spender may be addresses or things with addresses.
         """
-        spender = getattr(spender, 'address', spender)
-        
-        if (getattr(owner, 'address', owner) not in self.__approved) or (spender not in self.__approved[getattr(owner, 'address', owner)]):
-            # Issue an approval
-            #logger.info('WAITING FOR APPROVAL {} for {}'.format(getattr(owner, 'address', owner), spender))
-            tx_hash = transaction_helper(
-                owner,
-                self.__contract.functions.approve(spender, UINT256_MAX),
-                500000
-            )
-            receipt = w3.eth.waitForTransactionReceipt(tx_hash, poll_latency=tx_pool_latency)
-            #logger.info('APPROVED')
-            if getattr(owner, 'address', owner) not in self.__approved:
-                self.__approved[getattr(owner, 'address', owner)] = {spender: 1}
-            else:
-                self.__approved[getattr(owner, 'address', owner)][spender] = 1
-
-            open(self.__approved_file, 'w+').write(json.dumps(self.__approved))
+        approval_store.approve([(self, owner, spender)])
             
     def from_wei(self, wei):
         """
@@ -668,7 +2294,9 @@ class Agent:
         self.options_exchange = options_exchange
 
         # keeps track of latest block seen for nonce tracking/tx
-        self.next_tx_count = w3.eth.getTransactionCount(self.address, block_identifier=int(w3.eth.get_block('latest')["number"]))
+        self.next_tx_count = w3.eth.getTransactionCount(self.address, 'pending')
+        # The table outlives the chain (a reset or redeploy), so the chain's count wins at startup
+        nonce_table.set(self.address, self.next_tx_count)
 
         if kwargs.get("is_mint", False):
             # need to mint USDT to the wallets for each agent
@@ -681,7 +2309,7 @@ class Agent:
                 500000
             )
             time.sleep(1.1)
-            w3.eth.waitForTransactionReceipt(tx_hash, poll_latency=tx_pool_latency)
+            wait_for_receipt(tx_hash)
         
     @property
     def xsd(self):
@@ -699,10 +2327,14 @@ class Agent:
 
     @property
     def total_written(self):
+        if position_ledger is not None:
+            return position_ledger.written_of(self)
         return Balance(self.options_exchange.get_total_owner_written(self), EXCHG['decimals'])
 
     @property
     def total_holding(self):
+        if position_ledger is not None:
+            return position_ledger.holding_of(self)
         return Balance(self.options_exchange.get_total_owner_holding(self), EXCHG['decimals'])
 
     @property
@@ -717,6 +2349,8 @@ class Agent:
         """
         Get the short collateral balance for agent
         """
+        if position_ledger is not None:
+            return position_ledger.exposure_of(self)
         return self.credit_provider.get_short_collateral_exposure(self)
     
     def __str__(self):
@@ -770,12 +2404,377 @@ class Agent:
         
         return faith
         
+class OptionTokenRegistry:
+    """
+    Every option token seen this run, indexed both by symbol and by
+    address, with one TokenProxy each.
+
+    Symbols are resolved to addresses once; after that looking up a known
+    symbol costs no RPCs. Tokens are live until the maturity at the end of
+    their symbol passes, and expired after that.
+    """
+
+    def __init__(self, options_exchange):
+        self.options_exchange = options_exchange
+        # These map from symbol to address and back
+        self.by_symbol = {}
+        self.by_address = {}
+        # This maps from address to the one TokenProxy for it
+        self.proxies = {}
+        self.live = set()
+        self.expired = set()
+        # Called with the list of proxies whenever new tokens are resolved
+        self.on_new_tokens = []
+
+    def resolve(self, agent, symbol):
+        """
+        Get the proxy for the symbol's token, or None if it doesn't exist (yet).
+        """
+
+        if symbol not in self.by_symbol:
+            address = self.options_exchange.resolve_token(agent, symbol)
+            if not address:
+                # Not created yet, so ask again next time
+                return None
+            self.by_symbol[symbol] = address
+            self.by_address[address] = symbol
+            self.proxies[address] = log_indexer.proxy(w3.eth.contract(abi=OptionTokenContract['abi'], address=address))
+            self.live.add(symbol)
+        return self.proxies[self.by_symbol[symbol]]
+
+    def resolve_all(self, agent, symbols):
+        known = len(self.proxies)
+        option_tokens = []
+        for symbol in symbols:
+            option_token = self.resolve(agent, symbol)
+            if option_token is not None:
+                option_tokens.append(option_token)
+        if len(self.proxies) > known:
+            new_tokens = list(self.proxies.values())[known:]
+            for callback in self.on_new_tokens:
+                callback(new_tokens)
+        return option_tokens
+
+    def restore(self, by_symbol, expired):
+        """
+        Load symbol to address mappings saved from an earlier run, without
+        asking the exchange about any of them again.
+        """
+
+        for (symbol, address) in by_symbol.items():
+            if symbol in self.by_symbol:
+                continue
+            self.by_symbol[symbol] = address
+            self.by_address[address] = symbol
+            self.proxies[address] = log_indexer.proxy(w3.eth.contract(abi=OptionTokenContract['abi'], address=address))
+            if symbol in expired:
+                self.expired.add(symbol)
+            else:
+                self.live.add(symbol)
+
+    def expire(self, timestamp):
+        """
+        Move the tokens whose maturity is at or before timestamp from live to expired.
+        """
+
+        for symbol in [symbol for symbol in self.live if OptionSymbol.parse(symbol).is_expired(timestamp)]:
+            self.live.discard(symbol)
+            self.expired.add(symbol)
+
+    def live_tokens(self):
+        return [self.proxies[self.by_symbol[symbol]] for symbol in sorted(self.live, key=lambda x: OptionSymbol.parse(x).sort_key)]
+
+    def expired_tokens(self):
+        return [self.proxies[self.by_symbol[symbol]] for symbol in sorted(self.expired, key=lambda x: OptionSymbol.parse(x).sort_key)]
+
+class SurplusScreener:
+    """
+    Collateral surplus (OptionsExchange.calcSurplus) for every agent,
+    fetched in one batched read and cached until something that can change
+    it happens.
+
+    An owner's entry is dropped when one of their transactions (or a
+    liquidation of them) is mined. Everything is dropped when the feed gets
+    a new price or the clock moves, via invalidate_all(). Reads between
+    those cost no RPCs.
+    """
+
+    def __init__(self, options_exchange, agents):
+        self.options_exchange = options_exchange
+        self.agents = list(agents)
+        self.__lock = threading.Lock()
+        # This maps from agent address to (epoch, Balance surplus)
+        self.__surplus = {}
+        # Bumped by invalidate_all() so fetches racing it aren't kept
+        self.__epoch = 0
+        # The same per owner, bumped by invalidate()
+        self.__generations = collections.Counter()
+
+    def invalidate(self, owner):
+        address = getattr(owner, 'address', owner)
+        with self.__lock:
+            self.__generations[address] += 1
+            self.__surplus.pop(address, None)
+
+    def invalidate_all(self):
+        with self.__lock:
+            self.__epoch += 1
+            self.__surplus = {}
+
+    def track(self, tx_hash, owner):
+        """
+        Drop the owner's surplus now and again when the transaction is mined.
+        """
+
+        self.invalidate(owner)
+        when_mined(tx_hash, lambda receipt: self.invalidate(owner))
+
+    def refresh(self, checker):
+        """
+        Fetch the surplus of every agent without a current entry, in one batch.
+        """
+
+        with self.__lock:
+            epoch = self.__epoch
+            stale = [(a, self.__generations[a.address]) for a in self.agents if a.address not in self.__surplus]
+        if not stale:
+            return
+        surpluses = batch_call([(self.options_exchange.contract, 'calcSurplus', [a.address]) for (a, _) in stale], checker)
+        with self.__lock:
+            if epoch == self.__epoch:
+                for ((a, generation), cs) in zip(stale, surpluses):
+                    # Skip owners invalidated while this was in flight; the value may predate their transaction
+                    if generation == self.__generations[a.address]:
+                        self.__surplus[a.address] = (epoch, Balance(cs, EXCHG['decimals']))
+
+    def surplus(self, checker, agent):
+        address = getattr(agent, 'address', agent)
+        with self.__lock:
+            entry = self.__surplus.get(address)
+        if entry is None:
+            self.refresh(checker)
+            with self.__lock:
+                entry = self.__surplus.get(address)
+        if entry is None:
+            # Not one of ours, or invalidated mid-fetch
+            return Balance(self.options_exchange.contract.caller({'from' : checker.address, 'gas': 8000000}).calcSurplus(address), EXCHG['decimals'])
+        return entry[1].clone()
+
+    def surpluses(self, checker):
+        """
+        Get every agent's surplus as a BalanceArray, in the order of agents.
+        """
+
+        self.refresh(checker)
+        return BalanceArray.from_balances([self.surplus(checker, a) for a in self.agents], EXCHG['decimals'])
+
+    def by_surplus(self, checker):
+        """
+        Get (agent, surplus) for every agent, most under-collateralized first.
+        """
+
+        surpluses = self.surpluses(checker)
+        return [(self.agents[i], surpluses[i]) for i in np.argsort(surpluses.wei, kind='stable')]
+
+    def short(self, checker):
+        """
+        Get the agents with no collateral surplus left, most short first.
+        """
+
+        surpluses = self.surpluses(checker)
+        is_short = surpluses <= 0
+        return [self.agents[i] for i in np.argsort(surpluses.wei, kind='stable') if is_short[i]]
+
+surplus_screener = None
+
+class PoolQuoter:
+    """
+    The pool's queryBuy/querySell for every symbol it has parameters for,
+    worked out locally with the contract_math replica.
+
+    The pool's pricing parameters are private on chain, so this uses the
+    ones LinearLiquidityPool remembers passing to addSymbol. Everything else
+    the contract reads (feed price, free balance, collateral, the pool's
+    option token balances) comes in one batched read per block, and then
+    the whole book is quoted at once. Symbols we don't have parameters for
+    get None, so callers can fall back to asking the chain.
+    """
+
+    def __init__(self, linear_liquidity_pool, options_exchange, udl_feed, spread=POOL_SPREAD, reserve_ratio=POOL_RESERVE_RATIO):
+        self.linear_liquidity_pool = linear_liquidity_pool
+        self.options_exchange = options_exchange
+        self.udl_feed = udl_feed
+        self.spread = spread
+        self.reserve_ratio = reserve_ratio
+        self.__lock = threading.Lock()
+        # (block, {(op, symbol): (price, volume) or None})
+        self.__quotes = None
+
+    def key_of(self, symbol):
+        option_symbol = OptionSymbol.parse(symbol)
+        return (option_symbol.option_type, option_symbol.strike, option_symbol.maturity)
+
+    def refresh(self, agent):
+        """
+        Quote every symbol the pool has parameters for, unless we already
+        did at this block.
+        """
+
+        block = block_context.number
+        with self.__lock:
+            if self.__quotes is not None and self.__quotes[0] == block:
+                return self.__quotes[1]
+
+        pricing_parameters = self.linear_liquidity_pool.pricing_parameters
+        registry = self.options_exchange.registry
+        symbols = [x for x in self.linear_liquidity_pool.list_symbols(agent) if self.key_of(x) in pricing_parameters]
+        tokens = [registry.resolve(agent, x) for x in symbols]
+        # Without a token the contract's resolveToken fails, so there's nothing to quote
+        quoted = [(x, tk, pricing_parameters[self.key_of(x)]) for (x, tk) in zip(symbols, tokens) if tk is not None]
+
+        exchange = self.options_exchange.contract
+        pool_address = self.linear_liquidity_pool.contract.address
+        calls = [
+            (self.udl_feed, 'getLatestPrice', []),
+            (self.linear_liquidity_pool.contract, 'calcFreeBalance', []),
+            (exchange, 'balanceOf', [pool_address]),
+            (exchange, 'collateral', [pool_address]),
+        ]
+        for (x, tk, p) in quoted:
+            calls.extend([
+                (exchange, 'calcCollateral', [p.udl_feed, contract_math.VOLUME_BASE, p.option_type, p.strike, p.maturity]),
+                (exchange, 'calcIntrinsicValue', [p.udl_feed, p.option_type, p.strike, p.maturity]),
+                (tk.contract, 'writtenVolume', [pool_address]),
+                (tk.contract, 'balanceOf', [pool_address]),
+            ])
+        results = batch_call(calls, agent)
+        ((_, udl_price), free_balance, pool_balance, pool_collateral) = results[:4]
+        per_symbol = results[4:]
+
+        quotes = {}
+        if quoted:
+            book = PricingBook([p for (x, tk, p) in quoted])
+            now = block_context.timestamp
+            for op in [contract_math.BUY, contract_math.SELL]:
+                (price, volume, ok) = contract_math.query(
+                    book, op, udl_price, now, self.spread, self.reserve_ratio,
+                    per_symbol[0::4], per_symbol[1::4], per_symbol[2::4], per_symbol[3::4],
+                    free_balance, pool_balance, pool_collateral
+                )
+                for (i, (x, tk, p)) in enumerate(quoted):
+                    quotes[(op, x)] = (int(price[i]), int(volume[i])) if ok[i] else None
+
+        with self.__lock:
+            self.__quotes = (block, quotes)
+        return quotes
+
+    def quote(self, agent, symbol, op):
+        """
+        Get (price, volume) like queryBuy (op=BUY) or querySell (op=SELL)
+        would, or None if we can't say locally.
+
+        Raises ValueError where the contract call would revert.
+        """
+
+        if self.key_of(symbol) not in self.linear_liquidity_pool.pricing_parameters:
+            return None
+        quotes = self.refresh(agent)
+        if (op, symbol) not in quotes:
+            return None
+        if quotes[(op, symbol)] is None:
+            raise ValueError("{} {} would revert".format('queryBuy' if op == contract_math.BUY else 'querySell', symbol))
+        return quotes[(op, symbol)]
+
+    def check(self, agent):
+        """
+        Compare every local quote with what the pool says, and log the ones
+        that differ. Returns how many did.
+        """
+
+        quotes = self.refresh(agent)
+        caller = self.linear_liquidity_pool.contract.caller({'from' : agent.address, 'gas': 80000000})
+        mismatches = 0
+        for (op, symbol) in sorted(quotes.keys()):
+            fn_name = 'queryBuy' if op == contract_math.BUY else 'querySell'
+            try:
+                chain_quote = tuple(getattr(caller, fn_name)(symbol))
+            except Exception as inst:
+                # Reverted, same as a None quote
+                chain_quote = None
+            if chain_quote != quotes[(op, symbol)]:
+                mismatches += 1
+                logger.info({"action": "check quote", "function": fn_name, "symbol": symbol, "local": quotes[(op, symbol)], "chain": chain_quote})
+        return mismatches
+
+pool_quoter = None
+
+class CollateralQuoter:
+    """
+    OptionsExchange.calcCollateral for any options and volumes, worked out
+    locally with the contract_math port.
+
+    The feed's latest price and timestamp are read once per block, and the
+    vol comes from the model (its feed replica when it can). Options that
+    have matured are valued at the feed's price at maturity, which isn't
+    kept here, so asking about those gets None and callers ask the chain.
+    """
+
+    def __init__(self, udl_feed, daily_volatility):
+        self.udl_feed = udl_feed
+        self.daily_volatility = daily_volatility
+        self.__lock = threading.Lock()
+        # (block, (feed timestamp, feed price, vol))
+        self.__feed_state = None
+
+    def feed_state(self, agent):
+        block = block_context.number
+        with self.__lock:
+            if self.__feed_state is not None and self.__feed_state[0] == block:
+                return self.__feed_state[1]
+
+        ((timestamp, price),) = batch_call([(self.udl_feed, 'getLatestPrice', [])], agent)
+        state = (timestamp, price, self.daily_volatility(agent))
+        with self.__lock:
+            self.__feed_state = (block, state)
+        return state
+
+    def calc_collateral(self, agent, option_type, strike, maturity, volume):
+        """
+        Get calcCollateral in wei for every option and volume (they broadcast
+        against each other, see contract_math.calc_collateral), or None if
+        we can't say locally.
+
+        Raises ValueError where the contract call would revert.
+        """
+
+        if (np.asarray(maturity, dtype=object) <= block_context.timestamp).any():
+            return None
+        (now, udl_price, vol) = self.feed_state(agent)
+        (coll, ok) = contract_math.calc_collateral(option_type, strike, maturity, volume, udl_price, now, vol)
+        if not ok.all():
+            raise ValueError("calcCollateral would revert")
+        return coll
+
+    def max_volume(self, agent, option_type, strike, maturity, surplus):
+        """
+        Get the largest volume in wei of every option whose calcCollateral
+        fits in surplus (wei), or None if we can't say locally.
+        """
+
+        if (np.asarray(maturity, dtype=object) <= block_context.timestamp).any():
+            return None
+        (now, udl_price, vol) = self.feed_state(agent)
+        return contract_math.max_volume(option_type, strike, maturity, surplus, udl_price, now, vol)
+
+collateral_quoter = None
+
 class OptionsExchange:
     def __init__(self, contract, usdt_token, btcusd_chainlink_feed, **kwargs):
         self.contract = contract
         self.usdt_token = usdt_token
         self.btcusd_chainlink_feed = btcusd_chainlink_feed
         self.option_tokens = {}
+        self.registry = OptionTokenRegistry(self)
 
     def balance(self, agent):
         bal = self.contract.caller({'from' : agent.address, 'gas': 100000}).balanceOf(agent.address)
@@ -851,6 +2850,17 @@ class OptionsExchange:
         );
         '''
 
+        if collateral_quoter is not None and feed_address == collateral_quoter.udl_feed.address:
+            cc = collateral_quoter.calc_collateral(
+                agent,
+                0 if option_type == 'CALL' else 1,
+                strike_price,
+                maturity,
+                Balance.from_tokens(amount, EXCHG['decimals']).to_wei()
+            )
+            if cc is not None:
+                return Balance(int(cc[0]), EXCHG['decimals'])
+
         cc = self.contract.caller({'from' : agent.address, 'gas': 8000000}).calcCollateral(
             feed_address,
             Balance.from_tokens(amount, EXCHG['decimals']).to_wei(),
@@ -936,6 +2946,8 @@ class OptionsExchange:
             ),
             8000000
         )
+        if surplus_screener is not None:
+            surplus_screener.track(tx, owner_address)
         return tx
 
     def get_total_short_collateral_exposure(self, agent):
@@ -952,42 +2964,32 @@ class OptionsExchange:
             - loop over all options tokens and get (for total written)
                 - totalWrittenVolume()
         '''
-        tw = 0
-        for k, ot in self.option_tokens.items():
-            tw += ot.contract.caller({'from' : agent.address, 'gas': 100000}).totalWrittenVolume()
-        return tw
+        return sum(batch_call([(ot.contract, 'totalWrittenVolume', []) for ot in self.option_tokens.values()], agent, 100000))
 
     def get_total_holding(self, agent):
         '''
             - loop over all options tokens and get (for total holding)
                 - totalSupply()
         '''
-        th = 0
-        for k, ot in self.option_tokens.items():
-            th += ot.contract.caller({'from' : agent.address, 'gas': 100000}).totalSupply()
-        return th
+        return sum(batch_call([(ot.contract, 'totalSupply', []) for ot in self.option_tokens.values()], agent, 100000))
 
     def get_total_owner_written(self, agent):
         '''
             - loop over all options tokens and get (for written)
                 - writtenVolume(address owner)
         '''
-        ow = 0
-        for k, ot in self.option_tokens.items():
-            ow += ot.contract.caller({'from' : agent.address, 'gas': 8000000}).writtenVolume(agent.address)
-        return ow
+        return sum(batch_call([(ot.contract, 'writtenVolume', [agent.address]) for ot in self.option_tokens.values()], agent, 8000000))
 
     def get_total_owner_holding(self, agent):
         '''
             - loop over all options tokens and get (for holding)
                 - balanceOf(address owner)
         '''
-        oh = 0
-        for k, ot in self.option_tokens.items():
-            oh += ot.contract.caller({'from' : agent.address, 'gas': 8000000}).balanceOf(agent.address)
-        return oh
+        return sum(batch_call([(ot.contract, 'balanceOf', [agent.address]) for ot in self.option_tokens.values()], agent, 8000000))
 
     def calc_collateral_surplus(self, checker, agent):
+        if surplus_screener is not None:
+            return surplus_screener.surplus(checker, agent)
         cs = self.contract.caller({'from' : checker.address, 'gas': 8000000}).calcSurplus(agent.address)
         return Balance(cs, EXCHG['decimals'])
 
@@ -1005,9 +3007,8 @@ class OptionsExchange:
             ),
             8000000
         )
-        txr_recp = w3.eth.waitForTransactionReceipt(txr, poll_latency=tx_pool_latency, timeout=600)
-        print("prefetchDailyPrice", txr_recp)
         
+        # Same sender, so these mine in order; confirm them together
         txv = transaction_helper(
             agent,
             self.btcusd_chainlink_feed.functions.prefetchDailyVolatility(
@@ -1015,8 +3016,12 @@ class OptionsExchange:
             ),
             8000000
         )
-        txv_recp = w3.eth.waitForTransactionReceipt(txv, poll_latency=tx_pool_latency, timeout=600)
-        print("prefetchDailyVolatility", txr_recp)
+        (txr_recp, txv_recp) = wait_for_receipts([txr, txv], timeout=600)
+        print("prefetchDailyPrice", txr_recp)
+        print("prefetchDailyVolatility", txv_recp)
+        if surplus_screener is not None:
+            surplus_screener.invalidate_all()
+        return (txr_recp, txv_recp)
 
     def prefetch_sample(self, agent):
         txr = transaction_helper(
@@ -1024,7 +3029,10 @@ class OptionsExchange:
             self.btcusd_chainlink_feed.functions.prefetchSample(),
             8000000
         )
-        txv_recp = w3.eth.waitForTransactionReceipt(txr, poll_latency=tx_pool_latency, timeout=600)
+        txv_recp = wait_for_receipt(txr, timeout=600)
+        if surplus_screener is not None:
+            surplus_screener.invalidate_all()
+        return txv_recp
 
 class CreditProvider:
     def __init__(self, contract, **kwargs):
@@ -1052,6 +3060,11 @@ class LinearLiquidityPool(TokenProxy):
     def __init__(self, contract, usdt_token, options_exchange, **kwargs):
         self.usdt_token = usdt_token
         self.options_exchange = options_exchange
+        # (block, symbols) from the last listSymbols
+        self.__listed_symbols = None
+        self.__seeded_expired = False
+        # This maps from (option type, strike, maturity) to the PricingParameters we last set for it
+        self.pricing_parameters = {}
         super().__init__(contract)
 
     def deposit_pool(self, agent, amount):
@@ -1085,6 +3098,36 @@ class LinearLiquidityPool(TokenProxy):
         )
         return tx
 
+    def remember_parameters(self, tx, option_type, params):
+        """
+        Keep the symbol's pricing parameters for local quotes once the addSymbol goes through.
+        """
+
+        key = (option_type, params.strike, params.maturity)
+        when_mined(tx, lambda receipt: self.pricing_parameters.__setitem__(key, params) if receipt['status'] == 1 else None)
+
+    def quote_buy(self, agent, symbol):
+        """
+        Get (price, volume) like queryBuy, locally when we can.
+        """
+
+        if pool_quoter is not None:
+            price_volume = pool_quoter.quote(agent, symbol, contract_math.BUY)
+            if price_volume is not None:
+                return price_volume
+        return self.query_buy(agent, symbol)
+
+    def quote_sell(self, agent, symbol):
+        """
+        Get (price, volume) like querySell, locally when we can.
+        """
+
+        if pool_quoter is not None:
+            price_volume = pool_quoter.quote(agent, symbol, contract_math.SELL)
+            if price_volume is not None:
+                return price_volume
+        return self.query_sell(agent, symbol)
+
     def query_buy(self, agent, symbol):
         print(symbol)
         price_volume = self.contract.caller({'from' : agent.address, 'gas': 80000000}).queryBuy(symbol)
@@ -1125,7 +3168,7 @@ class LinearLiquidityPool(TokenProxy):
             ),
             8000000
         )
-        w3.eth.waitForTransactionReceipt(txc, poll_latency=tx_pool_latency)
+        wait_for_receipt(txc)
         '''
 
         option_token.ensure_approved(agent, self.contract.address)
@@ -1144,8 +3187,11 @@ class LinearLiquidityPool(TokenProxy):
         EXTRACT TIMESTAMP FROM SYMBOL AND FILTER ON IF BEFORE OR AFTER CURRENT BLOCK TIMESTAMP
     '''
     def list_symbols(self, agent):
-        symbols = self.contract.caller({'from' : agent.address, 'gas': 8000000}).listSymbols().split('\n')
-        return [x for x in list(filter(None,symbols)) if x != '']
+        # The pool's symbols only change with a new block
+        if self.__listed_symbols is None or self.__listed_symbols[0] != block_context.number:
+            symbols = self.contract.caller({'from' : agent.address, 'gas': 8000000}).listSymbols().split('\n')
+            self.__listed_symbols = (block_context.number, [x for x in list(filter(None,symbols)) if x != ''])
+        return list(self.__listed_symbols[1])
 
     '''
         EXTRACT TIMESTAMP FROM SYMBOL AND FILTER ON IF BEFORE OR AFTER CURRENT BLOCK TIMESTAMP
@@ -1155,26 +3201,19 @@ class LinearLiquidityPool(TokenProxy):
         return [x for x in list(filter(None,symbols)) if x != '']
 
     def get_option_tokens(self, agent):
-        symbols = self.list_symbols(agent)
-        option_tokens = []
-        for sym in symbols:
-            option_token_address = self.options_exchange.resolve_token(agent, sym)
-            if option_token_address:
-                option_token = TokenProxy(w3.eth.contract(abi=OptionTokenContract['abi'], address=option_token_address))
-                option_tokens.append(option_token)
-
-        return option_tokens
+        registry = self.options_exchange.registry
+        option_tokens = registry.resolve_all(agent, self.list_symbols(agent))
+        registry.expire(block_context.timestamp)
+        return [x for x in option_tokens if registry.by_address[x.address] in registry.live]
 
     def get_option_tokens_expired(self, agent):
-        symbols = self.list_expired_symbols(agent)
-        option_tokens = []
-        for sym in symbols:
-            option_token_address = self.options_exchange.resolve_token(agent, sym)
-            if option_token_address:
-                option_token = TokenProxy(w3.eth.contract(abi=OptionTokenContract['abi'], address=option_token_address))
-                option_tokens.append(option_token)
-
-        return option_tokens
+        registry = self.options_exchange.registry
+        if not self.__seeded_expired:
+            # Pick up whatever expired before this run once; after that maturities say what expired
+            registry.resolve_all(agent, self.list_expired_symbols(agent))
+            self.__seeded_expired = True
+        registry.expire(block_context.timestamp)
+        return registry.expired_tokens()
 
     def add_symbol(self, agent, udlfeed_address, strike, maturity, option_type, current_timestamp, x, y, buyStock, sellStock):
         '''
@@ -1191,22 +3230,24 @@ class LinearLiquidityPool(TokenProxy):
                 200 * volumeBase  // sell stock
             );
         '''
+        params = PricingParameters(
+            udlfeed_address,
+            contract_math.CALL if option_type == 'CALL' else contract_math.PUT,
+            strike * (10**EXCHG['decimals']),
+            maturity,
+            current_timestamp,
+            current_timestamp + (60 * 60 * 24 * 2),
+            buyStock * 10**EXCHG['decimals'],
+            sellStock * 10**EXCHG['decimals'],
+            x,
+            y
+        )
         tx = transaction_helper(
             agent,
-            self.contract.functions.addSymbol(
-                udlfeed_address,
-                strike * (10**EXCHG['decimals']),
-                maturity,
-                0 if option_type == 'CALL' else 1,
-                current_timestamp,
-                current_timestamp + (60 * 60 * 24 * 2),
-                x,
-                y,
-                buyStock * 10**EXCHG['decimals'],
-                sellStock * 10**EXCHG['decimals']
-            ),
+            self.contract.functions.addSymbol(*params.add_symbol_args()),
             8000000
         )
+        self.remember_parameters(tx, option_type, params)
         return tx
 
     def update_symbol(self, agent, udlfeed_address, strike, maturity, option_type, current_timestamp, x, y, buyStock, sellStock):
@@ -1224,22 +3265,24 @@ class LinearLiquidityPool(TokenProxy):
                 200 * volumeBase  // sell stock
             );
         '''
+        params = PricingParameters(
+            udlfeed_address,
+            contract_math.CALL if option_type == 'CALL' else contract_math.PUT,
+            strike * (10**EXCHG['decimals']),
+            maturity,
+            current_timestamp,
+            current_timestamp + (60 * 60 * 24 * 2),
+            buyStock * (10**EXCHG['decimals']),
+            sellStock * (10**EXCHG['decimals']),
+            x,
+            y
+        )
         tx = transaction_helper(
             agent,
-            self.contract.functions.addSymbol(
-                udlfeed_address,
-                strike * (10**EXCHG['decimals']),
-                maturity,
-                0 if option_type == 'CALL' else 1,
-                current_timestamp,
-                current_timestamp + (60 * 60 * 24 * 2),
-                x,
-                y,
-                buyStock * (10**EXCHG['decimals']),
-                sellStock * (10**EXCHG['decimals'])
-            ),
+            self.contract.functions.addSymbol(*params.add_symbol_args()),
             8000000
         )
+        self.remember_parameters(tx, option_type, params)
         return tx
 
     def pool_free_balance(self, agent):
@@ -1251,9 +3294,16 @@ class Model:
     Full model of the economy.
     """
     
-    def __init__(self, options_exchange, credit_provider, linear_liquidity_pool, btcusd_chainlink_feed, btcusd_agg, btcusd_data, xsd, usdt, agents, **kwargs):
+    CHECKPOINT_MAGIC = b'AVXMODEL'
+    CHECKPOINT_VERSION = 2
+    CHECKPOINT_HEADER = struct.Struct('<8sI')
+
+    def __init__(self, options_exchange, credit_provider, linear_liquidity_pool, btcusd_chainlink_feed, btcusd_agg, btcusd_data, xsd, usdt, agents, checkpoint_path=None, **kwargs):
         """
         Takes in experiment parameters and forwards them on to all components.
+
+        If checkpoint_path is set, pick up where that checkpoint left off
+        instead of initializing the feed.
         """
 
         self.agents = []
@@ -1265,7 +3315,8 @@ class Model:
         self.btcusd_data = btcusd_data
         self.btcusd_data_init_bins = 30
         self.current_round_id = 30
-        self.daily_vol_period = 30
+        # Days of the feed's vol window; main sets the exchange's volatility period from the same constant
+        self.daily_vol_period = VOLATILITY_PERIOD_DAYS
         self.prev_timestamp = 0
         self.daily_period = 60 * 60 * 24
         self.weekly_period = self.daily_period * 7
@@ -1276,9 +3327,11 @@ class Model:
         self.option_tokens_expired_to_burn = {}
         self.usdt_token = usdt
         self.symbol_created = {}
+        # What the feed has been fed, so its vol can be worked out without asking it
+        self.feed_replica = ChainlinkFeedReplica(BTCUSDAgg['decimals'], BTCUSDc['offset'])
 
         is_mint = is_try_model_mine
-        if w3.eth.get_block('latest')["number"] == block_offset:
+        if block_context.number == block_offset:
             # THIS ONLY NEEDS TO BE RUN ON NEW CONTRACTS
             # TODO: tolerate redeployment or time-based generation
             is_mint = True
@@ -1291,6 +3344,19 @@ class Model:
              
             self.agents.append(agent)
 
+        self.snapshot_id = None
+        if checkpoint_path is not None:
+            self.load(checkpoint_path)
+
+        # Approve everything the agents will need up front, all in one go
+        approval_store.approve(
+            [(usdt, a, self.options_exchange.contract.address) for a in self.agents] +
+            [(usdt, a, self.linear_liquidity_pool.contract.address) for a in self.agents]
+        )
+        # And approve the pool for option tokens as soon as they show up, without waiting
+        self.options_exchange.registry.on_new_tokens.append(
+            lambda tokens: approval_store.approve([(ot, a, self.linear_liquidity_pool.contract.address) for ot in tokens for a in self.agents], wait=False)
+        )
 
         is_print_agent_state = False
 
@@ -1317,7 +3383,7 @@ class Model:
         '''
 
         if self.prev_timestamp == 0:
-            current_timestamp = w3.eth.get_block('latest')['timestamp']
+            current_timestamp = block_context.timestamp
             seleted_advancer = self.agents[0]
             transaction_helper(
                 seleted_advancer,
@@ -1330,7 +3396,7 @@ class Model:
             transaction_helper(
                 seleted_advancer,
                 self.btcusd_agg.functions.setAnswers(
-                    self.btcusd_data[:self.btcusd_data_init_bins]
+                    self.btcusd_data[:self.btcusd_data_init_bins].tolist()
                 ),
                 500000
             )
@@ -1345,20 +3411,120 @@ class Model:
             )
 
             print(timestamps)
-            print(self.btcusd_data[:self.btcusd_data_init_bins])
+            print(self.btcusd_data[:self.btcusd_data_init_bins].tolist())
 
             tx = transaction_helper(
                 seleted_advancer,
                 self.btcusd_chainlink_feed.functions.initialize(
                     timestamps,
-                    self.btcusd_data[:self.btcusd_data_init_bins]
+                    self.btcusd_data[:self.btcusd_data_init_bins].tolist()
                 ),
                 8000000
             )
-            receipt = w3.eth.waitForTransactionReceipt(tx, poll_latency=tx_pool_latency, timeout=600)
+            receipt = wait_for_receipt(tx, timeout=600)
             print(receipt)
+            # If the feed was initialized before, this reverts and the replica stays empty
+            if receipt["status"] == 1:
+                self.feed_replica.initialize(timestamps, self.btcusd_data[:self.btcusd_data_init_bins].tolist())
 
         
+    def daily_volatility(self, agent):
+        """
+        Get the feed's getDailyVolatility over daily_vol_period, from the
+        replica if it has everything the feed has been fed.
+        """
+
+        timespan = self.daily_vol_period * self.daily_period
+        if self.feed_replica.is_initialized():
+            return self.feed_replica.daily_volatility(timespan, block_context.timestamp)
+        return self.btcusd_chainlink_feed.caller({'from' : agent.address, 'gas': 8000000}).getDailyVolatility(timespan)
+
+    @classmethod
+    def read_checkpoint(cls, path):
+        """
+        Read the state dict out of a checkpoint file written by save().
+        """
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        (magic, version) = cls.CHECKPOINT_HEADER.unpack_from(data)
+        if magic != cls.CHECKPOINT_MAGIC or version != cls.CHECKPOINT_VERSION:
+            raise ValueError("Unsupported model checkpoint in {}".format(path))
+        return pickle.loads(zlib.decompress(data[cls.CHECKPOINT_HEADER.size:]))
+
+    def save(self, path, snapshot_id=None):
+        """
+        Write everything needed to resume the model to a checkpoint file.
+
+        snapshot_id is the chain-side snapshot the checkpoint goes with. The
+        file is a short header and a compressed pickle of plain values, and
+        is written to the side and moved into place so a crash can't leave
+        half a checkpoint.
+        """
+
+        registry = self.options_exchange.registry
+        state = {
+            'prev_timestamp': self.prev_timestamp,
+            'current_round_id': self.current_round_id,
+            'snapshot_id': snapshot_id,
+            # Reverting to the snapshot should land back on this block
+            'block_number': block_context.number,
+            'by_symbol': dict(registry.by_symbol),
+            'expired': sorted(registry.expired),
+            'option_tokens': list(self.option_tokens.keys()),
+            'option_tokens_expired': list(self.option_tokens_expired.keys()),
+            'option_tokens_expired_to_burn': list(self.option_tokens_expired_to_burn.keys()),
+            'symbol_created': dict(self.symbol_created),
+            'pricing_parameters': [(key, params.to_tuple()) for (key, params) in self.linear_liquidity_pool.pricing_parameters.items()],
+            'feed': self.feed_replica.state(),
+            'nonces': {a.address: nonce_table.peek(a.address) for a in self.agents},
+            'approvals': sorted(approval_store.approved),
+            'random_state': random.getstate(),
+        }
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.CHECKPOINT_HEADER.pack(self.CHECKPOINT_MAGIC, self.CHECKPOINT_VERSION))
+            f.write(zlib.compress(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)))
+        os.replace(tmp_path, path)
+        self.snapshot_id = snapshot_id
+
+    def load(self, path):
+        """
+        Restore the model from a checkpoint file written by save().
+
+        The chain should already be back at the checkpoint's snapshot.
+        """
+
+        state = Model.read_checkpoint(path)
+        self.prev_timestamp = state['prev_timestamp']
+        self.current_round_id = state['current_round_id']
+        self.snapshot_id = state['snapshot_id']
+        self.symbol_created = state['symbol_created']
+        self.linear_liquidity_pool.pricing_parameters = {key: PricingParameters(*params) for (key, params) in state['pricing_parameters']}
+        self.feed_replica.restore(state['feed'])
+
+        registry = self.options_exchange.registry
+        registry.restore(state['by_symbol'], set(state['expired']))
+        self.option_tokens = {address: registry.proxies[address] for address in state['option_tokens']}
+        self.option_tokens_expired = {address: registry.proxies[address] for address in state['option_tokens_expired']}
+        self.option_tokens_expired_to_burn = {address: registry.proxies[address] for address in state['option_tokens_expired_to_burn']}
+        self.options_exchange.option_tokens = self.option_tokens
+
+        # The chain after the revert is the truth: anything unmined at snapshot time (a wait=False
+        # approval, say) is gone, and a saved nonce past it would stall the agent. Saved ones are just for the log.
+        for a in self.agents:
+            tx_count = w3.eth.getTransactionCount(a.address, 'pending')
+            nonce_table.set(a.address, tx_count)
+            a.next_tx_count = tx_count
+            if state['nonces'].get(a.address) not in (None, tx_count):
+                logger.info({"action": "load", "agent": a.address, "saved_nonce": state['nonces'][a.address], "chain_nonce": tx_count})
+
+        approval_store.reset(state['approvals'])
+        random.setstate(state['random_state'])
+
+        logger.info({"action": "load", "checkpoint": path, "prev_timestamp": self.prev_timestamp, "current_round_id": self.current_round_id, "tokens": len(registry.proxies)})
+
     def log(self, stream, seleted_advancer, header=False):
         """
         Log model statistics a TSV line.
@@ -1369,7 +3535,7 @@ class Model:
             stream.write("#block\twritten\tholding\texposure\ttotal CB\ttotal SB\ttotal debt\n")#\tfaith\n")
         
         print(
-            w3.eth.get_block('latest')["number"],
+            block_context.number,
             self.options_exchange.get_total_written(seleted_advancer),
             self.options_exchange.get_total_holding(seleted_advancer),
             self.options_exchange.get_total_short_collateral_exposure(seleted_advancer),
@@ -1379,7 +3545,7 @@ class Model:
         )
         
         stream.write('{}\t{}\t{}\t{:.2f}\t{:.2f}\t{:.2f}\t{:.2f}\n'.format(
-                w3.eth.get_block('latest')["number"],
+                block_context.number,
                 self.options_exchange.get_total_written(seleted_advancer),
                 self.options_exchange.get_total_holding(seleted_advancer),
                 self.options_exchange.get_total_short_collateral_exposure(seleted_advancer),
@@ -1422,8 +3588,10 @@ class Model:
         # Update caches to current chain state for all the tokens
         self.usdt_token.update()
         self.linear_liquidity_pool.update()
+        if position_ledger is not None:
+            position_ledger.check()
 
-        current_timestamp = w3.eth.get_block('latest')['timestamp']
+        current_timestamp = block_context.timestamp
         diff_timestamp = current_timestamp - self.prev_timestamp
 
         '''
@@ -1460,6 +3628,8 @@ class Model:
                 del self.option_tokens[x.address]
 
         self.options_exchange.option_tokens = self.option_tokens
+        if position_ledger is not None:
+            position_ledger.tokens.update(self.option_tokens.keys())
 
         '''
             UPDATE FEEDS WHEN LASTEST DAY PASSESS
@@ -1473,37 +3643,52 @@ class Model:
                 # increment round id
                 self.current_round_id += 1
 
-            tx = transaction_helper(
+            feed_txs = []
+            feed_txs.append(transaction_helper(
                 seleted_advancer,
                 self.btcusd_agg.functions.appendRoundId(
                     self.current_round_id
                 ),
                 500000
-            )
-            receipt = w3.eth.waitForTransactionReceipt(tx, poll_latency=tx_pool_latency, timeout=600)
-            print("appendRoundId:", receipt)
+            ))
 
-            tx = transaction_helper(
+            feed_txs.append(transaction_helper(
                 seleted_advancer,
                 self.btcusd_agg.functions.appendAnswer(
-                    self.btcusd_data[self.current_round_id]
+                    int(self.btcusd_data[self.current_round_id])
                 ),
                 500000
-            )
-            receipt = w3.eth.waitForTransactionReceipt(tx, poll_latency=tx_pool_latency, timeout=600)
-            print("appendAnswer:", receipt)
+            ))
 
-            tx = transaction_helper(
+            feed_txs.append(transaction_helper(
                 seleted_advancer,
                 self.btcusd_agg.functions.appendUpdatedAt(
                     current_timestamp
                 ),
                 500000
-            )
-            receipt = w3.eth.waitForTransactionReceipt(tx, poll_latency=tx_pool_latency, timeout=600)
-            print("appendUpdatedAt:", receipt)
-
-            self.options_exchange.prefetch_daily(seleted_advancer, self.current_round_id, self.daily_vol_period * self.daily_period)
+            ))
+            receipts = wait_for_receipts(feed_txs, timeout=600)
+            print("appendRoundId:", receipts[0])
+            print("appendAnswer:", receipts[1])
+            print("appendUpdatedAt:", receipts[2])
+
+            (price_receipt, vol_receipt) = self.options_exchange.prefetch_daily(seleted_advancer, self.current_round_id, self.daily_vol_period * self.daily_period)
+            if self.feed_replica.is_initialized():
+                try:
+                    if price_receipt["status"] == 1:
+                        self.feed_replica.prefetch_daily_price(current_timestamp, int(self.btcusd_data[self.current_round_id]))
+                    if vol_receipt["status"] == 1:
+                        timespan = self.daily_vol_period * self.daily_period
+                        self.feed_replica.prefetch_daily_volatility(timespan, block_context.timestamp)
+                        # Check it against the feed once a day, so a drift is caught here and not in every quote after
+                        expected = self.btcusd_chainlink_feed.caller({'from' : seleted_advancer.address, 'gas': 8000000}).getDailyVolatility(timespan)
+                        got = self.feed_replica.daily_volatility(timespan, block_context.timestamp)
+                        if got != expected:
+                            raise ValueError("daily volatility {} disagrees with the feed's {}".format(got, expected))
+                except ValueError as inst:
+                    # Out of step with the feed, so stop trusting it
+                    logger.info({"action": "feed replica", "error": str(inst)})
+                    self.feed_replica = ChainlinkFeedReplica(BTCUSDAgg['decimals'], BTCUSDc['offset'])
 
 
             '''
@@ -1519,108 +3704,93 @@ class Model:
                 }
             '''
             maturity = None
-            with open('mcmc_symbol_params.json', 'w+') as f:
-                mcmc_data = {}
-                for sym in available_symbols:
-                    print('update symbol param file:', sym)
-                    sym_parts = sym.split('-')
-
-                    strike = int(float(sym_parts[2]) / 10**EXCHG['decimals'])
-                    maturity = int(sym_parts[3])
-                    
-                    option_type = 'PUT' if sym_parts[1] == 'EP' else 'CALL'
-                    current_price = self.btcusd_data[self.current_round_id] / (10.**BTCUSDAgg['decimals'])
+            mcmc_data = {}
+            for sym in available_symbols:
+                print('update symbol param file:', sym)
+                option_symbol = OptionSymbol.parse(sym)
 
-                    if sym_parts[0] in mcmc_data:
-                        # just append new strike data
-                        mcmc_data[sym_parts[0]]["data"].append({
-                            "strike": strike, 
-                            "option_type": option_type,
-                            "symbol": sym
-                        })
-                    else:
-                        # need to calc feed vol
-                        # NEED TO MAKE SURE THAT THE DECIMALS ARE CORRECT WHEN NORMING VOL
-                        try:
-                            vol = self.btcusd_chainlink_feed.caller({'from' : random_advancer.address, 'gas': 8000000}).getDailyVolatility(
-                                self.daily_vol_period * self.daily_period
-                            )
-                        except Exception as inst:
-                            print(inst, "bad vol calc")
-                            continue
+                strike = option_symbol.strike // 10**EXCHG['decimals']
+                maturity = option_symbol.maturity
+                
+                option_type = option_symbol.option_type
+                current_price = self.btcusd_data[self.current_round_id] / (10.**BTCUSDAgg['decimals'])
+
+                if option_symbol.underlying in mcmc_data:
+                    # just append new strike data
+                    mcmc_data[option_symbol.underlying]["data"].append({
+                        "strike": strike, 
+                        "option_type": option_type,
+                        "symbol": sym
+                    })
+                else:
+                    # need to calc feed vol
+                    # NEED TO MAKE SURE THAT THE DECIMALS ARE CORRECT WHEN NORMING VOL
+                    try:
+                        vol = self.daily_volatility(random_advancer)
+                    except Exception as inst:
+                        print(inst, "bad vol calc")
+                        continue
 
-                        multiplier = 3.0
-                        tvol = (vol / (10.**EXCHG['decimals']))
-                        normed_vol = math.log((current_price + (tvol * multiplier)) / (current_price - (tvol * multiplier)))
+                    normed_vol = contract_math.normalized_vol(vol, current_price, decimals=EXCHG['decimals'])
 
-                        mcmc_data[sym_parts[0]] = {}
-                        mcmc_data[sym_parts[0]]["curr_price"] = current_price
-                        mcmc_data[sym_parts[0]]["vol"] = normed_vol
-                        mcmc_data[sym_parts[0]]["data"] = [{
-                            "strike": strike, 
-                            "option_type": option_type,
-                            "symbol": sym
-                        }]
+                    mcmc_data[option_symbol.underlying] = {}
+                    mcmc_data[option_symbol.underlying]["curr_price"] = current_price
+                    mcmc_data[option_symbol.underlying]["vol"] = normed_vol
+                    mcmc_data[option_symbol.underlying]["data"] = [{
+                        "strike": strike, 
+                        "option_type": option_type,
+                        "symbol": sym
+                    }]
 
-                f.write(json.dumps(mcmc_data, indent=4))
 
 
             
 
             if maturity != None:
                 '''
-                    EXECUTE MODEL HERE FOR ALL DATA
-                    EXAMPLE: ./op_model "2000" "0.2" "3.0"
+                    PRICE ALL THE SYMBOLS AT ONCE
                 '''
                 days_until_expiry = (maturity - current_timestamp) / self.daily_period
                 months_to_exp = days_until_expiry / (self.days_per_year / 12.0)
                 num_samples = 2000
-
-                cmd = './op_model "%s" "%s" "%s"' % (
-                    num_samples,
-                    0.05,
-                    months_to_exp,
-                )
-                model_ret = str(execute_cmd(cmd))
-
+                mcmc_symbol_computation = pricing_backend.curves(mcmc_data, months_to_exp, num_samples)
+                if isinstance(pricing_backend, CachedPricingBackend):
+                    logger.info(dict(action="pricing cache", **pricing_backend.stats()))
 
                 '''
-                    LOAD IN FILE AND MAP DATA TO PAIR
+                    MAP DATA TO PAIR
                 '''
-                with open('mcmc_symbol_computation.json', 'r+') as f:
-                    mcmc_symbol_computation = json.loads(f.read())
-                    if mcmc_symbol_computation:
-                        for sym in available_symbols:
-                            print('update symbol:', sym)
-                            sym_parts = sym.split('-')
+                sym_upd8_txs = []
+                if mcmc_symbol_computation:
+                    for sym in available_symbols:
+                        print('update symbol:', sym)
+                        option_symbol = OptionSymbol.parse(sym)
 
-                            if (sym in mcmc_symbol_computation) and mcmc_symbol_computation[sym]:
-                                x0s = mcmc_symbol_computation[sym]['x']
-                                if len(x0s) == 0:
-                                    continue
+                        if (sym in mcmc_symbol_computation) and mcmc_symbol_computation[sym]:
+                            x0s = mcmc_symbol_computation[sym]['x']
+                            if len(x0s) == 0:
+                                continue
 
-                                try:
-                                    x = [Balance.from_tokens(round(x0,4), EXCHG['decimals']).to_wei() for x0 in x0s]
-                                    y = mcmc_symbol_computation[sym]['y0'] + mcmc_symbol_computation[sym]['y1']
-                                    y  = [Balance.from_tokens(round(y0,4), EXCHG['decimals']).to_wei() for y0 in y]
-                                    print(x)
-                                    print(y)
-                                except Exception as inst:
-                                    print(inst, "no timestamp data to update")
-                                    x = [0, 0]
-                                    y = [0, 0, 0, 0]
+                            try:
+                                x = [Balance.from_tokens(round(x0,4), EXCHG['decimals']).to_wei() for x0 in x0s]
+                                y = mcmc_symbol_computation[sym]['y0'] + mcmc_symbol_computation[sym]['y1']
+                                y  = [Balance.from_tokens(round(y0,4), EXCHG['decimals']).to_wei() for y0 in y]
+                                print(x)
+                                print(y)
+                            except Exception as inst:
+                                print(inst, "no timestamp data to update")
+                                x = [0, 0]
+                                y = [0, 0, 0, 0]
+
+                            strike = option_symbol.strike // 10**EXCHG['decimals']
+                            option_type = option_symbol.option_type
+                            current_timestamp = block_context.timestamp
+                            sym_upd8_txs.append(self.linear_liquidity_pool.update_symbol(seleted_advancer, self.btcusd_chainlink_feed.address, strike, option_symbol.maturity, option_type, current_timestamp, x, y, buyStock, sellStock))
 
-                                strike = int(float(sym_parts[2]) / 10**EXCHG['decimals'])
-                                option_type = 'PUT' if sym_parts[1] == 'EP' else 'CALL'
-                                current_timestamp = w3.eth.get_block('latest')['timestamp']
-                                sym_upd8_tx = self.linear_liquidity_pool.update_symbol(seleted_advancer, self.btcusd_chainlink_feed.address, strike, int(sym_parts[3]), option_type, current_timestamp, x, y, buyStock, sellStock)
-                                receipt = w3.eth.waitForTransactionReceipt(sym_upd8_tx, poll_latency=tx_pool_latency, timeout=600)
-                                print('update hash:', receipt)
+                for receipt in wait_for_receipts(sym_upd8_txs, timeout=600):
+                    print('update hash:', receipt)
 
             
-            '''
-                TODO: NEED TO DUMP TO FILE AND LOAD FROM FILE IN ORDER TO BE ABLE TO START AND STOP MORE ROBUSTLY SANS NUKING CONTRACTS
-            '''
             self.prev_timestamp = current_timestamp
 
             print("current prev_timestamp daily:", self.prev_timestamp)
@@ -1636,25 +3806,30 @@ class Model:
         any_short_collateral = []
         while True:
             try:
-                any_short_collateral = [a for a in self.agents if self.options_exchange.calc_collateral_surplus(random_advancer, a) <= 0]
+                if surplus_screener is not None:
+                    any_short_collateral = surplus_screener.short(random_advancer)
+                else:
+                    any_short_collateral = [a for a in self.agents if self.options_exchange.calc_collateral_surplus(random_advancer, a) <= 0]
                 break
             except Exception as inst:
                 print(inst, 'trying to pretetch sample')
-                self.options_exchange.prefetch_sample(random_advancer)
+                if self.options_exchange.prefetch_sample(random_advancer)["status"] == 1:
+                    # The replica doesn't follow intraday samples, so ask the feed from here on
+                    self.feed_replica = ChainlinkFeedReplica(BTCUSDAgg['decimals'], BTCUSDc['offset'])
                 break
 
         
         tx_hashes = []
         total_tx_submitted = 0
 
-        unique_available_symbols = list(set([asym.split('-')[1] for asym in available_symbols]))
+        unique_available_symbols = list(set([OptionSymbol.parse(asym).type_code for asym in available_symbols]))
         tks_list_symbols = [tv.symbol for tv in list(self.option_tokens.values())]
 
         pool_free_balance = self.linear_liquidity_pool.pool_free_balance(random_advancer)
         logger.info("pool_free_balance: {}".format(pool_free_balance))
 
-        any_calls = any([ts for ts in available_symbols if '-EC-' in ts])
-        any_puts = any([ts for ts in available_symbols if '-EP-' in ts])
+        any_calls = any([ts for ts in available_symbols if OptionSymbol.parse(ts).is_call])
+        any_puts = any([ts for ts in available_symbols if OptionSymbol.parse(ts).is_put])
 
         print("available_symbols:", available_symbols, len(available_symbols), len(tks_list_symbols))
         print((not any_calls or not any_puts))
@@ -1683,8 +3858,8 @@ class Model:
             #'''
             #TODO: NEED A BETTER WAY TO FIGURE THIS OUT FOR SYMBOLS THAT FAIL TO UPDATE/HAVE ANY POS TXs
             available_symbols = self.linear_liquidity_pool.list_symbols(seleted_advancer)
-            any_calls = [ts for ts in available_symbols if '-EC-' in ts]
-            any_puts = [ts for ts in available_symbols if '-EP-' in ts]
+            any_calls = [ts for ts in available_symbols if OptionSymbol.parse(ts).is_call]
+            any_puts = [ts for ts in available_symbols if OptionSymbol.parse(ts).is_put]
 
             if len(available_symbols) != len(self.option_tokens):
                 #TRY AND UPDATE OPTION TOKENS AVAILABLE
@@ -1773,7 +3948,7 @@ class Model:
                         
                 '''
         
-                strategy = a.get_strategy(w3.eth.get_block('latest')["number"])
+                strategy = a.get_strategy(block_context.number)
                 
                 weights = [strategy[o] for o in options]
                 
@@ -1802,7 +3977,7 @@ class Model:
                     TODO:
                         choose random maturity length less than the maturity of the pool? 1 month for now
                     """
-                    current_timestamp = w3.eth.get_block('latest')['timestamp']
+                    current_timestamp = block_context.timestamp
                     num_months = 6.0 # 1.0
                     maturity = int(current_timestamp + (self.daily_period * (self.days_per_year / self.months_per_year * num_months)))
                     days_until_expiry = (maturity - current_timestamp) / self.daily_period
@@ -1828,85 +4003,64 @@ class Model:
                             # if put, write OTM by random amount, to the downside
                             strike = round(current_price * (1 - moneyness))
 
-                    with open('mcmc_symbol_params.json', 'w+') as f:
-                        mcmc_data = {}
-                        # need to calc feed vol
-                        # NEED TO MAKE SURE THAT THE DECIMALS ARE CORRECT WHEN NORMING VOL
-                        try:
-                            vol = self.btcusd_chainlink_feed.caller({'from' : random_advancer.address, 'gas': 8000000}).getDailyVolatility(
-                                self.daily_vol_period * self.daily_period
-                            )
-                        except Exception as inst:
-                            print(inst, "bad vol calc")
-                            continue
-
-                        multiplier = 3.0
-                        tvol = (vol / (10.**EXCHG['decimals']))
-                        normed_vol = math.log((current_price + (tvol * multiplier)) / (current_price - (tvol * multiplier)))
-
-                        mcmc_data["pending"] = {}
-                        mcmc_data["pending"]["curr_price"] = self.btcusd_data[self.current_round_id] / (10.**BTCUSDAgg['decimals'])
-                        mcmc_data["pending"]["vol"] = normed_vol
-                        mcmc_data["pending"]["data"] = [{
-                            "strike": strike, 
-                            "option_type": option_type,
-                            "symbol": "pending"
-                        }]
+                    mcmc_data = {}
+                    # need to calc feed vol
+                    # NEED TO MAKE SURE THAT THE DECIMALS ARE CORRECT WHEN NORMING VOL
+                    try:
+                        vol = self.daily_volatility(random_advancer)
+                    except Exception as inst:
+                        print(inst, "bad vol calc")
+                        continue
 
-                        f.write(json.dumps(mcmc_data, indent=4))
+                    normed_vol = contract_math.normalized_vol(vol, current_price, decimals=EXCHG['decimals'])
 
-                    '''
-                        EXECUTE MODEL HERE FOR ALL DATA
-                    '''
+                    mcmc_data["pending"] = {}
+                    mcmc_data["pending"]["curr_price"] = self.btcusd_data[self.current_round_id] / (10.**BTCUSDAgg['decimals'])
+                    mcmc_data["pending"]["vol"] = normed_vol
+                    mcmc_data["pending"]["data"] = [{
+                        "strike": strike, 
+                        "option_type": option_type,
+                        "symbol": "pending"
+                    }]
 
                     '''
-                        EXAMPLE: ./op_model "2000" "0.2" "3.0"
+                        PRICE IT
                     '''
-                    cmd = './op_model "%s" "%s" "%s"' % (
-                        num_samples,
-                        0.05,
-                        months_to_exp,
-                    )
-                    model_ret = str(execute_cmd(cmd))
-
+                    mcmc_symbol_computation = pricing_backend.curves(mcmc_data, months_to_exp, num_samples)
 
                     '''
-                        LOAD IN FILE AND MAP DATA TO PAIR
+                        MAP DATA TO PAIR
                     '''
-                    with open('mcmc_symbol_computation.json', 'r+') as f:
-                        mcmc_symbol_computation = json.loads(f.read())
-                        if mcmc_symbol_computation:
-                            if mcmc_symbol_computation["pending"]:
-                                x0s = mcmc_symbol_computation["pending"]['x']
-                                if len(x0s) == 0:
-                                    continue
+                    if mcmc_symbol_computation:
+                        if mcmc_symbol_computation["pending"]:
+                            x0s = mcmc_symbol_computation["pending"]['x']
+                            if len(x0s) == 0:
+                                continue
 
-                                try:
-                                    x = [Balance.from_tokens(round(x0,4), EXCHG['decimals']).to_wei() for x0 in x0s]
-                                    y = mcmc_symbol_computation["pending"]['y0'] + mcmc_symbol_computation["pending"]['y1']
-                                    y  = [Balance.from_tokens(round(y0,4), EXCHG['decimals']).to_wei() for y0 in y]
-                                    print(x)
-                                    print(y)
-                                except Exception as inst:
-                                    print ('failed to add_symbol')
-                                    continue
+                            try:
+                                x = [Balance.from_tokens(round(x0,4), EXCHG['decimals']).to_wei() for x0 in x0s]
+                                y = mcmc_symbol_computation["pending"]['y0'] + mcmc_symbol_computation["pending"]['y1']
+                                y  = [Balance.from_tokens(round(y0,4), EXCHG['decimals']).to_wei() for y0 in y]
+                                print(x)
+                                print(y)
+                            except Exception as inst:
+                                print ('failed to add_symbol')
+                                continue
 
-                                try:
-                                    # must be the selected advancer or governane proposoal
-                                    ads_hash = self.linear_liquidity_pool.add_symbol(seleted_advancer, self.btcusd_chainlink_feed.address, strike, maturity, option_type, current_timestamp, x, y, buyStock, sellStock)
-                                    providerAvax.make_request("avax.issueBlock", {})
-                                    receipt = w3.eth.waitForTransactionReceipt(ads_hash, poll_latency=tx_pool_latency, timeout=600)
-                                    tx_hashes.append({'type': 'add_symbol', 'hash': ads_hash})
-                                except Exception as inst:
-                                    logger.info({"agent": a.address, "error": inst, "action": "add_symbol", "strike": strike, "maturity": maturity, "x": x, "y": y, "normed_vol": normed_vol, "vol": vol})
+                            try:
+                                # must be the selected advancer or governane proposoal
+                                ads_hash = self.linear_liquidity_pool.add_symbol(seleted_advancer, self.btcusd_chainlink_feed.address, strike, maturity, option_type, current_timestamp, x, y, buyStock, sellStock)
+                                block_context.issue_block()
+                                tx_hashes.append({'type': 'add_symbol', 'hash': ads_hash})
+                            except Exception as inst:
+                                logger.info({"agent": a.address, "error": inst, "action": "add_symbol", "strike": strike, "maturity": maturity, "x": x, "y": y, "normed_vol": normed_vol, "vol": vol})
                 elif action == "create_symbol":
                     for sym in available_symbols:
                         if sym not in tks_list_symbols:
 
                             try:
                                 cs_hash = self.options_exchange.create_symbol(a, sym, self.btcusd_chainlink_feed)
-                                providerAvax.make_request("avax.issueBlock", {})
-                                receipt = w3.eth.waitForTransactionReceipt(cs_hash, poll_latency=tx_pool_latency, timeout=600)
+                                block_context.issue_block()
                                 tx_hashes.append({'type': 'create_symbol', 'hash': cs_hash})
                             except Exception as inst:
                                 logger.info({"agent": a.address, "error": inst, "action": "create_symbol", "sym": sym })
@@ -1960,8 +4114,9 @@ class Model:
                                 logger.info({"agent": a.address, "error": inst, "action": "burn_token", "option_token": otv.address})
                     '''
 
-                    for otk, otv in self.option_tokens.items():
-                        owv = Balance(otv.contract.caller({'from' : a.address, 'gas': 100000}).writtenVolume(a.address), EXCHG['decimals'])
+                    written_volumes = batch_call([(otv.contract, 'writtenVolume', [a.address]) for otv in self.option_tokens.values()], a, 100000)
+                    for (otk, otv), wv in zip(list(self.option_tokens.items()), written_volumes):
+                        owv = Balance(wv, EXCHG['decimals'])
                         if owv > 0 and otv[a] > 0:
                             # written > holding
                             token_amount = Balance(owv.to_wei() - otv[a].to_wei(), EXCHG['decimals'])
@@ -1977,14 +4132,14 @@ class Model:
                 elif action == "write":
                     # select from available symbols
                     sym = available_symbols[int(random.random() * (len(available_symbols) - 1))]
-                    sym_parts = sym.split('-')
+                    option_symbol = OptionSymbol.parse(sym)
 
                     '''
                         * sym is something like: `ETH/USD-EC-13e20-1611964800` which represents an ETH european call option with strike price US$ 1300 and maturity at timestamp `1611964800`.
                     '''
-                    strike_price = int(float(sym_parts[2]))
-                    maturity = int(sym_parts[3])
-                    option_type = 'PUT' if sym_parts[1] == 'EP' else 'CALL'
+                    strike_price = option_symbol.strike
+                    maturity = option_symbol.maturity
+                    option_type = option_symbol.option_type
                     amount = int(round(portion_dedusted(
                         buyStock,
                         commitment
@@ -2004,6 +4159,13 @@ class Model:
 
                     if(cc > cc_s):
                         amount /= (cc.to_wei() / cc_s.to_wei())
+                        if collateral_quoter is not None:
+                            # The ratio can land just over; take the most that fits exactly
+                            max_volume = collateral_quoter.max_volume(a, 0 if option_type == 'CALL' else 1, strike_price, maturity, cc_s.to_wei())
+                            if max_volume is not None:
+                                # Less a hair, so the float round trip in write() can't land over it
+                                max_volume = int(max_volume[0])
+                                amount = min(amount, (max_volume - (max_volume >> 40)) / 10.**EXCHG['decimals'])
                         logger.info("Norm to Write; amount: {}".format(amount))
 
                     if amount < 1:
@@ -2018,14 +4180,14 @@ class Model:
                 elif action == "buy":
                     tks_list = list(self.option_tokens.values())
                     option_token_to_buy = tks_list[int(random.random() * (len(tks_list) - 1))]
-                    symbol = option_token_to_buy.contract.caller({'from' : a.address, 'gas': 8000000}).symbol()
+                    symbol = option_token_to_buy.symbol
                     option_token_balance_of_pool = Balance(
                         option_token_to_buy.contract.caller({'from' : a.address, 'gas': 8000000}).writtenVolume(self.linear_liquidity_pool.address),
                         EXCHG['decimals']
                     )
                     print(symbol, option_token_balance_of_pool)
                     try:
-                        current_price_volume = self.linear_liquidity_pool.query_buy(a, symbol)
+                        current_price_volume = self.linear_liquidity_pool.quote_buy(a, symbol)
                     except Exception as inst:
                         print("\terror querying buy", inst)
                         continue
@@ -2061,7 +4223,7 @@ class Model:
                     try:
                         logger.info("Before Buy; symbol: {}, price: {}, volume: {}".format(symbol, price, volume))
                         buy_hash = self.linear_liquidity_pool.buy(a, symbol, price, volume)
-                        providerAvax.make_request("avax.issueBlock", {})
+                        block_context.issue_block()
                         tx_hashes.append({'type': 'buy', 'hash': buy_hash})
                     except Exception as inst:
                         logger.info({"agent": a.address, "error": inst, "action": "buy", "volume": volume, "price": price, "symbol": symbol})
@@ -2070,17 +4232,18 @@ class Model:
                     symbol = None
                     volume_to_sell = Balance(0, EXCHG['decimals'])
                     current_price_volume = None
-                    for k, ot in self.option_tokens.items():
-                        volume_to_sell = Balance(ot.contract.caller({'from' : a.address, 'gas': 8000000}).balanceOf(a.address), EXCHG['decimals'])
+                    balances = batch_call([(ot.contract, 'balanceOf', [a.address]) for ot in self.option_tokens.values()], a)
+                    for (k, ot), bal in zip(list(self.option_tokens.items()), balances):
+                        volume_to_sell = Balance(bal, EXCHG['decimals'])
                         if volume_to_sell > 1:
                             option_token_to_sell = ot
                             
                             if not option_token_to_sell:
                                 continue
                             
-                            symbol = option_token_to_sell.contract.caller({'from' : a.address, 'gas': 8000000}).symbol()
+                            symbol = option_token_to_sell.symbol
                             try:
-                                current_price_volume = self.linear_liquidity_pool.query_sell(a, symbol)
+                                current_price_volume = self.linear_liquidity_pool.quote_sell(a, symbol)
                             except Exception as inst:
                                 print("\terror querying sell", inst)
                                 continue
@@ -2120,8 +4283,9 @@ class Model:
                 elif action == "liquidate":
                     for short_owner in any_short_collateral:
                         if short_owner.total_written > 1: 
-                            for otk, otv in self.option_tokens.items():
-                                if otv.contract.caller({'from' : a.address, 'gas': 8000000}).writtenVolume(short_owner.address) > 0:
+                            written_volumes = batch_call([(otv.contract, 'writtenVolume', [short_owner.address]) for otv in self.option_tokens.values()], a)
+                            for (otk, otv), wv in zip(list(self.option_tokens.items()), written_volumes):
+                                if wv > 0:
                                     try:
                                         lqd8_hash = self.options_exchange.liquidate(a, otk, short_owner.address)
                                         tx_hashes.append({'type': 'liquidate', 'hash': lqd8_hash})
@@ -2158,21 +4322,10 @@ class Model:
 
             total_tx_submitted += (end_tx_count - start_tx_count)
 
-        providerAvax.make_request("avax.issueBlock", {})
-
-        tx_hashes_good = 0
-        tx_fails = []
-        tx_good = []
-        #'''
-        for tmp_tx_hash in tx_hashes:
-            receipt = w3.eth.waitForTransactionReceipt(tmp_tx_hash['hash'], poll_latency=tx_pool_latency, timeout=600)
-            tx_hashes_good += receipt["status"]
-            if receipt["status"] == 0:
-                tx_fails.append(tmp_tx_hash)
-            else:
-                tx_good.append(tmp_tx_hash)
+        block_context.issue_block()
 
-        #'''
+        # Confirm the whole step in one pass
+        (tx_hashes_good, tx_fails, tx_good) = receipt_collector.summarize(tx_hashes, timeout=600)
 
         logger.info("total tx: {}, successful tx: {}, tx fails: {}, tx passed: {}".format(
                 len(tx_hashes), tx_hashes_good, tx_fails, tx_good
@@ -2181,11 +4334,51 @@ class Model:
 
         return True, random_advancer, tx_good
 
+def revert_to_checkpoint(path):
+    """
+    Put the chain back where the checkpoint at path was taken, and tell
+    if it got there.
+    """
+
+    try:
+        state = Model.read_checkpoint(path)
+    except (OSError, ValueError) as inst:
+        logger.info({"action": "read checkpoint", "error": inst, "path": path})
+        return False
+    if state['snapshot_id'] is None:
+        # Without a snapshot the chain may be steps ahead of the checkpoint
+        logger.info({"action": "evm_revert", "error": "checkpoint has no snapshot", "path": path})
+        return False
+    try:
+        reverted = rpc_connection.call('evm_revert', [state['snapshot_id']])
+    except Exception as inst:
+        logger.info({"action": "evm_revert", "error": inst})
+        reverted = False
+    block_context.invalidate()
+    if reverted and block_context.number != state['block_number']:
+        logger.info({"action": "evm_revert", "error": "at block {}, checkpoint was taken at {}".format(block_context.number, state['block_number'])})
+        reverted = False
+    return reverted
+
 def main():
     """
     Main function: run the simulation.
     """
-    global avax_cchain_nonces
+    global nonce_table
+    global tx_pipeline
+    global rpc_connection
+    global receipt_collector
+    global block_context
+    global gas_profile
+    global log_indexer
+    global position_ledger
+    global surplus_screener
+    global approval_store
+    global pricing_backend
+    global pool_quoter
+    global collateral_quoter
+
+    init_chain()
 
     '''
         curl -X POST --data '{ "jsonrpc":"2.0", "id" :1, "method" :"debug_increaseTime", "params" : ["0x45e8d9a7ca159a0f6957534cb25412b4daa4243906ef2b6e93125246b1e27d05"]}' -H 'content-type:application/json;' http://127.0.0.1:9545/ext/bc/C/rpc
@@ -2201,6 +4394,59 @@ def main():
     logging.basicConfig(level=logging.INFO)
     logger.info('Total Agents: {}'.format(len(w3.eth.accounts[:max_accounts])))
 
+    nonce_table = NonceTable(MMAP_FILE)
+    rpc_connection = AsyncRPCConnection(provider.endpoint_uri, start_event_loop_thread('rpc'))
+    receipt_collector = ReceiptCollector(rpc_connection)
+    block_context = BlockContext(rpc_connection)
+    gas_profile = GasProfile(GAS_PROFILE_FILE)
+
+    # Everything that goes into the chain state at step 0 besides the contracts themselves
+    setup_params = {
+        "pool_spread": POOL_SPREAD,
+        "pool_reserve_ratio": POOL_RESERVE_RATIO,
+        "pool_maturity_days": POOL_MATURITY_DAYS,
+        "volatility_period_days": VOLATILITY_PERIOD_DAYS,
+        "ohlc_start_date": OHLC_START_DATE,
+        "ohlc_lookback_days": OHLC_LOOKBACK_DAYS,
+        "max_accounts": max_accounts,
+        "usdt": USDT["addr"],
+    }
+    snapshot_cache = ChainSnapshotCache(SNAPSHOT_CACHE_DIR)
+    snapshot_key = snapshot_cache.key(setup_params)
+
+    checkpoint_path = None
+    if is_resuming and os.path.exists(CHECKPOINT_FILE):
+        # Put the chain back where the checkpoint was taken before anything reads it
+        if not revert_to_checkpoint(CHECKPOINT_FILE):
+            # The chain has moved on from the checkpoint and from any clean start
+            logger.info({"action": "resume", "error": "can't get the chain back to the checkpoint, redeploy"})
+            sys.exit(REDEPLOY_EXIT_CODE)
+        checkpoint_path = CHECKPOINT_FILE
+    elif snapshot_cache.has_snapshots():
+        # The deployment was set up by a run before, so only its step 0 is a clean start
+        reverted = False
+        if snapshot_cache.get(snapshot_key) is not None:
+            reverted = revert_to_checkpoint(snapshot_cache.checkpoint_file(snapshot_key))
+        if reverted:
+            checkpoint_path = snapshot_cache.checkpoint_file(snapshot_key)
+            logger.info({"action": "warm start", "snapshot": snapshot_key})
+        else:
+            # Gone from the node, or a different setup: setting up on top of the old runs would skew everything
+            snapshot_cache.drop(snapshot_key)
+            logger.info({"action": "warm start", "error": "no snapshot to revert to, redeploy", "snapshot": snapshot_key})
+            sys.exit(REDEPLOY_EXIT_CODE)
+
+    log_indexer = LogIndexer(block_context.number)
+    approval_store = ApprovalStore(APPROVALS_FILE)
+    pricing_backend = NumpyPricingBackend() if is_in_process_pricing else OpModelBackend()
+    if is_pricing_cache:
+        pricing_backend = CachedPricingBackend(pricing_backend, PRICING_CACHE_DIR)
+    if is_pipelined_tx:
+        signer = None
+        if is_local_signing:
+            signer = LocalSigner(load_agent_keys(AGENT_KEYS_FILE), use_processes=is_signing_in_processes)
+        tx_pipeline = TransactionPipeline(rpc_connection, receipt_collector, signer=signer)
+
     
     options_exchange = w3.eth.contract(abi=OptionsExchangeContract['abi'], address=EXCHG["addr"])
     proposal_wrapper = w3.eth.contract(abi=ProposalWrapperContract['abi'], address=PROPSWRPR["addr"])
@@ -2235,8 +4481,6 @@ def main():
     '''
         INIT FEEDS FOR BTCUSDAGG
     '''
-    btcusd_historical_ohlc = []
-
     '''
     for acc in w3.eth.accounts[:max_accounts]:
         cs = options_exchange.caller({'from' : acc, 'gas': 8000000}).calcSurplus(acc)
@@ -2248,41 +4492,17 @@ def main():
     #print(Balance(4.474093538197649, 18).to_wei())
 
     #sys.exit()
-    '''
-    with open('../../data/BTC-USD_vol_date_high_low_close.json', 'r+') as btcusd_file:
-        btcusd_historical_ohlc = json.loads(btcusd_file.read())["chart"]
-    
-
     daily_period = 60 * 60 * 24
-    current_timestamp = int(w3.eth.get_block('latest')['timestamp'])
+    current_timestamp = block_context.timestamp
     print("current_timestamp", current_timestamp)
 
-    btcusd_answers = []
-    start_date = "2017-06-17"#"2017-12-17"
-    btcusd_data_offset = 0
-    btcusd_data_subtraction_set = 30 # look back period to present to seed data for vol calcs
-    start_data_parsing = False # change this if you want to skip foward to specific time period
-    for xidx, x in enumerate(btcusd_historical_ohlc):
-
-
-        if start_data_parsing is False:
-            if x['date'] == start_date:
-                start_data_parsing = True
-                btcusd_data_offset = xidx
-
-
-        if x["open"] != 'null':
-            btcusd_answers.append(int(float(x["open"]) * (10**BTCUSDAgg['decimals'])))
-
-    if btcusd_data_offset <  btcusd_data_subtraction_set:
-        btcusd_data_subtraction_set = btcusd_data_offset
+    # Converted once from historical_ohlc.tar.gz with ohlc_data.py, then memory-mapped
+    btcusd_historical_ohlc = OHLCData(os.path.join(OHLC_DATA_DIR, 'BTC-USD'))
+    start_date = OHLC_START_DATE
+    btcusd_data_subtraction_set = OHLC_LOOKBACK_DAYS # look back period to present to seed data for vol calcs
+    btcusd_answers = btcusd_historical_ohlc.window('open', BTCUSDAgg['decimals'], start_date, btcusd_data_subtraction_set)
 
-    btcusd_answers = btcusd_answers[btcusd_data_offset-btcusd_data_subtraction_set:]
-
-    print('btcusd_data_offset', btcusd_data_offset, start_date)
-    '''
-
-    avax_cchain_nonces = open(MMAP_FILE, "r+b")
+    print('btcusd_data_offset', btcusd_historical_ohlc.row(start_date), start_date)
 
     tx_hashes = []
     tx_hashes_good = 0
@@ -2307,7 +4527,7 @@ def main():
         )
         tmp_tx_hash = {'type': 'createPool', 'hash': p_hash}
         print(tmp_tx_hash)
-        receipt = w3.eth.waitForTransactionReceipt(tmp_tx_hash['hash'], poll_latency=tx_pool_latency)
+        receipt = wait_for_receipt(tmp_tx_hash['hash'])
         tx_hashes.append(tmp_tx_hash)
         tx_hashes_good += receipt["status"]    
         if receipt["status"] == 0:
@@ -2340,7 +4560,7 @@ def main():
     tmp_tx_hash = {'type': 'setAllowedToken', 'hash': sat_hash}
     tx_hashes.append(tmp_tx_hash)
     print(tmp_tx_hash)
-    receipt = w3.eth.waitForTransactionReceipt(tmp_tx_hash['hash'], poll_latency=tx_pool_latency)
+    receipt = wait_for_receipt(tmp_tx_hash['hash'])
     tx_hashes_good += receipt["status"]
     if receipt["status"] == 0:
         print(receipt)
@@ -2359,7 +4579,7 @@ def main():
     tmp_tx_hash = {'type': 'setMinShareForProposal', 'hash': msp_hash}
     tx_hashes.append(tmp_tx_hash)
     print(tmp_tx_hash)
-    receipt = w3.eth.waitForTransactionReceipt(tmp_tx_hash['hash'], poll_latency=tx_pool_latency)
+    receipt = wait_for_receipt(tmp_tx_hash['hash'])
     tx_hashes_good += receipt["status"]
     if receipt["status"] == 0:
         print(receipt)
@@ -2380,14 +4600,14 @@ def main():
     '''
 
 
-    pool_spread = 5 * (10**7) #5% 
-    pool_reserve_ratio = 0 * (10**7) # 20% default
-    pool_maturity = (1000000000 * daily_period) + current_timestamp
+    pool_spread = POOL_SPREAD
+    pool_reserve_ratio = POOL_RESERVE_RATIO
+    pool_maturity = (POOL_MATURITY_DAYS * daily_period) + current_timestamp
 
     '''
         SETUP PROTOCOL SETTINGS FOR POOL
     '''
-    skip = False
+    skip = checkpoint_path is not None
 
     if not skip:
         mt_hash = transaction_helper(
@@ -2400,7 +4620,7 @@ def main():
         tmp_tx_hash = {'type': 'setFixedTime', 'hash': mt_hash}
         tx_hashes.append(tmp_tx_hash)
         print(tmp_tx_hash)
-        receipt = w3.eth.waitForTransactionReceipt(tmp_tx_hash['hash'], poll_latency=tx_pool_latency)
+        receipt = wait_for_receipt(tmp_tx_hash['hash'])
         tx_hashes_good += receipt["status"]
         if receipt["status"] == 0:
             print(receipt)
@@ -2419,7 +4639,7 @@ def main():
         tmp_tx_hash = {'type': 'setParameters', 'hash': sp_hash}
         tx_hashes.append(tmp_tx_hash)
         print(tmp_tx_hash)
-        receipt = w3.eth.waitForTransactionReceipt(tmp_tx_hash['hash'], poll_latency=tx_pool_latency)
+        receipt = wait_for_receipt(tmp_tx_hash['hash'])
         tx_hashes_good += receipt["status"]
         if receipt["status"] == 0:
             print(receipt)
@@ -2436,7 +4656,7 @@ def main():
         tmp_tx_hash = {'type': 'setOwner', 'hash': so_hash}
         tx_hashes.append(tmp_tx_hash)
         print(tmp_tx_hash)
-        receipt = w3.eth.waitForTransactionReceipt(tmp_tx_hash['hash'], poll_latency=tx_pool_latency)
+        receipt = wait_for_receipt(tmp_tx_hash['hash'])
         tx_hashes_good += receipt["status"]
         if receipt["status"] == 0:
             print(receipt)
@@ -2456,7 +4676,7 @@ def main():
         tmp_tx_hash = {'type': 'setAllowedToken', 'hash': sat_hash}
         tx_hashes.append(tmp_tx_hash)
         print(tmp_tx_hash)
-        receipt = w3.eth.waitForTransactionReceipt(tmp_tx_hash['hash'], poll_latency=tx_pool_latency)
+        receipt = wait_for_receipt(tmp_tx_hash['hash'])
         tx_hashes_good += receipt["status"]
         if receipt["status"] == 0:
             print(receipt)
@@ -2474,7 +4694,7 @@ def main():
         tmp_tx_hash = {'type': 'setUdlFeed', 'hash': suf_hash}
         tx_hashes.append(tmp_tx_hash)
         print(tmp_tx_hash)
-        receipt = w3.eth.waitForTransactionReceipt(tmp_tx_hash['hash'], poll_latency=tx_pool_latency)
+        receipt = wait_for_receipt(tmp_tx_hash['hash'])
         tx_hashes_good += receipt["status"]
         if receipt["status"] == 0:
             print(receipt)
@@ -2484,14 +4704,14 @@ def main():
         svp_hash = transaction_helper(
             agent,
             protocol_settings.functions.setVolatilityPeriod(
-                30 * daily_period
+                VOLATILITY_PERIOD_DAYS * daily_period
             ),
             500000
         )
         tmp_tx_hash = {'type': 'setVolatilityPeriod', 'hash': svp_hash}
         tx_hashes.append(tmp_tx_hash)
         print(tmp_tx_hash)
-        receipt = w3.eth.waitForTransactionReceipt(tmp_tx_hash['hash'], poll_latency=tx_pool_latency)
+        receipt = wait_for_receipt(tmp_tx_hash['hash'])
         tx_hashes_good += receipt["status"]
         if receipt["status"] == 0:
             print(receipt)
@@ -2507,7 +4727,21 @@ def main():
     # Make a model of the options exchnage
     start_init = time.time()
     logger.info('INIT STARTED')
-    model = Model(options_exchange, credit_provider, linear_liquidity_pool, btcusd_chainlink_feed, btcusd_agg, btcusd_answers, None, usdt, w3.eth.accounts[:max_accounts], min_faith=0.5E6, max_faith=1E6, use_faith=False)
+    model = Model(options_exchange, credit_provider, linear_liquidity_pool, btcusd_chainlink_feed, btcusd_agg, btcusd_answers, None, usdt, w3.eth.accounts[:max_accounts], checkpoint_path=checkpoint_path, min_faith=0.5E6, max_faith=1E6, use_faith=False)
+    collateral_manager = protocol_settings.functions.getUdlCollateralManager(btcusd_chainlink_feed.address).call()
+    position_ledger = PositionLedger(options_exchange, model.credit_provider, [collateral_manager])
+    position_ledger.load(model.agents)
+    surplus_screener = SurplusScreener(model.options_exchange, model.agents)
+    pool_quoter = PoolQuoter(model.linear_liquidity_pool, model.options_exchange, btcusd_chainlink_feed)
+    collateral_quoter = CollateralQuoter(btcusd_chainlink_feed, model.daily_volatility)
+    if checkpoint_path != CHECKPOINT_FILE:
+        # Remember step 0 for next time. Reverting used up the old snapshot, so take a new one either way.
+        try:
+            snapshot_id = rpc_connection.call('evm_snapshot', [])
+            model.save(snapshot_cache.checkpoint_file(snapshot_key), snapshot_id)
+            snapshot_cache.put(snapshot_key, snapshot_id)
+        except Exception as inst:
+            logger.info({"action": "evm_snapshot", "error": inst})
     end_init = time.time()
     logger.info('INIT FINISHED {} (s)'.format(end_init - start_init))
 
@@ -2528,13 +4762,25 @@ def main():
         logger.info('iter: %s, sys time %s' % (i, end_iter-start_iter))
         # Log system state
         model.log(stream, seleted_advancer, header=(i == 0))
+        gas_profile.save()
 
         filtered_tx_passed = list(set([x['type'] for x in tx_passed]))
 
         if len(filtered_tx_passed) == 1:
-            provider.make_request("debug_increaseTime", [3600 * 24])
+            block_context.advance_time(3600 * 24)
         else:
-            provider.make_request("debug_increaseTime", [3600 * 6])
+            block_context.advance_time(3600 * 6)
+        # Time to maturity moved for every position
+        surplus_screener.invalidate_all()
+
+        # Checkpoint after the clock moves, so a resume starts on the next step. Nodes only let go
+        # of a snapshot by reverting to it, so take one every CHECKPOINT_STEPS instead of every step.
+        if (i + 1) % CHECKPOINT_STEPS == 0:
+            try:
+                model.save(CHECKPOINT_FILE, rpc_connection.call('evm_snapshot', []))
+            except Exception as inst:
+                # A checkpoint without a snapshot can't be resumed, so keep the last one
+                logger.info({"action": "evm_snapshot", "error": inst})
         #'''
         #sys.exit()
         
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+"""
+ohlc_data.py: historical OHLC charts as memory-mapped NumPy columns
+
+historical_ohlc.tar.gz has one JSON chart per market, like
+{"chart": [{"date": "2014-09-17", "open": "465.864014", ...}, ...]}, with
+every number as a string and "null" for missing days. Convert them once:
+
+    python ohlc_data.py ../../historical_ohlc.tar.gz ../../data/ohlc
+
+That writes a directory per market (BTC-USD, ETH-USD, EURUSD=X) holding one
+.npy file per column. OHLCData memory-maps them read-only, so every
+simulator process shares the same pages, and since the dates are sorted
+finding a date is a binary search.
+"""
+import json
+import os
+import sys
+import tarfile
+import numpy as np
+
+OHLC_DATA_DIR = '../../data/ohlc'
+CHART_SUFFIX = '_vol_date_high_low_close.json'
+PRICE_COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+
+def convert_chart(chart, out_dir):
+    """
+    Write the rows of a parsed chart as .npy columns under out_dir.
+
+    Days with nulls are dropped, so every row has all its columns.
+    """
+
+    rows = [x for x in chart if 'null' not in [x[column] for column in ['date'] + PRICE_COLUMNS]]
+    rows.sort(key=lambda x: x['date'])
+
+    os.makedirs(out_dir, exist_ok=True)
+    np.save(os.path.join(out_dir, 'date.npy'), np.array([x['date'] for x in rows], dtype='datetime64[D]'))
+    for column in PRICE_COLUMNS:
+        np.save(os.path.join(out_dir, column + '.npy'), np.array([float(x[column]) for x in rows], dtype=np.float64))
+    return len(rows)
+
+def convert(source, out_dir=OHLC_DATA_DIR):
+    """
+    Convert every chart in source, either a directory of JSON charts or the
+    tarball they ship in.
+    """
+
+    charts = {}
+    if os.path.isdir(source):
+        for file_name in os.listdir(source):
+            if file_name.endswith(CHART_SUFFIX):
+                with open(os.path.join(source, file_name), 'r') as f:
+                    charts[file_name[:-len(CHART_SUFFIX)]] = json.loads(f.read())['chart']
+    else:
+        with tarfile.open(source, 'r:*') as tar:
+            for member in tar.getmembers():
+                file_name = os.path.basename(member.name)
+                if member.isfile() and file_name.endswith(CHART_SUFFIX):
+                    charts[file_name[:-len(CHART_SUFFIX)]] = json.loads(tar.extractfile(member).read())['chart']
+
+    for (market, chart) in sorted(charts.items()):
+        rows = convert_chart(chart, os.path.join(out_dir, market))
+        print('{}: {} rows'.format(market, rows))
+
+class OHLCData:
+    """
+    One market's columns, memory-mapped read-only.
+
+    Columns are NumPy arrays backed by the .npy files, so indexing or
+    slicing one reads straight from the shared page cache without copying.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.date = np.load(os.path.join(path, 'date.npy'), mmap_mode='r')
+        self.columns = {column: np.load(os.path.join(path, column + '.npy'), mmap_mode='r') for column in PRICE_COLUMNS}
+
+    def __len__(self):
+        return len(self.date)
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def row(self, date):
+        """
+        Get the row of the given date (a string like "2017-06-17"), or of
+        the first day after it we have data for.
+        """
+
+        return int(np.searchsorted(self.date, np.datetime64(date, 'D')))
+
+    def scaled(self, column, decimals):
+        """
+        Get the column as int64 fixed point with the given decimals, the way
+        the feed takes it.
+
+        The scaled column is written next to the others the first time it's
+        asked for and memory-mapped like them after that.
+        """
+
+        scaled_file = os.path.join(self.path, '{}-e{}.npy'.format(column, decimals))
+        if not os.path.exists(scaled_file) or os.path.getmtime(scaled_file) < os.path.getmtime(os.path.join(self.path, column + '.npy')):
+            scaled = np.trunc(self.columns[column] * (10**decimals)).astype(np.int64)
+            tmp_file = scaled_file + '.tmp.npy'
+            np.save(tmp_file, scaled)
+            os.replace(tmp_file, scaled_file)
+        return np.load(scaled_file, mmap_mode='r')
+
+    def window(self, column, decimals, start_date, lookback=0):
+        """
+        Get the scaled column from lookback rows before start_date on.
+
+        If there isn't that much history before start_date, start at the
+        first row instead.
+        """
+
+        start = max(0, self.row(start_date) - lookback)
+        return self.scaled(column, decimals)[start:]
+
+def main():
+    if len(sys.argv) not in (2, 3):
+        print('usage: {} SOURCE [OUT_DIR]'.format(sys.argv[0]))
+        sys.exit(2)
+    convert(sys.argv[1], sys.argv[2] if len(sys.argv) == 3 else OHLC_DATA_DIR)
+
+if __name__ == "__main__":
+    main()
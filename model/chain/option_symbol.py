@@ -0,0 +1,71 @@
+"""
+option_symbol.py: parsed option symbols
+
+A symbol like `ETH/USD-EC-13e20-1611964800` is an ETH european call with a
+strike of US$ 1300 (in wei) and maturity at timestamp `1611964800`. Kept out
+of model.py so that scripts like mine_sim_output.py can use it without
+connecting to a node.
+"""
+import decimal
+
+class OptionSymbol:
+    """
+    One option symbol, parsed once. OptionSymbol.parse() interns by the
+    symbol string, so parsing the same symbol again is a dict lookup and
+    every copy of it is the same object.
+    """
+
+    __slots__ = ('symbol', 'underlying', 'type_code', 'option_type', 'strike', 'maturity', 'sort_key')
+
+    TYPES = {'EC': 'CALL', 'EP': 'PUT'}
+
+    # This maps from symbol string to its OptionSymbol
+    interned = {}
+
+    def __init__(self, symbol):
+        (underlying, type_code, strike, maturity) = symbol.rsplit('-', 3)
+        self.symbol = symbol
+        self.underlying = underlying
+        self.type_code = type_code
+        self.option_type = self.TYPES[type_code]
+        # Strikes are written like 13e20, so go through Decimal to stay exact
+        self.strike = int(decimal.Decimal(strike))
+        self.maturity = int(maturity)
+        self.sort_key = (underlying, self.maturity, type_code, self.strike)
+
+    @classmethod
+    def parse(cls, symbol):
+        if isinstance(symbol, OptionSymbol):
+            return symbol
+        option_symbol = cls.interned.get(symbol)
+        if option_symbol is None:
+            option_symbol = cls(symbol)
+            cls.interned[symbol] = option_symbol
+        return option_symbol
+
+    @property
+    def is_call(self):
+        return self.type_code == 'EC'
+
+    @property
+    def is_put(self):
+        return self.type_code == 'EP'
+
+    def is_expired(self, timestamp):
+        """
+        Check if the option has matured as of the given (block) timestamp.
+        """
+
+        return self.maturity <= timestamp
+
+    def time_to_maturity(self, timestamp):
+        return max(0, self.maturity - timestamp)
+
+    def __lt__(self, other):
+        return self.sort_key < other.sort_key
+
+    def __str__(self):
+        return self.symbol
+
+    def __repr__(self):
+        return 'OptionSymbol({!r})'.format(self.symbol)
@@ -0,0 +1,377 @@
+"""
+pricing.py: pricing curves for the liquidity pool's symbols
+
+The pool prices an option by interpolating between points on two curves: x
+holds underlying prices, y0 the option's price at each of them when the
+curve is set (t0) and y1 the price two days later (t1). This module builds
+those curves for many symbols in one vectorized Monte Carlo run.
+
+Input is the same structure model.py used to hand to `./op_model` in
+mcmc_symbol_params.json:
+
+    {
+        "BTC/USD": {
+            "curr_price": 9000.0,
+            "vol": 0.04,
+            "data": [
+                {"strike": 9500, "option_type": "PUT", "symbol": "BTC/USD-EP-95e20-1623989786"}
+            ]
+        }
+    }
+
+and output matches mcmc_symbol_computation.json, {symbol: {"x": [...],
+"y0": [...], "y1": [...]}}. The vol there is the normalized vol
+log((p + 3 std) / (p - 3 std)) of the feed's daily volatility, which spans
+six daily standard deviations in log terms.
+
+OpModelBackend still runs the old binary through the JSON files, for
+comparing against it or when it's the one wanted. CachedPricingBackend
+goes in front of either and keeps the curves it has seen, in memory and
+on disk, so repeated scenarios and parameter sweeps skip the pricing.
+"""
+import collections
+import hashlib
+import json
+import math
+import os
+import subprocess
+import threading
+import time
+import numpy as np
+
+PRICING_RATE = 0.05
+PRICING_SAMPLES = 2000
+PRICING_POINTS = 10
+# How many standard deviations of the underlying over the option's life the x grid spans each way
+PRICING_GRID_WIDTH = 3.0
+CURVE_SPAN_DAYS = 2
+VOL_MULTIPLIER = 3.0
+DAYS_PER_YEAR = 365
+MONTHS_PER_YEAR = 12
+PRICING_CACHE_DIR = './pricing-cache'
+# Bump when what goes into a cache key or entry changes, so old entries stop matching
+PRICING_CACHE_VERSION = 1
+PRICING_CACHE_ENTRIES = 4096
+# How finely curve inputs are told apart: dollars of spot, normalized vol, months to expiry (about a day)
+PRICING_CACHE_SPOT_STEP = 1.0
+PRICING_CACHE_VOL_STEP = 1e-4
+PRICING_CACHE_MONTHS_STEP = 1.0 / 30
+
+def annualized_vol(normed_vol, multiplier=VOL_MULTIPLIER, days_per_year=DAYS_PER_YEAR):
+    """
+    Turn the normalized vol, log((p + m std) / (p - m std)), into an
+    annualized log vol.
+    """
+
+    return np.asarray(normed_vol, dtype=np.float64) / (2.0 * multiplier) * math.sqrt(days_per_year)
+
+def price_curves(spot, vol, strike, is_call, months, rate=PRICING_RATE, num_samples=PRICING_SAMPLES,
+                 num_points=PRICING_POINTS, span_days=CURVE_SPAN_DAYS, seed=None):
+    """
+    Price European options on a grid of underlying prices, for every
+    symbol at once.
+
+    spot, vol (annualized), strike and is_call are arrays with one entry
+    per symbol; months is how long until they mature (a scalar or one per
+    symbol). Returns (x, y0, y1), each of shape (symbols, num_points): the
+    grid of underlying prices, the prices with months to go and the prices
+    span_days later.
+
+    Every symbol and grid point shares the same normal draws (and their
+    antithetics), so the curves come out smooth in x.
+    """
+
+    spot = np.atleast_1d(np.asarray(spot, dtype=np.float64))
+    vol = np.atleast_1d(np.asarray(vol, dtype=np.float64))
+    strike = np.atleast_1d(np.asarray(strike, dtype=np.float64))
+    is_call = np.atleast_1d(np.asarray(is_call, dtype=bool))
+    months = np.broadcast_to(np.asarray(months, dtype=np.float64), spot.shape)
+
+    t0 = np.maximum(months / MONTHS_PER_YEAR, 1.0 / DAYS_PER_YEAR)
+    t1 = np.maximum(t0 - span_days / DAYS_PER_YEAR, 0.0)
+
+    # Grid of underlying prices, evenly spaced in log terms around spot
+    width = PRICING_GRID_WIDTH * vol * np.sqrt(t0)
+    steps = np.linspace(-1.0, 1.0, num_points)
+    x = spot[:, None] * np.exp(width[:, None] * steps[None, :])
+
+    rng = np.random.default_rng(seed)
+    z = rng.standard_normal((num_samples + 1) // 2)
+    z = np.concatenate([z, -z])[:num_samples]
+
+    def price_at(t):
+        # (symbols, 1, 1) against (1, 1, samples) against (symbols, points, 1)
+        sigma = vol[:, None, None]
+        tt = t[:, None, None]
+        growth = np.exp((rate - 0.5 * sigma**2) * tt + sigma * np.sqrt(tt) * z[None, None, :])
+        terminal = x[:, :, None] * growth
+        k = strike[:, None, None]
+        payoff = np.where(is_call[:, None, None], np.maximum(terminal - k, 0.0), np.maximum(k - terminal, 0.0))
+        return np.exp(-rate * t)[:, None] * payoff.mean(axis=2)
+
+    return (x, price_at(t0), price_at(t1))
+
+class NumpyPricingBackend:
+    """
+    Prices every symbol in process with price_curves().
+    """
+
+    def __init__(self, rate=PRICING_RATE, num_points=PRICING_POINTS, seed=None):
+        self.rate = rate
+        self.num_points = num_points
+        self.seed = seed
+
+    def cache_identity(self):
+        return {
+            "backend": "numpy",
+            "rate": self.rate,
+            "num_points": self.num_points,
+            "seed": self.seed,
+            "grid_width": PRICING_GRID_WIDTH,
+            "span_days": CURVE_SPAN_DAYS,
+            "vol_multiplier": VOL_MULTIPLIER,
+            "days_per_year": DAYS_PER_YEAR,
+            "months_per_year": MONTHS_PER_YEAR,
+        }
+
+    def curves(self, params, months, num_samples=PRICING_SAMPLES):
+        symbols = []
+        spot = []
+        vol = []
+        strike = []
+        is_call = []
+        for (underlying, udl_params) in params.items():
+            for option in udl_params["data"]:
+                symbols.append(option["symbol"])
+                spot.append(udl_params["curr_price"])
+                vol.append(udl_params["vol"])
+                strike.append(option["strike"])
+                is_call.append(option["option_type"] == 'CALL')
+
+        if not symbols:
+            return {}
+        (x, y0, y1) = price_curves(spot, annualized_vol(vol), strike, is_call, months,
+                                   rate=self.rate, num_samples=num_samples, num_points=self.num_points, seed=self.seed)
+        return {
+            symbol: {"x": x[i].tolist(), "y0": y0[i].tolist(), "y1": y1[i].tolist()}
+            for (i, symbol) in enumerate(symbols)
+        }
+
+class OpModelBackend:
+    """
+    Prices through the `./op_model` binary, handing the parameters over in
+    mcmc_symbol_params.json and reading mcmc_symbol_computation.json back.
+    """
+
+    def __init__(self, command='./op_model', params_file='mcmc_symbol_params.json',
+                 computation_file='mcmc_symbol_computation.json', rate=PRICING_RATE):
+        self.command = command
+        self.params_file = params_file
+        self.computation_file = computation_file
+        self.rate = rate
+        self.__binary_digest = None
+
+    def binary_digest(self):
+        """
+        Get the sha256 of the binary, so a rebuilt op_model doesn't hit
+        curves the old one priced. Worked out once per backend.
+        """
+
+        if self.__binary_digest is None:
+            digest = hashlib.sha256()
+            with open(self.command.split()[0], 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+            self.__binary_digest = digest.hexdigest()
+        return self.__binary_digest
+
+    def cache_identity(self):
+        return {"backend": "op_model", "command": self.command, "binary": self.binary_digest(), "rate": self.rate}
+
+    def curves(self, params, months, num_samples=PRICING_SAMPLES):
+        with open(self.params_file, 'w+') as f:
+            f.write(json.dumps(params, indent=4))
+
+        # Whatever the last run left behind isn't for these parameters
+        try:
+            os.remove(self.computation_file)
+        except FileNotFoundError:
+            pass
+
+        cmd = '%s "%s" "%s" "%s"' % (
+            self.command,
+            num_samples,
+            self.rate,
+            months,
+        )
+        try:
+            proc = subprocess.Popen(cmd, shell=True, stdin=None, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True)
+            (output, _) = proc.communicate()
+        except Exception as inst:
+            print(inst)
+            return {}
+        if proc.returncode != 0:
+            print(cmd, 'exited with', proc.returncode, output.decode('utf8', 'replace'))
+            return {}
+
+        try:
+            with open(self.computation_file, 'r+') as f:
+                return json.loads(f.read()) or {}
+        except (OSError, ValueError) as inst:
+            print(inst)
+            return {}
+
+class CachedPricingBackend:
+    """
+    Curves from another backend, cached in an in-memory LRU in front of an
+    on-disk store.
+
+    A curve depends only on the backend and (spot, vol, strike, option
+    type, months to expiry, samples). Spot, vol and months are rounded to
+    steps first, and the curve is priced at the rounded values, so every
+    input in a bucket gets the same curve. On disk each curve is a JSON file
+    named after the hash of its key. Files are written to the side and
+    moved into place, so runs and processes can share the directory.
+    """
+
+    def __init__(self, backend, path=PRICING_CACHE_DIR, max_entries=PRICING_CACHE_ENTRIES, spot_step=PRICING_CACHE_SPOT_STEP,
+                 vol_step=PRICING_CACHE_VOL_STEP, months_step=PRICING_CACHE_MONTHS_STEP):
+        self.backend = backend
+        self.path = path
+        self.max_entries = max_entries
+        self.spot_step = spot_step
+        self.vol_step = vol_step
+        self.months_step = months_step
+        self.__lock = threading.Lock()
+        # This maps from key hash to {"x": ..., "y0": ..., "y1": ...}, least recently used first
+        self.__entries = collections.OrderedDict()
+        self.__counters = collections.Counter()
+        self.__seconds = collections.Counter()
+
+    def bucket(self, value, step):
+        return int(round(value / step)) if step else value
+
+    def key(self, spot, vol, strike, option_type, months, num_samples):
+        """
+        Get the cache key of a curve as a dict, with spot, vol and months as
+        bucket numbers.
+        """
+
+        return {
+            "version": PRICING_CACHE_VERSION,
+            "pricer": self.backend.cache_identity(),
+            "spot": self.bucket(spot, self.spot_step),
+            "vol": self.bucket(vol, self.vol_step),
+            "strike": strike,
+            "option_type": option_type,
+            "months": self.bucket(months, self.months_step),
+            "num_samples": num_samples,
+        }
+
+    def digest(self, key):
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf8')).hexdigest()
+
+    def entry_file(self, digest):
+        return os.path.join(self.path, digest[:2], digest + '.json')
+
+    def get(self, digest):
+        """
+        Look a curve up in memory, then on disk. Returns None on a miss.
+        """
+
+        with self.__lock:
+            curve = self.__entries.get(digest)
+            if curve is not None:
+                self.__entries.move_to_end(digest)
+                self.__counters['memory_hits'] += 1
+                return curve
+
+        try:
+            with open(self.entry_file(digest), 'r') as f:
+                curve = json.loads(f.read())["curve"]
+        except (OSError, ValueError, KeyError):
+            return None
+        self.__remember(digest, curve)
+        with self.__lock:
+            self.__counters['disk_hits'] += 1
+        return curve
+
+    def put(self, digest, key, curve):
+        self.__remember(digest, curve)
+        entry_file = self.entry_file(digest)
+        os.makedirs(os.path.dirname(entry_file), exist_ok=True)
+        tmp_file = '{}.{}.tmp'.format(entry_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            f.write(json.dumps({"key": key, "curve": curve}))
+        os.replace(tmp_file, entry_file)
+
+    def __remember(self, digest, curve):
+        with self.__lock:
+            self.__entries[digest] = curve
+            self.__entries.move_to_end(digest)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+
+    def curves(self, params, months, num_samples=PRICING_SAMPLES):
+        start = time.perf_counter()
+        computation = {}
+        # Misses, grouped by the rounded underlying inputs they get priced at
+        missing = {}
+        for (underlying, udl_params) in params.items():
+            for option in udl_params["data"]:
+                key = self.key(udl_params["curr_price"], udl_params["vol"], option["strike"], option["option_type"], months, num_samples)
+                digest = self.digest(key)
+                curve = self.get(digest)
+                if curve is not None:
+                    computation[option["symbol"]] = {k: list(v) for (k, v) in curve.items()}
+                    continue
+                group = missing.setdefault((underlying, key["spot"], key["vol"]), [])
+                group.append((option, key, digest))
+
+        with self.__lock:
+            self.__counters['lookups'] += sum(len(udl_params["data"]) for udl_params in params.values())
+            self.__counters['misses'] += sum(len(group) for group in missing.values())
+            self.__seconds['lookup'] += time.perf_counter() - start
+
+        if missing:
+            start = time.perf_counter()
+            # Price every miss at its bucket's values, in one call
+            miss_params = {}
+            for (i, ((underlying, spot, vol), group)) in enumerate(missing.items()):
+                miss_params['{}#{}'.format(underlying, i)] = {
+                    "curr_price": spot * self.spot_step if self.spot_step else spot,
+                    "vol": vol * self.vol_step if self.vol_step else vol,
+                    "data": [option for (option, key, digest) in group],
+                }
+            bucket_months = self.bucket(months, self.months_step) * self.months_step if self.months_step else months
+            priced = self.backend.curves(miss_params, bucket_months, num_samples)
+            for group in missing.values():
+                for (option, key, digest) in group:
+                    curve = priced.get(option["symbol"])
+                    if curve is not None:
+                        self.put(digest, key, curve)
+                        computation[option["symbol"]] = {k: list(v) for (k, v) in curve.items()}
+            with self.__lock:
+                self.__seconds['pricing'] += time.perf_counter() - start
+
+        return computation
+
+    def stats(self):
+        """
+        Get hit counts, the hit rate and the seconds spent looking up and
+        pricing, since this cache was made.
+        """
+
+        with self.__lock:
+            lookups = self.__counters['lookups']
+            hits = self.__counters['memory_hits'] + self.__counters['disk_hits']
+            return {
+                "lookups": lookups,
+                "memory_hits": self.__counters['memory_hits'],
+                "disk_hits": self.__counters['disk_hits'],
+                "misses": self.__counters['misses'],
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "lookup_seconds": self.__seconds['lookup'],
+                "pricing_seconds": self.__seconds['pricing'],
+                "entries": len(self.__entries),
+            }
@@ -6,13 +6,24 @@ set -e
 # Have a function to kill off Ganache and clean up the database when we quit.
 function cleanup {
     echo "Clean Up..."
-    rm *-approvals.json
 }
 
 trap cleanup EXIT
 
-echo "Deploying contracts..."
-time truffle migrate --reset -f 2 --to 2 --skip-dry-run --network=development | tee deploy_output.txt
+function deploy {
+    echo "Deploying contracts..."
+    # Approvals and checkpoints are only kept across runs on the same deployment
+    rm -f approvals.log model-checkpoint.bin
+    time truffle migrate --reset -f 2 --to 2 --skip-dry-run --network=development | tee deploy_output.txt
+    python3 snapshot_cache.py save-deploy deploy_output.txt
+}
+
+if python3 snapshot_cache.py restore-deploy deploy_output.txt ; then
+    # Same contracts as a deployment the node still has, so the model can revert to its snapshot
+    echo "Reusing cached deployment..."
+else
+    deploy
+fi
 #curl -X POST --data @q.txt -H "Content-Type: application/json" http://127.0.0.1:9545/ext/bc/evm/rpc | python -m json.tool
 
 
@@ -31,6 +42,12 @@ else
     time python -m py_compile model.py
 fi
 
+if [[ ! -e ../../data/ohlc/BTC-USD ]] ; then
+    # Convert the price history to memory-mappable columns, just once
+    echo "Converting OHLC Data..."
+    python ohlc_data.py ../../historical_ohlc.tar.gz ../../data/ohlc
+fi
+
 if [[ "${RUN_SHELL}" == "1" ]] ; then
     # Run a shell so that you can run the model several times
     echo "Running Interactive Shell..."
@@ -38,7 +55,16 @@ if [[ "${RUN_SHELL}" == "1" ]] ; then
 else
     # Run the model
     echo "Running Model..."
-    ./model.py
+    status=0
+    ./model.py || status=$?
+    if [[ "${status}" == "3" ]] ; then
+        # REDEPLOY_EXIT_CODE: the cached deployment has no clean state to revert to
+        echo "Cached deployment can't be reverted, redeploying..."
+        deploy
+        ./model.py
+    elif [[ "${status}" != "0" ]] ; then
+        exit "${status}"
+    fi
 fi
 
 # grep -P "^  Gas usage: .{6,}" ganache_output.txt | wc -l
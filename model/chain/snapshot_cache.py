@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+"""
+snapshot_cache.py: cached chain snapshots for warm starts
+
+After the first run against a fresh deployment, the model stores an
+`evm_snapshot` id of the chain as it stood at step 0 (contracts set up,
+agents funded, feed seeded) together with a model checkpoint. Later runs
+with the same compiled contracts and setup parameters revert to it instead
+of replaying all of that. Kept out of model.py so that run.sh can ask it
+whether `truffle migrate` can be skipped, without a virtualenv or web3:
+
+    python3 snapshot_cache.py restore-deploy deploy_output.txt
+    python3 snapshot_cache.py save-deploy deploy_output.txt
+
+A reused deployment is only good for reverting: the runs before it have
+changed the chain. So restore-deploy only succeeds when a snapshot is
+stored for the artifacts, and when the model can't revert to the one for
+its setup it exits with REDEPLOY_EXIT_CODE rather than setting up on top.
+"""
+import glob
+import hashlib
+import json
+import os
+import shutil
+import sys
+import urllib.request
+
+SNAPSHOT_CACHE_DIR = './chain-snapshots'
+BUILD_DIR = './build/contracts'
+MIGRATIONS_DIR = './migrations'
+RPC_URI = 'http://127.0.0.1:9545/ext/bc/C/rpc'
+# Any contract from the deploy output will do to see if the node still has the deployment
+DEPLOY_CHECK_SLUG = 'OptionsExchangeAddress is at: '
+# What the model exits with when run.sh should deploy again and rerun it
+REDEPLOY_EXIT_CODE = 3
+
+class ChainSnapshotCache:
+    """
+    Snapshot ids by cache key, in an index file under the cache directory.
+
+    A key is the hash of the compiled contract artifacts (bytecode only, so
+    recompiling unchanged sources doesn't miss) and the migration scripts,
+    plus the hash of the setup parameters. The deploy output for a set of
+    artifacts and the model checkpoint for a key are kept next to the index.
+    """
+
+    def __init__(self, path=SNAPSHOT_CACHE_DIR, build_dir=BUILD_DIR, migrations_dir=MIGRATIONS_DIR):
+        self.path = path
+        self.build_dir = build_dir
+        self.migrations_dir = migrations_dir
+        self.index_file = os.path.join(path, 'index.json')
+        self.index = {}
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'r') as f:
+                self.index = json.loads(f.read())
+        self.__artifacts_hash = None
+
+    def artifacts_hash(self):
+        if self.__artifacts_hash is None:
+            h = hashlib.sha256()
+            for artifact_file in sorted(glob.glob(os.path.join(self.build_dir, '*.json'))):
+                with open(artifact_file, 'r') as f:
+                    artifact = json.loads(f.read())
+                h.update(os.path.basename(artifact_file).encode('utf8'))
+                h.update(artifact.get('bytecode', '').encode('utf8'))
+                h.update(artifact.get('deployedBytecode', '').encode('utf8'))
+            for migration_file in sorted(glob.glob(os.path.join(self.migrations_dir, '*.js'))):
+                with open(migration_file, 'rb') as f:
+                    h.update(os.path.basename(migration_file).encode('utf8'))
+                    h.update(f.read())
+            self.__artifacts_hash = h.hexdigest()[:16]
+        return self.__artifacts_hash
+
+    def key(self, setup_params):
+        params = json.dumps(setup_params, sort_keys=True).encode('utf8')
+        return self.artifacts_hash() + '-' + hashlib.sha256(params).hexdigest()[:16]
+
+    def deploy_file(self):
+        return os.path.join(self.path, 'deploy-{}.txt'.format(self.artifacts_hash()))
+
+    def checkpoint_file(self, key):
+        # The model writes the checkpoint itself, so make sure it has somewhere to go
+        os.makedirs(self.path, exist_ok=True)
+        return os.path.join(self.path, '{}.bin'.format(key))
+
+    def get(self, key):
+        """
+        Get the snapshot id stored for the key, or None.
+        """
+
+        entry = self.index.get(key)
+        if entry is None or not os.path.exists(self.checkpoint_file(key)):
+            return None
+        return entry['snapshot_id']
+
+    def put(self, key, snapshot_id):
+        self.index[key] = {'snapshot_id': snapshot_id}
+        self.__save()
+
+    def drop(self, key):
+        if self.index.pop(key, None) is not None:
+            self.__save()
+
+    def has_snapshots(self):
+        """
+        Tell if any snapshot is stored for the current artifacts, i.e. a run
+        has set up the deployment before.
+        """
+
+        prefix = self.artifacts_hash() + '-'
+        return any(key.startswith(prefix) and self.get(key) is not None for key in self.index)
+
+    def __save(self):
+        os.makedirs(self.path, exist_ok=True)
+        tmp_file = self.index_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(json.dumps(self.index, indent=4, sort_keys=True))
+        os.replace(tmp_file, self.index_file)
+
+    def save_deploy(self, deploy_output):
+        os.makedirs(self.path, exist_ok=True)
+        shutil.copyfile(deploy_output, self.deploy_file())
+        # Snapshots of the last deployment of these artifacts are no use with the new one
+        prefix = self.artifacts_hash() + '-'
+        for key in [key for key in self.index if key.startswith(prefix)]:
+            del self.index[key]
+        self.__save()
+
+    def restore_deploy(self, deploy_output, rpc_uri=RPC_URI):
+        """
+        Copy the cached deploy output for the current artifacts into place,
+        if there is one, a snapshot to revert it to, and the node still has
+        those contracts.
+
+        Returns True if deploying can be skipped.
+        """
+
+        if not os.path.exists(self.deploy_file()) or not self.has_snapshots():
+            return False
+        with open(self.deploy_file(), 'r') as f:
+            deploy_data = f.read()
+        if DEPLOY_CHECK_SLUG not in deploy_data:
+            return False
+        address = deploy_data.split(DEPLOY_CHECK_SLUG)[1].split('\n')[0].strip()
+
+        request = urllib.request.Request(
+            rpc_uri,
+            data=json.dumps({"jsonrpc": "2.0", "id": 1, "method": "eth_getCode", "params": [address, "latest"]}).encode('utf8'),
+            headers={'Content-Type': 'application/json'}
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                code = json.loads(response.read().decode('utf8')).get('result')
+        except Exception as inst:
+            print(inst, 'could not reach node')
+            return False
+        if not code or code == '0x':
+            # The node was reset since, so the deployment is gone
+            return False
+
+        shutil.copyfile(self.deploy_file(), deploy_output)
+        return True
+
+def main():
+    if len(sys.argv) != 3 or sys.argv[1] not in ('restore-deploy', 'save-deploy'):
+        print('usage: {} restore-deploy|save-deploy DEPLOY_OUTPUT'.format(sys.argv[0]))
+        sys.exit(2)
+
+    cache = ChainSnapshotCache()
+    if sys.argv[1] == 'save-deploy':
+        cache.save_deploy(sys.argv[2])
+    elif not cache.restore_deploy(sys.argv[2]):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()